@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""End-to-end scaling benchmark for PyIR
+
+Runs PyIR.run on synthetic repertoires for every combination of input size, --chunk_size, --outfmt and --multi, and
+reports the speedup and parallel efficiency of each process count against a single process. The --report timings of
+each run are used to find the serial part of the run that limits scaling: the input splitter, the parent's merge of
+the chunk outputs (concat or dict merge) or gzip.
+
+    python benchmarks/bench_scaling.py --reads 20000,100000 --multi 1,8,32,64 --out scaling.json
+    python benchmarks/bench_scaling.py --reads 20000,100000 --multi 1,8,32,64 --compare scaling.json
+
+The real IgBLAST binary and germline library are used when `pyir setup` has installed them. Otherwise, or with
+--standin, fake_igblastn.py stands in for IgBLAST with a cost model: a fixed startup per IgBLAST process and a fixed
+CPU cost per read, both spent busy so that workers compete for cores as IgBLAST would.
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import repertoire
+from bench_stages import environment
+from crowelab_pyir import factory, parsers
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_IGBLASTN = os.path.join(BENCHMARK_DIR, 'fake_igblastn.py')
+# Stages the parent process runs on its own, one after another
+SERIAL_STAGES = ['split', 'concat', 'merge', 'gzip']
+
+
+def find_igblast():
+    """Returns the igblastn installed by `pyir setup` if it runs, otherwise None"""
+    name = 'igblastn_darwin' if 'darwin' in sys.platform else 'igblastn_linux'
+    path = os.path.join(os.path.dirname(os.path.abspath(parsers.__file__)), 'data', 'bin', name)
+    try:
+        subprocess.check_call([path, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return path
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_list(value, cast=int):
+    """Parses a comma separated option. 'auto' stands for PyIR's own default"""
+    return [None if item == 'auto' else cast(item) for item in value.split(',')]
+
+
+def default_multi():
+    """Powers of two up to the number of cores, plus the number of cores itself"""
+    cores = os.cpu_count() or 1
+    multi = [1]
+    while multi[-1] * 2 < cores:
+        multi.append(multi[-1] * 2)
+    if cores > 1:
+        multi.append(cores)
+    return multi
+
+
+class ScalingBenchmark:
+    """Runs PyIR over the sweep and collects one result per run"""
+    def __init__(self, work_dir, executable, germlines, repeat, seed):
+        self.work_dir = work_dir
+        self.executable = executable
+        self.germlines = germlines
+        self.repeat = repeat
+        self.seed = seed
+        self.inputs = {}
+        self.runs = []
+
+    def input_file(self, num_reads):
+        """Writes a synthetic repertoire of the given size once and reuses it for every run"""
+        if num_reads not in self.inputs:
+            path = os.path.join(self.work_dir, 'reads_{0}.fasta'.format(num_reads))
+            reads = repertoire.Repertoire(self.germlines, self.seed)
+            reads.write(path, num_reads)
+            reads.save(repertoire.spec_file(path))
+            self.inputs[num_reads] = path
+        return self.inputs[num_reads]
+
+    def run_once(self, query, multi, chunk_size, outfmt):
+        """Runs PyIR once and returns its --report"""
+        report_file = os.path.join(self.work_dir, 'report.json')
+        args = ['-x', self.executable, '--silent', '--tmp_dir', self.work_dir, '--multi', str(multi),
+                '--outfmt', outfmt, '--report', report_file, '--out', os.path.join(self.work_dir, 'out.' + outfmt)]
+        if chunk_size:
+            args += ['--chunk_size', str(chunk_size)]
+
+        os.environ['FAKE_IGBLAST_REPERTOIRE'] = repertoire.spec_file(query)
+        pyir = factory.PyIR(query=query, args=args)
+        result = pyir.run()
+        if isinstance(result, str) and os.path.exists(result):
+            os.remove(result)
+        with open(report_file, 'r') as fin:
+            return json.load(fin)
+
+    def run(self, num_reads, multi, chunk_size, outfmt):
+        query = self.input_file(num_reads)
+        reports = [self.run_once(query, multi, chunk_size, outfmt) for i in range(self.repeat)]
+        report = min(reports, key=lambda r: r['total_wall_seconds'])
+
+        stages = report['stages']
+        serial = collections.OrderedDict((name, stages[name]['wall_seconds']) for name in SERIAL_STAGES
+                                         if name in stages)
+        result = collections.OrderedDict([
+            ('reads', num_reads),
+            ('chunk_size', chunk_size),
+            ('outfmt', outfmt),
+            ('multi', multi),
+            ('actual_chunk_size', report['chunk_size']),
+            ('chunks', report['num_chunks']),
+            ('wall_seconds', report['total_wall_seconds']),
+            ('reads_per_second', round(num_reads / report['total_wall_seconds'], 2)),
+            ('pool_seconds', stages['pool']['wall_seconds']),
+            ('serial_seconds', serial),
+            ('igblast_seconds', stages['worker_igblast']['wall_seconds']),
+            ('igblast_startup_seconds', stages['worker_igblast']['startup_seconds']),
+            ('peak_rss_kb', report['peak_rss_kb']['parent'])
+        ])
+        self.runs.append(result)
+        print('{0:>9,} reads  chunk {1:>6}  {2:<7} multi {3:>4}  {4:>9.2f}s  {5:>10,.0f} reads/s'.format(
+            num_reads, result['actual_chunk_size'], outfmt, multi, result['wall_seconds'],
+            result['reads_per_second']))
+        return result
+
+
+def run_key(run):
+    return (run['reads'], run['chunk_size'], run['outfmt'])
+
+
+def curves(runs):
+    """Groups the runs that differ only in --multi and adds speedup and efficiency against the smallest --multi.
+
+    The serial fraction is the Karp-Flatt estimate, (1/speedup - 1/p) / (1 - 1/p), which grows with p when the
+    overhead of running in parallel grows and stays flat when a fixed serial part limits the speedup."""
+    groups = collections.OrderedDict()
+    for run in runs:
+        groups.setdefault(run_key(run), []).append(run)
+
+    result = []
+    for key, group in groups.items():
+        group = sorted(group, key=lambda r: r['multi'])
+        base = group[0]
+        points = []
+        for run in group:
+            # Speedup relative to the smallest process count, scaled as if that were one process
+            speedup = base['wall_seconds'] / run['wall_seconds'] * base['multi']
+            p = run['multi']
+            point = collections.OrderedDict([
+                ('multi', p),
+                ('wall_seconds', run['wall_seconds']),
+                ('speedup', round(speedup, 3)),
+                ('efficiency', round(speedup / p, 3)),
+                ('serial_fraction', round((1 / speedup - 1 / p) / (1 - 1 / p), 4) if p > 1 else None)
+            ])
+            points.append(point)
+
+        result.append(collections.OrderedDict([
+            ('reads', key[0]),
+            ('chunk_size', key[1]),
+            ('outfmt', key[2]),
+            ('points', points),
+            ('bottleneck', bottleneck(group[-1]))
+        ]))
+    return result
+
+
+def bottleneck(run):
+    """Finds what limits the scaling of a run, usually the one with the most processes"""
+    serial = run['serial_seconds']
+    serial_total = sum(serial.values())
+    stage = max(serial, key=serial.get) if serial else None
+    if run['chunks'] < run['multi']:
+        reason = 'only {0} chunks for {1} processes, lower --chunk_size'.format(run['chunks'], run['multi'])
+    elif stage and serial_total > run['pool_seconds']:
+        reason = 'serial stages take longer than the process pool'
+    else:
+        reason = None
+
+    return collections.OrderedDict([
+        ('multi', run['multi']),
+        ('serial_stage', stage),
+        ('serial_stage_seconds', serial.get(stage)),
+        ('serial_share', round(serial_total / run['wall_seconds'], 4)),
+        ('pool_share', round(run['pool_seconds'] / run['wall_seconds'], 4)),
+        ('igblast_startup_share', round(run['igblast_startup_seconds'] / run['igblast_seconds'], 4)
+                                  if run['igblast_seconds'] else None),
+        ('note', reason)
+    ])
+
+
+def print_curves(results):
+    for curve in results:
+        print('\n{0:,} reads, chunk size {1}, {2}'.format(curve['reads'], curve['chunk_size'] or 'auto',
+                                                          curve['outfmt']))
+        print('{0:>8}{1:>12}{2:>10}{3:>12}{4:>10}'.format('multi', 'seconds', 'speedup', 'efficiency', 'serial'))
+        for point in curve['points']:
+            print('{0:>8}{1:>12.2f}{2:>10.2f}{3:>12.1%}{4:>10}'.format(
+                point['multi'], point['wall_seconds'], point['speedup'], point['efficiency'],
+                '' if point['serial_fraction'] is None else '{0:.1%}'.format(point['serial_fraction'])))
+
+        neck = curve['bottleneck']
+        print('Serial stages take {0:.1%} of the run at multi {1}, mostly {2} ({3:.2f}s)'.format(
+            neck['serial_share'], neck['multi'], neck['serial_stage'], neck['serial_stage_seconds'] or 0))
+        if neck['note']:
+            print('Bottleneck:', neck['note'])
+
+
+def compare(baseline, results, threshold):
+    """Prints the change in wall time of each run found in the baseline and returns the runs that got slower than the
+    threshold"""
+    old_runs = {run_key(run) + (run['multi'],): run for run in baseline['runs']}
+    regressions = []
+    print('\n{0:>9} {1:>6} {2:<7}{3:>6}{4:>12}{5:>12}{6:>10}'.format('reads', 'chunk', 'outfmt', 'multi',
+                                                                   'baseline s', 'current s', 'change'))
+    for run in results['runs']:
+        key = run_key(run) + (run['multi'],)
+        if key not in old_runs:
+            continue
+
+        old = old_runs[key]['wall_seconds']
+        change = (run['wall_seconds'] - old) / old
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = '  SLOWER'
+        print('{0:>9,} {1:>6} {2:<7}{3:>6}{4:>12.2f}{5:>12.2f}{6:>+9.1%}{7}'.format(
+            run['reads'], run['chunk_size'] or 'auto', run['outfmt'], run['multi'], old, run['wall_seconds'],
+            change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how PyIR scales with the number of processes')
+    parser.add_argument('--reads', default='20000', help='Comma separated input sizes, in reads')
+    parser.add_argument('--multi', default=None,
+                        help='Comma separated process counts. Default is powers of two up to the number of cores')
+    parser.add_argument('--chunk_size', default='auto',
+                        help='Comma separated chunk sizes. \'auto\' uses the chunk size PyIR picks')
+    parser.add_argument('--outfmt', default='lsjson', help='Comma separated output formats')
+    parser.add_argument('--repeat', type=int, default=1, help='Times to run each setting; the fastest run is kept')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic repertoires')
+    parser.add_argument('--standin', action='store_true',
+                        help='Use the IgBLAST stand-in even if the real IgBLAST is installed')
+    parser.add_argument('--startup', type=float, default=1.0,
+                        help='Stand-in only: seconds each IgBLAST process spends starting up')
+    parser.add_argument('--seconds_per_read', type=float, default=0.002,
+                        help='Stand-in only: CPU seconds IgBLAST spends on each read')
+    parser.add_argument('--out', default='bench_scaling.json', help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown, as a fraction of the baseline wall time, reported as a regression')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    args = parser.parse_args()
+
+    igblast = None if args.standin else find_igblast()
+    if igblast:
+        germlines = repertoire.Germlines.load(repertoire.default_igdata(), 'human', 'Ig')
+        executable = igblast
+        cost_model = None
+    else:
+        print('Using the IgBLAST stand-in: {0}s startup, {1}s per read'.format(args.startup, args.seconds_per_read))
+        germlines = repertoire.load_germlines(repertoire.default_igdata())
+        executable = FAKE_IGBLASTN
+        cost_model = {'startup_seconds': args.startup, 'seconds_per_read': args.seconds_per_read}
+        os.environ['FAKE_IGBLAST_STARTUP'] = str(args.startup)
+        os.environ['FAKE_IGBLAST_SECONDS_PER_READ'] = str(args.seconds_per_read)
+        os.environ['FAKE_IGBLAST_BUSY'] = '1'
+
+    multi = parse_list(args.multi) if args.multi else default_multi()
+    if max(multi) > (os.cpu_count() or 1):
+        print('Warning: --multi goes above the {0} cores of this machine'.format(os.cpu_count()))
+
+    work_dir = tempfile.mkdtemp(prefix='pyir_scaling_')
+    bench = ScalingBenchmark(work_dir, executable, germlines, args.repeat, args.seed)
+    try:
+        for num_reads in parse_list(args.reads):
+            for chunk_size in parse_list(args.chunk_size):
+                for outfmt in parse_list(args.outfmt, str):
+                    for processes in sorted(multi):
+                        bench.run(num_reads, processes, chunk_size, outfmt)
+    finally:
+        if args.keep:
+            print('Working directory:', work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    results = environment()
+    results['igblast'] = 'stand-in' if cost_model else igblast
+    results['cost_model'] = cost_model
+    results['settings'] = {'repeat': args.repeat, 'seed': args.seed}
+    results['runs'] = bench.runs
+    results['curves'] = curves(bench.runs)
+    print_curves(results['curves'])
+    with open(args.out, 'w') as fout:
+        json.dump(results, fout, indent=4)
+    print('\nResults written to', args.out)
+
+    if args.compare:
+        with open(args.compare, 'r') as fin:
+            regressions = compare(json.load(fin), results, args.threshold)
+        if regressions:
+            print('\n{0} run(s) slower than the baseline'.format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
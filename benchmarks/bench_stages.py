@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""Stage-level benchmarks for PyIR
+
+Times the input splitter, the AIRR and legacy parsers, the filters, the serializers and the concatenation of chunk
+outputs separately, on a synthetic repertoire from repertoire.py. Results are written as JSON so runs of different
+PyIR versions can be compared:
+
+    python benchmarks/bench_stages.py --out before.json
+    (install the new version of PyIR)
+    python benchmarks/bench_stages.py --out after.json --compare before.json
+
+IgBLAST output is generated once by fake_igblastn.py and replayed to the parsers, so only PyIR's own work is timed.
+PyIR is imported from the installed crowelab_pyir package. With --compare, the exit status is 1 if any stage got
+slower than the threshold.
+"""
+import argparse
+import collections
+import gzip
+import json
+import os
+import pickle
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import repertoire
+from crowelab_pyir import arg_parse, columnar, factory, filters, igblast, parsers, reader, records, sort
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_IGBLASTN = os.path.join(BENCHMARK_DIR, 'fake_igblastn.py')
+# Parquet and Arrow are only benchmarked when pyarrow is installed
+COLUMNAR_FORMATS = columnar.FORMATS if columnar.available() else []
+SERIALIZERS = ['lsjson', 'json', 'tsv', 'dict'] + COLUMNAR_FORMATS
+LEGACY_SERIALIZERS = ['lsjson', 'json']
+# Workers write SQLite output as TSV, so it is only benchmarked when the parent loads it
+CONCAT_FORMATS = ['lsjson', 'json', 'tsv', 'sqlite'] + COLUMNAR_FORMATS
+SORT_FORMATS = ['lsjson', 'tsv'] + COLUMNAR_FORMATS
+SORT_BY = 'v_call,cdr3_aa'
+# Expressions that are easy to compile wrong, with a record and whether it passes, checked before the filters are
+# timed: flags compared with a list of strings, and empty fields, which fail != and not in as every comparison
+FILTER_CHECKS = [
+    ("productive in ['T']", {'productive': 'T'}, True),
+    ("productive in ['T']", {'productive': 'F'}, False),
+    ("productive != True", {'productive': ''}, False),
+    ("cdr3_aa_length != 12", {'cdr3_aa_length': ''}, False),
+    ("cdr3_aa_length != 12", {'cdr3_aa_length': 10}, True),
+    ("v_call not in ['IGHV1-2*02']", {'v_call': ''}, False),
+    ("v_call != ''", {'v_call': ''}, False),
+    ("v_call != ''", {'v_call': 'IGHV1-2*02'}, True)
+]
+READ_FORMATS = ['lsjson', 'json', 'tsv']
+READ_FIELDS = ['sequence_id', 'v_call', 'cdr3_aa']
+READ_WHERE = "productive == 'T' and cdr3_aa_length >= 10"
+
+
+class StageBenchmark:
+    """Runs each PyIR stage on the same synthetic data and collects timings"""
+    def __init__(self, work_dir, num_reads, chunk_size, repeat, seed):
+        self.work_dir = work_dir
+        self.num_reads = num_reads
+        self.chunk_size = chunk_size
+        self.repeat = repeat
+        self.results = collections.OrderedDict()
+
+        self.fasta = os.path.join(work_dir, 'reads.fasta')
+        self.fastq = os.path.join(work_dir, 'reads.fastq')
+        reads = repertoire.Repertoire(repertoire.load_germlines(repertoire.default_igdata()), seed)
+        reads.write(self.fasta, num_reads)
+        reads.write(self.fastq, num_reads, fastq=True)
+        reads.save(repertoire.spec_file(self.fasta))
+        os.environ['FAKE_IGBLAST_REPERTOIRE'] = repertoire.spec_file(self.fasta)
+
+        self.airr_output = self.igblast_output('19')
+        # Older IgBLAST releases leave FWR4 empty, so PyIR recovers it for every productive record
+        self.airr_output_no_fwr4 = self.igblast_output('19', no_fwr4=True)
+        self.legacy_output = self.igblast_output('3')
+
+    def igblast_output(self, outfmt, no_fwr4=False):
+        path = os.path.join(self.work_dir, 'igblast_outfmt_{0}{1}.txt'.format(outfmt, '_no_fwr4' if no_fwr4 else ''))
+        env = dict(os.environ, FAKE_IGBLAST_NO_FWR4='1' if no_fwr4 else '0')
+        with open(path, 'w') as fout:
+            subprocess.check_call([sys.executable, FAKE_IGBLASTN, '-query', self.fasta, '-outfmt', outfmt],
+                                  stdout=fout, env=env)
+        return path
+
+    def args(self, query=None, *extra):
+        """PyIR's argument dict, as the command line would build it"""
+        return arg_parse.PyIrArgumentParser().parse_arguments(
+            [query or self.fasta, '-x', FAKE_IGBLASTN, '--silent', '--tmp_dir', self.work_dir,
+             '--chunk_size', str(self.chunk_size)] + list(extra))
+
+    def output_file(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def measure(self, name, records, run, setup=None, teardown=None):
+        """Times run(state) repeat times, where state comes from setup() and isn't part of the timing"""
+        wall = []
+        cpu = []
+        for i in range(self.repeat):
+            state = setup() if setup else None
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            run(state)
+            wall.append(time.perf_counter() - wall_start)
+            cpu.append(time.process_time() - cpu_start)
+            if teardown:
+                teardown(state)
+
+        self.results[name] = {
+            'records': records,
+            'repeat': self.repeat,
+            'wall_seconds': {'min': round(min(wall), 6), 'median': round(statistics.median(wall), 6)},
+            'cpu_seconds': {'min': round(min(cpu), 6), 'median': round(statistics.median(cpu), 6)},
+            'records_per_second': round(records / min(wall), 2) if min(wall) else None
+        }
+        print('{0:<24}{1:>12,.0f} records/s'.format(name, self.results[name]['records_per_second'] or 0))
+
+    def bench_split(self):
+        for input_type, path in [('fasta', self.fasta), ('fastq', self.fastq)]:
+            def setup(path=path):
+                return factory.PyIR(query=path, args=['-x', FAKE_IGBLASTN, '--silent', '--tmp_dir', self.work_dir,
+                                                      '--chunk_size', str(self.chunk_size)])
+
+            self.measure('split_' + input_type, self.num_reads, lambda pyir: pyir.split_input_file(), setup,
+                         lambda pyir: shutil.rmtree(pyir.tmp_dir))
+
+    def parse(self, parser, output):
+        """Runs a parser over replayed IgBLAST output and returns the records, without filtering or writing them"""
+        records = []
+        parser.write_record = lambda d, filtered=False: records.append(d)
+        parser.process(['cat', output])
+        parser.close()
+        return records
+
+    def airr_parser(self, outfmt='lsjson', *extra):
+        return parsers.AirrParser(self.output_file('airr.out'), self.args(None, '--outfmt', outfmt, *extra))
+
+    def legacy_parser(self, outfmt='lsjson', *extra):
+        args = self.args(None, '--legacy', '--outfmt', outfmt, *extra)
+        return parsers.LegacyParser(igblast.IgBlastRun(args).get_seqs_dict(self.fasta), self.output_file('legacy.out'),
+                                    args)
+
+    def bench_parsers(self):
+        self.measure('parse_airr', self.num_reads, lambda parser: self.parse(parser, self.airr_output),
+                     self.airr_parser)
+        self.measure('parse_airr_no_fwr4', self.num_reads,
+                     lambda parser: self.parse(parser, self.airr_output_no_fwr4), self.airr_parser)
+        self.measure('parse_legacy', self.num_reads, lambda parser: self.parse(parser, self.legacy_output),
+                     self.legacy_parser)
+
+        # Parsing, filtering and writing Parquet together, record by record and in batches of columns
+        def process(parser):
+            parser.process(['cat', self.airr_output])
+            parser.close()
+
+        if COLUMNAR_FORMATS:
+            self.measure('process_airr_parquet', self.num_reads, process,
+                         lambda: self.airr_parser('parquet', '--enable_filter', '--batch_size', '0'))
+            self.measure('process_airr_parquet_batch', self.num_reads, process,
+                         lambda: self.airr_parser('parquet', '--enable_filter'))
+
+    def prepare_records(self):
+        """Parses the replayed IgBLAST output once for the stages that work on parsed records"""
+        template = self.airr_parser()
+        self.airr_records = self.parse(template, self.airr_output)
+        self.airr_keys = (template.header_keys, template.out_keys)
+        self.legacy_records = self.parse(self.legacy_parser(), self.legacy_output)
+
+    def check_filters(self):
+        """Raises RuntimeError if a compiled filter expression of FILTER_CHECKS gives the wrong result"""
+        for expression, record, expected in FILTER_CHECKS:
+            passed = filters.PyIRFilters(self.args(None, '--filter_expression', expression)).run_filters(record)
+            if passed != expected:
+                raise RuntimeError('Filter expression {0!r} gives {1} for {2}, expected {3}'.format(
+                    expression, passed, record, expected))
+
+    def bench_filters(self):
+        self.check_filters()
+        for name, records, extra in [('filter_airr', self.airr_records, []),
+                                     ('filter_legacy', self.legacy_records, ['--legacy'])]:
+            def run(pyir_filters, records=records):
+                for d in records:
+                    pyir_filters.run_filters(d)
+
+            self.measure(name, len(records), run,
+                         lambda extra=extra: filters.PyIRFilters(self.args(None, '--enable_filter', *extra)))
+
+        # The same filters compiled for IgBLAST's raw columns, as AirrParser runs them before building records
+        with open(self.airr_output, 'r') as fin:
+            rows = [line.rstrip('\n').split('\t') for line in fin]
+        header = rows.pop(0)
+
+        def run_raw(row_filter):
+            for row in rows:
+                row_filter(row)
+
+        self.measure('filter_airr_raw', len(rows), run_raw,
+                     lambda: filters.PyIRFilters(self.args(None, '--enable_filter')).row_filter(header))
+
+    def airr_writer(self, outfmt, path=None, *extra):
+        """An AirrParser ready to write already parsed records"""
+        parser = parsers.AirrParser(path or self.output_file('airr.' + outfmt),
+                                    self.args(None, '--outfmt', outfmt, *extra))
+        parser.header_keys = list(self.airr_keys[0])
+        parser.out_keys = list(self.airr_keys[1])
+        parser.formatter.set_keys(parser.out_keys)
+        return parser
+
+    @staticmethod
+    def write_records(parser, records):
+        for d in records:
+            parser.write_record(d)
+        parser.close()
+
+    def bench_serializers(self):
+        for outfmt in SERIALIZERS:
+            self.measure('serialize_airr_' + outfmt, len(self.airr_records),
+                         lambda parser: self.write_records(parser, self.airr_records),
+                         lambda outfmt=outfmt: self.airr_writer(outfmt))
+
+        self.measure('serialize_airr_lsjson_fast', len(self.airr_records),
+                     lambda parser: self.write_records(parser, self.airr_records),
+                     lambda: self.airr_writer('lsjson', None, '--fast_json'))
+
+        self.measure('serialize_airr_dict_compact', len(self.airr_records),
+                     lambda parser: self.write_records(parser, self.airr_records),
+                     lambda: self.airr_writer('dict', None, '--compact_dict'))
+
+        for outfmt in ['lsjson'] + COLUMNAR_FORMATS[:1]:
+            self.measure('serialize_airr_{0}_partitioned'.format(outfmt), len(self.airr_records),
+                         lambda parser: self.write_records(parser, self.airr_records),
+                         lambda outfmt=outfmt: self.airr_writer(outfmt, None, '--partition_by', 'v_family'))
+
+        for outfmt in LEGACY_SERIALIZERS:
+            self.measure('serialize_legacy_' + outfmt, len(self.legacy_records),
+                         lambda parser: self.write_records(parser, self.legacy_records),
+                         lambda outfmt=outfmt: parsers.LegacyParser({}, self.output_file('legacy.' + outfmt),
+                                                                    self.args(None, '--legacy', '--outfmt', outfmt)))
+
+    def chunk_outputs(self, outfmt, *extra):
+        """Writes the parsed records as the chunk outputs the workers would have produced"""
+        chunk_files = []
+        for start in range(0, len(self.airr_records), self.chunk_size):
+            path = self.output_file('chunk_{0:06d}.{1}'.format(start // self.chunk_size, outfmt))
+            parser = self.airr_writer(outfmt, path, *extra)
+            self.write_records(parser, self.airr_records[start:start + self.chunk_size])
+            chunk_files.append(path)
+        return chunk_files
+
+    def bench_concat(self):
+        for outfmt in CONCAT_FORMATS:
+            chunk_files = self.chunk_outputs(outfmt)
+            pyir = factory.PyIR(query=self.fasta, args=['-x', FAKE_IGBLASTN, '--silent', '--tmp_dir', self.work_dir,
+                                                        '--outfmt', outfmt])
+            self.measure('concat_' + outfmt, len(self.airr_records),
+                         lambda pyir: pyir.concat_files(chunk_files, self.output_file('concat.' + outfmt)),
+                         lambda: pyir)
+            for path in chunk_files:
+                os.remove(path)
+
+    def bench_sort(self):
+        """Sorting the chunks as the workers do with --sort_by, and merging them into the final file"""
+        for outfmt in SORT_FORMATS:
+            self.measure('sort_chunks_' + outfmt, len(self.airr_records),
+                         lambda outfmt: self.chunk_outputs(outfmt, '--sort_by', SORT_BY), lambda outfmt=outfmt: outfmt)
+            chunk_files = self.chunk_outputs(outfmt, '--sort_by', SORT_BY)
+            pyir = factory.PyIR(query=self.fasta, args=['-x', FAKE_IGBLASTN, '--silent', '--tmp_dir', self.work_dir,
+                                                        '--outfmt', outfmt, '--sort_by', SORT_BY])
+            self.measure('merge_sorted_' + outfmt, len(self.airr_records),
+                         lambda pyir: pyir.concat_files(chunk_files, self.output_file('sorted.' + outfmt)),
+                         lambda: pyir)
+            for path in chunk_files:
+                os.remove(path)
+                if os.path.exists(sort.keys_file(path)):
+                    os.remove(sort.keys_file(path))
+
+    @staticmethod
+    def check_shared_fds(chunks, rounds=20):
+        """Raises RuntimeError if records received through shared memory keep file descriptors open. Every chunk is
+        received rounds times and the records are kept, so a leak shows as a growing count of open descriptors"""
+        if not os.path.isdir('/proc/self/fd'):
+            return
+        # The first segment starts the resource tracker, which keeps a pipe to it open
+        records.SharedRecords.send(chunks[0]).receive()
+        before = len(os.listdir('/proc/self/fd'))
+        received = [records.SharedRecords.send(out_d).receive() for _ in range(rounds) for out_d in chunks]
+        after = len(os.listdir('/proc/self/fd'))
+        if after > before:
+            raise RuntimeError('{0} file descriptors left open after receiving {1} chunks through shared memory'.format(
+                after - before, len(received)))
+
+    def bench_transfer(self):
+        """Passes dict output from the workers to the parent, pickled as the pool's result pipe does and through
+        shared memory"""
+        for name, extra in [('dict', []), ('dict_compact', ['--compact_dict'])]:
+            chunks = []
+            for start in range(0, len(self.airr_records), self.chunk_size):
+                parser = self.airr_writer('dict', None, *extra)
+                self.write_records(parser, self.airr_records[start:start + self.chunk_size])
+                chunks.append(parser.formatter.out_d)
+            self.check_shared_fds(chunks)
+
+            # Sending runs in the workers, receiving in the main process, which receives every chunk
+            self.measure('send_' + name, len(self.airr_records),
+                         lambda chunks: [pickle.dumps(out_d, protocol=pickle.HIGHEST_PROTOCOL) for out_d in chunks],
+                         lambda: chunks)
+            self.measure('receive_' + name, len(self.airr_records),
+                         lambda sent: [pickle.loads(data) for data in sent],
+                         lambda: [pickle.dumps(out_d, protocol=pickle.HIGHEST_PROTOCOL) for out_d in chunks])
+            self.measure('send_' + name + '_shared', len(self.airr_records),
+                         lambda sent: sent.extend(records.SharedRecords.send(out_d) for out_d in chunks), list,
+                         lambda sent: [shared.receive() for shared in sent])
+            self.measure('receive_' + name + '_shared', len(self.airr_records),
+                         lambda sent: [shared.receive() for shared in sent],
+                         lambda: [records.SharedRecords.send(out_d) for out_d in chunks])
+
+    def bench_read(self):
+        """Reads gzipped output back with read_results, every field, only READ_FIELDS, and READ_FIELDS of the
+        records READ_WHERE lets through"""
+        for outfmt in READ_FORMATS:
+            chunk_files = self.chunk_outputs(outfmt)
+            pyir = factory.PyIR(query=self.fasta, args=['-x', FAKE_IGBLASTN, '--silent', '--tmp_dir', self.work_dir,
+                                                        '--outfmt', outfmt])
+            output = self.output_file('read.' + outfmt)
+            pyir.concat_files(chunk_files, output)
+            with open(output, 'rb') as fin, gzip.open(output + '.gz', 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            for path in chunk_files + [output]:
+                os.remove(path)
+
+            for name, kwargs in [('full', {}), ('fields', {'fields': READ_FIELDS}),
+                                 ('where', {'fields': READ_FIELDS, 'where': READ_WHERE})]:
+                self.measure('read_{0}_{1}'.format(name, outfmt), len(self.airr_records),
+                             lambda kwargs: collections.deque(reader.read_results(output + '.gz', **kwargs), 0),
+                             lambda kwargs=kwargs: kwargs)
+
+
+def environment():
+    try:
+        from importlib.metadata import version
+        version = version('crowelab_pyir')
+    except Exception:
+        version = None
+
+    return collections.OrderedDict([
+        ('pyir_version', version),
+        ('pyir_path', os.path.dirname(os.path.abspath(parsers.__file__))),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpu_count', os.cpu_count()),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S'))
+    ])
+
+
+def compare(baseline, results, threshold):
+    """Prints the change in throughput of each stage and returns the stages that got slower than the threshold"""
+    regressions = []
+    print('\n{0:<24}{1:>14}{2:>14}{3:>10}'.format('stage', 'baseline/s', 'current/s', 'change'))
+    for name, result in results['stages'].items():
+        old = baseline['stages'].get(name, {}).get('records_per_second')
+        new = result['records_per_second']
+        if not old or not new:
+            print('{0:<24}{1:>14}{2:>14,.0f}'.format(name, 'n/a', new or 0))
+            continue
+
+        change = (new - old) / old
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print('{0:<24}{1:>14,.0f}{2:>14,.0f}{3:>+9.1%}{4}'.format(name, old, new, change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks each stage of PyIR separately')
+    parser.add_argument('--reads', type=int, default=20000, help='Number of synthetic reads')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Reads per chunk for the splitter and concat')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each stage; the fastest run is reported')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic repertoire')
+    parser.add_argument('--stages', default='split,parse,filter,serialize,concat',
+                        help='Comma separated stages to run')
+    parser.add_argument('--out', default='bench_stages.json', help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown, as a fraction of the baseline throughput, reported as a regression')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    work_dir = tempfile.mkdtemp(prefix='pyir_bench_')
+    try:
+        bench = StageBenchmark(work_dir, args.reads, args.chunk_size, args.repeat, args.seed)
+        if 'split' in stages:
+            bench.bench_split()
+        if 'parse' in stages:
+            bench.bench_parsers()
+        if set(stages) & {'filter', 'serialize', 'concat'}:
+            bench.prepare_records()
+        if 'filter' in stages:
+            bench.bench_filters()
+        if 'serialize' in stages:
+            bench.bench_serializers()
+        if 'concat' in stages:
+            bench.bench_concat()
+            bench.bench_sort()
+            bench.bench_transfer()
+            bench.bench_read()
+    finally:
+        if args.keep:
+            print('Working directory:', work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    results = environment()
+    results['settings'] = {'reads': args.reads, 'chunk_size': args.chunk_size, 'repeat': args.repeat,
+                           'seed': args.seed}
+    results['stages'] = bench.results
+    with open(args.out, 'w') as fout:
+        json.dump(results, fout, indent=4)
+    print('Results written to', args.out)
+
+    if args.compare:
+        with open(args.compare, 'r') as fin:
+            regressions = compare(json.load(fin), results, args.threshold)
+        if regressions:
+            print('\n{0} stage(s) slower than the baseline: {1}'.format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
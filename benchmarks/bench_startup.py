@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Startup-time benchmark for PyIR
+
+Measures the fixed cost every PyIR invocation pays before any sequence is processed, each in a fresh interpreter:
+
+    python      starting the interpreter, for reference
+    import      importing crowelab_pyir
+    help        pyir -h
+    api_cold    creating a PyIR object with an empty state file, so the IgBLAST executable is checked
+    api_warm    creating a PyIR object once the state file remembers the executable
+    tiny_job    a complete pyir run on 10 reads with the IgBLAST stand-in
+
+The api measurements use the IgBLAST installed with PyIR when there is one, and otherwise the stand-in given with -x,
+which PyIR doesn't run to check. Results are written as JSON; with --compare, the exit status is 1 if any measurement
+got slower than the threshold.
+
+    python benchmarks/bench_startup.py --out before.json
+    python benchmarks/bench_startup.py --out after.json --compare before.json
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import repertoire
+from bench_scaling import find_igblast
+from bench_stages import environment
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_IGBLASTN = os.path.join(BENCHMARK_DIR, 'fake_igblastn.py')
+TINY_READS = 10
+
+
+class StartupBenchmark:
+    """Times commands in fresh interpreters"""
+    def __init__(self, work_dir, repeat):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = collections.OrderedDict()
+        self.env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, 'cache'),
+                        XDG_CONFIG_HOME=os.path.join(work_dir, 'config'))
+
+        self.query = os.path.join(work_dir, 'tiny.fasta')
+        reads = repertoire.Repertoire(repertoire.Germlines.synthetic())
+        reads.write(self.query, TINY_READS)
+        reads.save(repertoire.spec_file(self.query))
+        self.env['FAKE_IGBLAST_REPERTOIRE'] = repertoire.spec_file(self.query)
+
+    def clear_state(self):
+        shutil.rmtree(self.env['XDG_CACHE_HOME'], ignore_errors=True)
+
+    def measure(self, name, command, setup=None):
+        """Runs command repeat times, calling setup() untimed before each run"""
+        times = []
+        for i in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            subprocess.run(command, env=self.env, cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+
+        self.results[name] = {
+            'repeat': self.repeat,
+            'seconds': {'min': round(min(times), 6), 'median': round(statistics.median(times), 6)}
+        }
+        print('{0:<12}{1:>10.1f} ms'.format(name, min(times) * 1000))
+
+    def api_command(self, args):
+        return [sys.executable, '-c', 'from crowelab_pyir import PyIR; PyIR(query={0!r}, args={1!r})'.format(
+            self.query, args)]
+
+    def run(self, pyir_script):
+        self.measure('python', [sys.executable, '-c', 'pass'])
+        self.measure('import', [sys.executable, '-c', 'import crowelab_pyir'])
+        if pyir_script:
+            self.measure('help', [sys.executable, pyir_script, '-h'])
+
+        args = ['--silent'] if find_igblast() else ['--silent', '-x', FAKE_IGBLASTN]
+        self.measure('api_cold', self.api_command(args), self.clear_state)
+        self.measure('api_warm', self.api_command(args))
+
+        if pyir_script:
+            self.measure('tiny_job', [sys.executable, pyir_script, self.query, '-x', FAKE_IGBLASTN, '--silent',
+                                      '--multi', '1', '--out', os.path.join(self.work_dir, 'tiny')])
+
+
+def compare(baseline, results, threshold):
+    """Prints the change of each measurement and returns the ones that got slower than the threshold"""
+    regressions = []
+    print('\n{0:<12}{1:>14}{2:>14}{3:>10}'.format('', 'baseline ms', 'current ms', 'change'))
+    for name, result in results['startup'].items():
+        if name not in baseline['startup']:
+            continue
+
+        old = baseline['startup'][name]['seconds']['min']
+        new = result['seconds']['min']
+        change = (new - old) / old
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print('{0:<12}{1:>14.1f}{2:>14.1f}{3:>+9.1%}{4}'.format(name, old * 1000, new * 1000, change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of PyIR')
+    parser.add_argument('--repeat', type=int, default=10, help='Times to run each measurement; the fastest is kept')
+    parser.add_argument('--pyir', default=shutil.which('pyir'), help='The pyir script. Default is the one on PATH')
+    parser.add_argument('--out', default='bench_startup.json', help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown, as a fraction of the baseline time, reported as a regression')
+    args = parser.parse_args()
+
+    if not args.pyir:
+        print('No pyir script found on PATH, skipping the measurements that need it. Set it with --pyir')
+
+    work_dir = tempfile.mkdtemp(prefix='pyir_startup_')
+    try:
+        bench = StartupBenchmark(work_dir, args.repeat)
+        bench.run(args.pyir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    results = environment()
+    results['igblast'] = find_igblast() or 'stand-in'
+    results['startup'] = bench.results
+    with open(args.out, 'w') as fout:
+        json.dump(results, fout, indent=4)
+    print('Results written to', args.out)
+
+    if args.compare:
+        with open(args.compare, 'r') as fin:
+            regressions = compare(json.load(fin), results, args.threshold)
+        if regressions:
+            print('\n{0} measurement(s) slower than the baseline: {1}'.format(len(regressions),
+                                                                            ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""A stand-in for igblastn that replays realistic IgBLAST output for reads generated by repertoire.py
+
+Takes igblastn's command line and writes the AIRR TSV report for -outfmt 19 or the legacy text report for -outfmt 3,
+rebuilding the rearrangement of each read from its sequence id. Reads it doesn't recognise get IgBLAST's 'no hits'
+output. The germline options are ignored; everything else comes from the environment:
+
+    FAKE_IGBLAST_REPERTOIRE          repertoire spec written by repertoire.py (required)
+    FAKE_IGBLAST_STARTUP             seconds spent starting up, as IgBLAST does loading its databases (default 0)
+    FAKE_IGBLAST_SECONDS_PER_READ    seconds spent on each read (default 0)
+    FAKE_IGBLAST_BUSY                set to 1 to burn CPU for those times instead of sleeping
+    FAKE_IGBLAST_NO_FWR4             set to 1 to leave fwr4 empty, as older IgBLAST releases do
+
+Usage:
+    pyir repertoire.fasta -x benchmarks/fake_igblastn.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import repertoire
+
+AIRR_HEADER = ['sequence_id', 'sequence', 'locus', 'stop_codon', 'vj_in_frame', 'v_frameshift', 'productive',
+               'rev_comp', 'complete_vdj', 'v_call', 'd_call', 'j_call', 'c_call', 'sequence_alignment',
+               'germline_alignment', 'sequence_alignment_aa', 'germline_alignment_aa', 'v_alignment_start',
+               'v_alignment_end', 'd_alignment_start', 'd_alignment_end', 'j_alignment_start', 'j_alignment_end',
+               'v_sequence_alignment', 'v_sequence_alignment_aa', 'v_germline_alignment', 'v_germline_alignment_aa',
+               'd_sequence_alignment', 'd_sequence_alignment_aa', 'd_germline_alignment', 'd_germline_alignment_aa',
+               'j_sequence_alignment', 'j_sequence_alignment_aa', 'j_germline_alignment', 'j_germline_alignment_aa',
+               'fwr1', 'fwr1_aa', 'cdr1', 'cdr1_aa', 'fwr2', 'fwr2_aa', 'cdr2', 'cdr2_aa', 'fwr3', 'fwr3_aa', 'fwr4',
+               'fwr4_aa', 'cdr3', 'cdr3_aa', 'junction', 'junction_length', 'junction_aa', 'junction_aa_length',
+               'v_score', 'd_score', 'j_score', 'v_cigar', 'd_cigar', 'j_cigar', 'v_support', 'd_support',
+               'j_support', 'v_identity', 'd_identity', 'j_identity', 'v_sequence_start', 'v_sequence_end',
+               'v_germline_start', 'v_germline_end', 'd_sequence_start', 'd_sequence_end', 'd_germline_start',
+               'd_germline_end', 'j_sequence_start', 'j_sequence_end', 'j_germline_start', 'j_germline_end',
+               'fwr1_start', 'fwr1_end', 'cdr1_start', 'cdr1_end', 'fwr2_start', 'fwr2_end', 'cdr2_start',
+               'cdr2_end', 'fwr3_start', 'fwr3_end', 'fwr4_start', 'fwr4_end', 'cdr3_start', 'cdr3_end', 'np1',
+               'np1_length', 'np2', 'np2_length']
+REGIONS = ['fwr1', 'cdr1', 'fwr2', 'cdr2', 'fwr3']
+LEGACY_REGIONS = {'fwr1': 'FR1', 'cdr1': 'CDR1', 'fwr2': 'FR2', 'cdr2': 'CDR2', 'fwr3': 'FR3', 'cdr3': 'CDR3'}
+CHAIN_TYPES = {'IGH': 'VH', 'IGK': 'VK', 'IGL': 'VL', 'TRA': 'VA', 'TRB': 'VB', 'TRD': 'VD', 'TRG': 'VG'}
+# Alignment columns per block of the legacy report
+LINE_LENGTH = 120
+# Rough blastn statistics for IgBLAST's default scoring: bits = BIT_SCALE * raw score + BIT_OFFSET
+BIT_SCALE = 1.57
+BIT_OFFSET = 1.69
+SEARCH_SPACE = {'V': 3.6e7, 'D': 2.5e5, 'J': 1.5e5}
+
+
+def spend(seconds, busy):
+    """Stands in for the time IgBLAST spends searching"""
+    if seconds <= 0:
+        return
+    if busy:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+    else:
+        time.sleep(seconds)
+
+
+def read_fasta(path):
+    records = []
+    with open(path, 'r') as fin:
+        for line in fin:
+            if line.startswith('>'):
+                records.append([line[1:].strip().split()[0], ''])
+            elif records:
+                records[-1][1] += line.strip()
+    return records
+
+
+def format_evalue(evalue):
+    """Formats an e-value the way IgBLAST's hit table does"""
+    if evalue == 0:
+        return '0.0'
+    elif evalue < 1e-3:
+        return '{0:.0e}'.format(evalue)
+    elif evalue < 10:
+        return '{0:.2g}'.format(evalue)
+    return '{0:.0f}'.format(evalue)
+
+
+class Hit:
+    """Scores for the alignment of one germline gene with the read"""
+    def __init__(self, segment_type, segment, penalty=1):
+        self.type = segment_type
+        self.name = segment.name
+        self.length = len(segment.query)
+        self.matches = sum(1 for q, g in zip(segment.query, segment.germline) if q == g)
+        self.gaps = sum(1 for q, g in zip(segment.query, segment.germline) if q == '-' or g == '-')
+        self.mismatches = self.length - self.matches - self.gaps
+        gap_opens = sum(1 for i in range(self.length) if (segment.query[i] == '-' or segment.germline[i] == '-') and
+                        (i == 0 or (segment.query[i - 1] != '-' and segment.germline[i - 1] != '-')))
+        raw = self.matches - penalty * self.mismatches - 5 * gap_opens - 2 * self.gaps
+        self.bits = max(BIT_SCALE * raw + BIT_OFFSET, 0)
+        self.evalue = SEARCH_SPACE[segment_type] * 2 ** -self.bits
+        self.identity = 100.0 * self.matches / self.length if self.length else 0
+
+    def scaled(self, name, factor):
+        """A weaker hit on another gene, for the extra alignments of the legacy report"""
+        hit = Hit.__new__(Hit)
+        hit.__dict__.update(self.__dict__)
+        hit.name = name
+        hit.matches = int(self.matches * factor)
+        hit.mismatches = self.length - hit.matches - self.gaps
+        hit.bits = self.bits * factor
+        hit.evalue = SEARCH_SPACE[self.type] * 2 ** -hit.bits
+        hit.identity = 100.0 * hit.matches / self.length if self.length else 0
+        return hit
+
+
+class Annotation:
+    """What IgBLAST reports for a read: the regions, calls and scores derived from its rearrangement"""
+    def __init__(self, rearrangement, germlines):
+        self.rearrangement = rearrangement
+        self.germlines = germlines
+        self.sequence = rearrangement.sequence
+        segments = rearrangement.segments
+        self.v = segments['V']
+        self.d = segments.get('D')
+        self.j = segments['J']
+        self.segments = [('V', self.v)] + ([('D', self.d)] if self.d else []) + [('J', self.j)]
+        self.hits = {'V': Hit('V', self.v), 'J': Hit('J', self.j, penalty=2)}
+        if self.d:
+            self.hits['D'] = Hit('D', self.d, penalty=3)
+
+        # The read aligned against its germline genes, with N-regions in between
+        np2 = rearrangement.np2 if self.d else ''
+        self.query_alignment = self.v.query + rearrangement.np1 + (self.d.query if self.d else '') + np2 + \
+            self.j.query
+        self.germline_alignment = self.v.germline + 'N' * len(rearrangement.np1) + \
+            (self.d.germline + 'N' * len(np2) if self.d else '') + self.j.germline
+        self.columns = {'V': 0, 'J': len(self.query_alignment) - len(self.j.query)}
+        if self.d:
+            self.columns['D'] = len(self.v.query) + len(rearrangement.np1)
+        self.base_columns = [column for column, base in enumerate(self.query_alignment) if base != '-']
+
+        # Frame of the first full V codon, and the CDR3 from the end of FR3 to the J gene's last CDR3 base
+        self.frame_start = self.query_position(self.v, self.v.germline_start + (-self.v.germline_start) % 3)
+        regions = germlines.v_regions[self.v.name]
+        self.regions = []
+        for index, name in enumerate(REGIONS):
+            start = max(regions[index * 2] - 1, self.v.germline_start)
+            end = min(regions[index * 2 + 1], self.v.germline_end)
+            if end > start:
+                self.regions.append((name, self.query_position(self.v, start), self.query_position(self.v, end)))
+
+        self.cdr3 = None
+        if regions[9] < self.v.germline_end:
+            cdr3_end = self.j.query_start + germlines.j_cdr3_ends[self.j.name] - self.j.germline_start + 1
+            self.cdr3 = (self.query_position(self.v, regions[9]), cdr3_end)
+
+        self.aa = repertoire.translate(self.sequence[self.frame_start:])
+        v_gaps = self.v.query.count('-') - self.v.germline.count('-')
+        self.v_frameshift = v_gaps % 3 != 0
+        j_frame = self.j.query_start + (self.germlines.j_frames[self.j.name] - self.j.germline_start) % 3
+        self.vj_in_frame = self.cdr3 is not None and (j_frame - self.cdr3[0]) % 3 == 0
+        self.stop_codon = '*' in self.aa
+        self.productive = self.vj_in_frame and not self.stop_codon and not self.v_frameshift
+
+    @staticmethod
+    def query_position(segment, germline_position):
+        """The 0-based read position aligned with a germline position, or the next read base if it was deleted"""
+        query = segment.query_start
+        germline = segment.germline_start
+        for q, g in zip(segment.query, segment.germline):
+            if g != '-':
+                if germline == germline_position:
+                    return query
+                germline += 1
+            if q != '-':
+                query += 1
+        return query
+
+    def translate_from(self, start, seq):
+        """Translates part of the read that starts at position start in the reading frame of the V gene"""
+        return repertoire.translate(seq[(self.frame_start - start) % 3:])
+
+    @staticmethod
+    def cigar(segment, read_length):
+        ops = []
+        for q, g in zip(segment.query, segment.germline):
+            op = 'D' if q == '-' else 'I' if g == '-' else 'M'
+            if ops and ops[-1][0] == op:
+                ops[-1][1] += 1
+            else:
+                ops.append([op, 1])
+
+        cigar = '{0}S'.format(segment.query_start) if segment.query_start else ''
+        cigar += '{0}N'.format(segment.germline_start) if segment.germline_start else ''
+        cigar += ''.join('{0}{1}'.format(count, op) for op, count in ops)
+        if read_length > segment.query_end:
+            cigar += '{0}S'.format(read_length - segment.query_end)
+        return cigar
+
+    def airr(self):
+        r = self.rearrangement
+        seq = self.sequence
+        d = {
+            'sequence_id': r.read_id,
+            'sequence': seq,
+            'locus': r.locus,
+            'stop_codon': 'T' if self.stop_codon else 'F',
+            'vj_in_frame': 'T' if self.vj_in_frame else 'F',
+            'v_frameshift': 'T' if self.v_frameshift else 'F',
+            'productive': 'T' if self.productive else 'F',
+            'rev_comp': 'F',
+            'complete_vdj': 'T' if self.v.germline_start == 0 else 'F',
+            'sequence_alignment': self.query_alignment,
+            'germline_alignment': self.germline_alignment,
+            'sequence_alignment_aa': self.aa,
+            'germline_alignment_aa': self.translate_from(0, self.germline_alignment.replace('-', '')),
+            'np1': r.np1,
+            'np1_length': str(len(r.np1)),
+            'np2': r.np2 if self.d else '',
+            'np2_length': str(len(r.np2)) if self.d else ''
+        }
+
+        for segment_type, segment in self.segments:
+            prefix = segment_type.lower() + '_'
+            hit = self.hits[segment_type]
+            column = self.columns[segment_type]
+            d.update({
+                prefix + 'call': segment.name,
+                prefix + 'alignment_start': str(column + 1),
+                prefix + 'alignment_end': str(column + len(segment.query)),
+                prefix + 'sequence_alignment': segment.query,
+                prefix + 'sequence_alignment_aa': self.translate_from(segment.query_start,
+                                                                      segment.query.replace('-', '')),
+                prefix + 'germline_alignment': segment.germline,
+                prefix + 'germline_alignment_aa': self.translate_from(segment.query_start,
+                                                                      segment.germline.replace('-', '')),
+                prefix + 'score': '{0:.3f}'.format(hit.bits),
+                prefix + 'cigar': self.cigar(segment, len(seq)),
+                prefix + 'support': '{0:.3e}'.format(hit.evalue),
+                prefix + 'identity': '{0:.3f}'.format(hit.identity),
+                prefix + 'sequence_start': str(segment.query_start + 1),
+                prefix + 'sequence_end': str(segment.query_end),
+                prefix + 'germline_start': str(segment.germline_start + 1),
+                prefix + 'germline_end': str(segment.germline_end)
+            })
+
+        regions = list(self.regions)
+        if self.cdr3:
+            regions.append(('cdr3', self.cdr3[0], self.cdr3[1]))
+            if os.environ.get('FAKE_IGBLAST_NO_FWR4') != '1':
+                regions.append(('fwr4', self.cdr3[1], self.j.query_end))
+
+            junction = seq[self.cdr3[0] - 3:self.cdr3[1] + 3]
+            d['junction'] = junction
+            d['junction_length'] = str(len(junction))
+            d['junction_aa'] = repertoire.translate(junction)
+            d['junction_aa_length'] = str(len(d['junction_aa']))
+
+        for name, start, end in regions:
+            d[name] = seq[start:end]
+            d[name + '_aa'] = self.translate_from(start, seq[start:end])
+            d[name + '_start'] = str(start + 1)
+            d[name + '_end'] = str(end)
+
+        return '\t'.join(d.get(key, '') for key in AIRR_HEADER)
+
+    def other_hits(self, segment_type, names, count, rng):
+        """The top hit followed by weaker hits on other genes of the same locus"""
+        top = self.hits[segment_type]
+        others = [name for name in names if name != top.name]
+        rng.shuffle(others)
+        hits = [top]
+        for name in others[:count - 1]:
+            hits.append(top.scaled(name, rng.uniform(0.7, 0.97)))
+        return hits
+
+    def legacy(self, query_number, num_alignments):
+        """The -outfmt 3 report for the read"""
+        r = self.rearrangement
+        seq = self.sequence
+        rng = random.Random(r.read_id)
+        loci = self.germlines.loci[r.locus]
+        hits = self.other_hits('V', loci['V'], num_alignments['V'], rng)
+        if self.d:
+            hits.extend(self.other_hits('D', list(self.germlines.genes['D']), num_alignments['D'], rng))
+        hits.extend(self.other_hits('J', loci['J'], num_alignments['J'], rng))
+
+        lines = ['Query= ' + r.read_id, '', 'Length={0}'.format(len(seq)),
+                 '{0:>108}'.format('Score     E'),
+                 '{0:<100}{1}'.format('Sequences producing significant alignments:', '(Bits)  Value'), '']
+        lines.extend('{0:<100}{1:<8.1f}{2}'.format(hit.name, hit.bits, format_evalue(hit.evalue)) for hit in hits)
+        lines.extend(['', '', 'Domain classification requested: imgt', ''])
+
+        summary = [self.v.name] + ([self.d.name] if self.d else []) + [self.j.name, 'N/A', CHAIN_TYPES.get(r.locus, 'N/A'),
+                                                                        'Yes' if self.stop_codon else 'No',
+                                                                        'In-frame' if self.vj_in_frame else
+                                                                        'Out-of-frame',
+                                                                        'Yes' if self.productive else 'No', '+',
+                                                                        'Yes' if self.v_frameshift else 'No']
+        lines.append('V-(D)-J rearrangement summary for query sequence (Top V gene match, ' +
+                     ('Top D gene match, ' if self.d else '') + 'Top J gene match, Top C gene match, Chain type, '
+                     'stop codon, V-J frame, Productive, Strand, V Frame shift).  Multiple equivalent top matches, if '
+                     'present, are separated by a comma.')
+        lines.extend(['\t'.join(summary), ''])
+
+        v_end = seq[max(self.v.query_end - 5, 0):self.v.query_end]
+        j_start = seq[self.j.query_start:self.j.query_start + 5]
+        if self.d:
+            lines.append('V-(D)-J junction details based on top germline gene matches (V end, V-D junction, D region, '
+                         'D-J junction, J start).  Note that possible overlapping nucleotides at VDJ junction (i.e, '
+                         'nucleotides that could be assigned to either rearranging gene) are indicated in parentheses '
+                         '(i.e., (TACT)) but are not included under the V, D, or J gene itself')
+            junction = [v_end, r.np1 or 'N/A', self.d.query, r.np2 or 'N/A', j_start]
+        else:
+            lines.append('V-(D)-J junction details based on top germline gene matches (V end, V-J junction, J start). '
+                         ' Note that possible overlapping nucleotides at VDJ junction (i.e, nucleotides that could be '
+                         'assigned to either rearranging gene) are indicated in parentheses (i.e., (TACT)) but are not '
+                         'included under the V, D, or J gene itself')
+            junction = [v_end, r.np1 or 'N/A', j_start]
+        lines.extend(['\t'.join(junction) + '\t', ''])
+
+        if self.cdr3:
+            cdr3 = seq[self.cdr3[0]:self.cdr3[1]]
+            lines.extend(['Sub-region sequence details (nucleotide sequence, translation, start, end)',
+                          'CDR3\t{0}\t{1}\t{2}\t{3}\t'.format(cdr3, '  '.join(repertoire.translate(cdr3)),
+                                                               self.cdr3[0] + 1, self.cdr3[1]), ''])
+
+        lines.append('Alignment summary between query and top germline V gene hit (from, to, length, matches, '
+                     'mismatches, gaps, percent identity)')
+        totals = [0, 0, 0, 0]
+        for name, start, end in self.regions:
+            stats = self.region_stats(start, end)
+            totals = [total + stat for total, stat in zip(totals, stats)]
+            lines.append('{0}-IMGT\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7:.1f}'.format(
+                LEGACY_REGIONS[name], start + 1, end, stats[0], stats[1], stats[2], stats[3],
+                100.0 * stats[1] / stats[0]))
+        if self.cdr3 and self.cdr3[0] < self.v.query_end:
+            stats = self.region_stats(self.cdr3[0], self.v.query_end)
+            totals = [total + stat for total, stat in zip(totals, stats)]
+            lines.append('CDR3-IMGT (germline)\t{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6:.1f}'.format(
+                self.cdr3[0] + 1, self.v.query_end, stats[0], stats[1], stats[2], stats[3],
+                100.0 * stats[1] / stats[0]))
+        lines.append('Total\tN/A\tN/A\t{0}\t{1}\t{2}\t{3}\t{4:.1f}'.format(totals[0], totals[1], totals[2], totals[3],
+                                                                          100.0 * totals[1] / max(totals[0], 1)))
+        lines.extend(['', '', 'Alignments', ''])
+        lines.extend(self.alignment_blocks(query_number, hits))
+        return lines
+
+    def region_stats(self, start, end):
+        """Length, matches, mismatches and gaps of the V alignment over part of the read"""
+        first = self.base_columns[start]
+        last = self.base_columns[min(end, len(self.base_columns)) - 1] + 1
+        pairs = list(zip(self.v.query[first:last], self.v.germline[first:last]))
+        matches = sum(1 for q, g in pairs if q == g)
+        gaps = sum(1 for q, g in pairs if q == '-' or g == '-')
+        return [len(pairs), matches, len(pairs) - matches - gaps, gaps]
+
+    def alignment_blocks(self, query_number, hits):
+        """The alignment of the read with its top hits, LINE_LENGTH columns at a time, topped by the IMGT region
+        markers and the translation"""
+        width = len(self.query_alignment)
+        header = [' '] * width
+        regions = list(self.regions) + ([('cdr3', self.cdr3[0], self.cdr3[1])] if self.cdr3 else [])
+        for name, start, end in regions:
+            first = self.base_columns[start]
+            last = self.base_columns[min(end, len(self.base_columns)) - 1] + 1
+            label = LEGACY_REGIONS[name] + '-IMGT'
+            length = last - first
+            if length >= len(label) + 2:
+                left = (length - len(label) - 2) // 2
+                marker = '<' + '-' * left + label + '-' * (length - len(label) - 2 - left) + '>'
+            else:
+                marker = '<' + '-' * (length - 2) + '>' if length >= 2 else '<'
+            header[first:last] = marker
+
+        translation = [' '] * width
+        for index in range(self.frame_start + 1, len(self.sequence) - 1, 3):
+            translation[self.base_columns[index]] = self.aa[(index - self.frame_start) // 3]
+
+        v_gene = self.germlines.genes['V'][self.v.name]
+        germline_translation = [' '] * width
+        position = self.v.germline_start
+        for column, base in enumerate(self.v.germline):
+            if base != '-':
+                if position % 3 == 1 and position + 1 < len(v_gene):
+                    germline_translation[column] = repertoire.CODON_TABLE.get(v_gene[position - 1:position + 2], 'X')
+                position += 1
+
+        label = 'Query_{0}'.format(query_number)
+        rows = [(label, self.query_alignment, 1)]
+        for segment_type, segment in self.segments:
+            hit = hits[[h.name for h in hits].index(segment.name)]
+            row = [' '] * width
+            column = self.columns[segment_type]
+            for offset, (q, g) in enumerate(zip(segment.query, segment.germline)):
+                row[column + offset] = '.' if q == g else g
+            rows.append(('{0}  {1:.1f}% ({2}/{3})  {4}'.format(segment_type, hit.identity, hit.matches, hit.length,
+                                                                segment.name), ''.join(row),
+                         segment.germline_start + 1))
+
+        label_width = max(len(row[0]) for row in rows) + 2
+        pad = ' ' * (label_width + 6)
+        header = ''.join(header)
+        translation = ''.join(translation)
+        germline_translation = ''.join(germline_translation)
+        starts = [row[2] for row in rows]
+
+        lines = []
+        for block in range(0, width, LINE_LENGTH):
+            part = slice(block, block + LINE_LENGTH)
+            if header[part].strip():
+                lines.append(pad + header[part].rstrip())
+            if translation[part].strip():
+                lines.append(pad + translation[part].rstrip())
+
+            for index, (name, row, _) in enumerate(rows):
+                residues = sum(1 for base in row[part] if base not in ' -')
+                if residues:
+                    lines.append('{0:<{1}}{2:<6}{3}  {4}'.format(name, label_width, starts[index], row[part],
+                                                                 starts[index] + residues - 1))
+                    if name.startswith('V ') and germline_translation[part].strip():
+                        lines.append(pad + germline_translation[part].rstrip())
+                    starts[index] += residues
+            lines.append('')
+
+        return lines
+
+
+def no_hits_legacy(read_id, seq):
+    return ['Query= ' + read_id, '', 'Length={0}'.format(len(seq)), '', '', '***** No hits found *****', '', '']
+
+
+def legacy_footer():
+    return ['Lambda      K        H        a         alpha', '    1.10    0.333     0.549     0.00     0.00', '',
+            'Gapped', 'Lambda      K        H        a         alpha         sigma',
+            '    1.08    0.280     0.540     0.00     0.00     0.00', '', 'Effective search space used: 36000000', '']
+
+
+def get_option(argv, name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+
+def main():
+    argv = sys.argv[1:]
+    if '-h' in argv or '-help' in argv:
+        print('USAGE\n  fake_igblastn.py -query <file> -outfmt <3|19> [igblastn options]')
+        return
+
+    spec = os.environ.get('FAKE_IGBLAST_REPERTOIRE')
+    if not spec:
+        sys.stderr.write('FAKE_IGBLAST_REPERTOIRE must be set to the spec written by repertoire.py\n')
+        sys.exit(1)
+
+    busy = os.environ.get('FAKE_IGBLAST_BUSY') == '1'
+    seconds_per_read = float(os.environ.get('FAKE_IGBLAST_SECONDS_PER_READ', 0))
+    spend(float(os.environ.get('FAKE_IGBLAST_STARTUP', 0)), busy)
+
+    reads = repertoire.Repertoire.load(spec)
+    legacy = get_option(argv, '-outfmt', '19') == '3'
+    num_alignments = {segment: int(get_option(argv, '-num_alignments_' + segment, 3)) for segment in 'VDJ'}
+
+    out = sys.stdout
+    if legacy:
+        out.write('IGBLASTN 2.8.1+\n\n\nReference: Jian Ye, Ning Ma, Thomas L. Madden and James M. Ostell (2013). '
+                  'IgBLAST: an\nimmunoglobulin variable domain sequence analysis tool. Nucleic Acids Res. 41:W34-W40.'
+                  '\n\n\nDatabase: {0}\n\n\n'.format(get_option(argv, '-germline_db_V', '')))
+    else:
+        out.write('\t'.join(AIRR_HEADER) + '\n')
+
+    for number, (read_id, seq) in enumerate(read_fasta(get_option(argv, '-query')), 1):
+        spend(seconds_per_read, busy)
+        index = reads.read_index(read_id)
+        rearrangement = reads.rearrange(index) if index is not None else None
+        annotation = Annotation(rearrangement, reads.germlines) \
+            if rearrangement and rearrangement.sequence == seq.upper() else None
+
+        if legacy:
+            lines = annotation.legacy(number, num_alignments) if annotation else no_hits_legacy(read_id, seq)
+            out.write('\n'.join(lines + legacy_footer()) + '\n')
+        elif annotation:
+            out.write(annotation.airr() + '\n')
+        else:
+            out.write('\t'.join([read_id, seq] + [''] * (len(AIRR_HEADER) - 2)) + '\n')
+
+    if legacy:
+        out.write('  Database: {0}\n    Posted date:  Jan 1, 2020  12:00 AM\n  Number of letters in database: '
+                  '100,000\n  Number of sequences in database:  300\n\nMatrix: blastn matrix 1 -1\nGap Penalties: '
+                  'Existence: 5, Extension: 2\n'.format(get_option(argv, '-germline_db_V', '')))
+
+
+if __name__ == '__main__':
+    main()
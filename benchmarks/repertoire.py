@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""Synthetic antibody repertoires for benchmarking PyIR
+
+Reads are built by recombining the V, D and J germline genes written by `pyir setup`, with trimmed gene ends, random
+N-regions, point mutations and indels. Each read is generated from its own random seed, derived from the repertoire
+seed and the read's index, so fake_igblastn.py can rebuild the rearrangement behind any read from its sequence id.
+The settings needed to do that are saved next to the reads as a small JSON spec.
+
+If the germline library hasn't been set up, random germline genes shaped like human heavy and kappa genes are used.
+
+Usage:
+    python benchmarks/repertoire.py 100000 repertoire.fasta
+    export FAKE_IGBLAST_REPERTOIRE=repertoire.repertoire.json
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+
+SEGMENTS = ['V', 'D', 'J']
+NUCLEOTIDES = 'ACGT'
+CODONS = [a + b + c for a in 'TCAG' for b in 'TCAG' for c in 'TCAG']
+CODON_TABLE = dict(zip(CODONS, 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'))
+SENSE_CODONS = [codon for codon in CODONS if CODON_TABLE[codon] != '*']
+# Loci that rearrange a D gene
+D_LOCI = ['IGH', 'TRB', 'TRD']
+# IMGT FR1 to FR3 boundaries (1-based, inclusive) for V genes missing from IgBLAST's internal data
+HEAVY_REGIONS = [1, 75, 76, 99, 100, 150, 151, 174, 175, 288]
+LIGHT_REGIONS = [1, 78, 79, 96, 97, 147, 148, 156, 157, 264]
+
+
+def translate(seq):
+    """Translates a nucleotide sequence from its first base. Codons with gaps or ambiguous bases become 'X'"""
+    return ''.join(CODON_TABLE.get(seq[i:i + 3], 'X') for i in range(0, len(seq) - 2, 3))
+
+
+def read_fasta(path):
+    genes = collections.OrderedDict()
+    name = None
+    with open(path, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                genes[name] = ''
+            elif name:
+                genes[name] += line.upper()
+
+    return genes
+
+
+class Germlines:
+    """V, D and J germline genes along with the positions IgBLAST uses to find the CDR3: the FR1 to FR3 boundaries of
+    each V gene and the coding frame and last CDR3 base (both 0-based) of each J gene"""
+    def __init__(self, genes, v_regions, j_frames, j_cdr3_ends, source):
+        self.genes = genes
+        self.v_regions = v_regions
+        self.j_frames = j_frames
+        self.j_cdr3_ends = j_cdr3_ends
+        self.source = source
+
+        # The V and J genes of each locus, so that a read never pairs genes from different loci. J genes without a
+        # known CDR3 end (mostly pseudogenes) are left out
+        self.loci = collections.OrderedDict()
+        for name in genes['V']:
+            self.loci.setdefault(name[:3], {'V': [], 'J': []})['V'].append(name)
+        for name in genes['J']:
+            if name[:3] in self.loci and name in self.j_cdr3_ends:
+                self.loci[name[:3]]['J'].append(name)
+        for locus in list(self.loci):
+            if not self.loci[locus]['J']:
+                del self.loci[locus]
+
+    @classmethod
+    def load(cls, igdata, species='human', receptor='Ig'):
+        """Reads the germline FASTA files written by `pyir setup` and IgBLAST's region and auxiliary data"""
+        suffix = 'TCR' if receptor == 'TCR' else 'gl'
+        base = os.path.join(igdata, receptor, species, species + '_' + suffix + '_')
+        genes = {segment: read_fasta(base + segment + '.fasta') for segment in SEGMENTS}
+
+        v_regions = {}
+        regions_file = os.path.join(igdata, 'internal_data', species, species + '.ndm.imgt')
+        if os.path.exists(regions_file):
+            with open(regions_file, 'r') as fin:
+                for line in fin:
+                    fields = line.split()
+                    if len(fields) >= 11 and not line.startswith('#'):
+                        v_regions[fields[0]] = [int(x) for x in fields[1:11]]
+
+        j_frames = {}
+        j_cdr3_ends = {}
+        with open(os.path.join(igdata, 'aux_data', species + '_gl.aux'), 'r') as fin:
+            for line in fin:
+                fields = line.split()
+                if len(fields) >= 4 and not line.startswith('#'):
+                    j_frames[fields[0]] = int(fields[1])
+                    j_cdr3_ends[fields[0]] = int(fields[3])
+
+        for name, seq in genes['V'].items():
+            if name not in v_regions:
+                v_regions[name] = list(HEAVY_REGIONS if name[:3] in D_LOCI else LIGHT_REGIONS)
+
+        source = {'type': 'igdata', 'igdata': os.path.abspath(igdata), 'species': species, 'receptor': receptor}
+        return cls(genes, v_regions, j_frames, j_cdr3_ends, source)
+
+    @classmethod
+    def synthetic(cls, seed=0):
+        """Random germline genes shaped like human IGH and IGK genes, with the conserved cysteine at the end of FR3
+        and the tryptophan or phenylalanine that starts FR4"""
+        rng = random.Random(seed)
+        genes = {segment: collections.OrderedDict() for segment in SEGMENTS}
+        v_regions = {}
+        j_frames = {}
+        j_cdr3_ends = {}
+
+        def coding(num_codons):
+            return ''.join(rng.choice(SENSE_CODONS) for i in range(num_codons))
+
+        for locus, regions, cdr3_start, fwr4_start in [('IGH', HEAVY_REGIONS, 'GCGAGAGA', 'TGGGGCCAGGGA'),
+                                                      ('IGK', LIGHT_REGIONS, 'CAGCAGTA', 'TTCGGCCAAGGG')]:
+            for i in range(30 if locus == 'IGH' else 20):
+                name = '{0}V{1}-{2}*01'.format(locus, i % 7 + 1, i + 1)
+                # Ends with the 'YYC' of FR3 and the first bases of the CDR3
+                genes['V'][name] = coding(regions[-1] // 3 - 3) + 'TATTACTGT' + cdr3_start
+                v_regions[name] = list(regions)
+
+            for i in range(6 if locus == 'IGH' else 5):
+                name = '{0}J{1}*01'.format(locus, i + 1)
+                frame = 2 if locus == 'IGH' else 1
+                cdr3 = coding(rng.randint(2, 6))
+                genes['J'][name] = ''.join(rng.choice(NUCLEOTIDES) for j in range(frame)) + cdr3 + fwr4_start + \
+                    coding(6) + 'G'
+                j_frames[name] = frame
+                j_cdr3_ends[name] = frame + len(cdr3) - 1
+
+        for i in range(25):
+            name = 'IGHD{0}-{1}*01'.format(i % 6 + 1, i + 1)
+            genes['D'][name] = ''.join(rng.choice(NUCLEOTIDES) for j in range(rng.randint(11, 31)))
+
+        return cls(genes, v_regions, j_frames, j_cdr3_ends, {'type': 'synthetic', 'seed': seed})
+
+    @classmethod
+    def from_source(cls, source):
+        if source['type'] == 'synthetic':
+            return cls.synthetic(source['seed'])
+        return cls.load(source['igdata'], source['species'], source['receptor'])
+
+
+class Segment:
+    """A gene segment of a read, as a pairwise alignment of the read (query) with the germline gene. Gaps are '-'.
+    Starts are 0-based"""
+    def __init__(self, name, query, germline, query_start, germline_start):
+        self.name = name
+        self.query = query
+        self.germline = germline
+        self.query_start = query_start
+        self.germline_start = germline_start
+        self.query_end = query_start + len(query.replace('-', ''))
+        self.germline_end = germline_start + len(germline.replace('-', ''))
+
+
+class Rearrangement:
+    """The V(D)J recombination behind a read: its segments, N-regions and sequence"""
+    def __init__(self, read_id, locus, segments, np1, np2):
+        self.read_id = read_id
+        self.locus = locus
+        self.segments = segments
+        self.np1 = np1
+        self.np2 = np2
+
+        parts = [segments['V'].query.replace('-', ''), np1]
+        if 'D' in segments:
+            parts.extend([segments['D'].query, np2])
+        parts.append(segments['J'].query)
+        self.sequence = ''.join(parts)
+
+
+class Repertoire:
+    """Generates reads from germline genes.
+
+    Every read gets its own mutation rate, drawn uniformly between zero and twice mutation_rate, so the repertoire has
+    both naive-like and heavily mutated reads. indel_rate is the fraction of reads with an insertion or deletion in the
+    V gene, a third of which shift the reading frame. Like a real repertoire after selection, productive_fraction of
+    the reads are recombined until they are in frame and free of stop codons"""
+    def __init__(self, germlines, seed=1, mutation_rate=0.05, indel_rate=0.02, heavy_fraction=0.6,
+                 productive_fraction=0.85, max_n_length=12):
+        self.germlines = germlines
+        self.seed = seed
+        self.mutation_rate = mutation_rate
+        self.indel_rate = indel_rate
+        self.heavy_fraction = heavy_fraction
+        self.productive_fraction = productive_fraction
+        self.max_n_length = max_n_length
+        self.prefix = 'synth{0}_'.format(seed)
+
+        self.heavy_loci = [locus for locus in germlines.loci if locus in D_LOCI and germlines.genes['D']]
+        self.light_loci = [locus for locus in germlines.loci if locus not in self.heavy_loci]
+
+    def spec(self):
+        return {
+            'seed': self.seed,
+            'mutation_rate': self.mutation_rate,
+            'indel_rate': self.indel_rate,
+            'heavy_fraction': self.heavy_fraction,
+            'productive_fraction': self.productive_fraction,
+            'max_n_length': self.max_n_length,
+            'germlines': self.germlines.source
+        }
+
+    def save(self, path):
+        with open(path, 'w') as fout:
+            json.dump(self.spec(), fout, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fin:
+            spec = json.load(fin)
+
+        return cls(Germlines.from_source(spec['germlines']), spec['seed'], spec['mutation_rate'], spec['indel_rate'],
+                   spec['heavy_fraction'], spec['productive_fraction'], spec['max_n_length'])
+
+    def read_id(self, index):
+        return self.prefix + str(index)
+
+    def read_index(self, read_id):
+        """Returns the index of a read of this repertoire given its id, or None if the id isn't one of ours"""
+        if read_id.startswith(self.prefix) and read_id[len(self.prefix):].isdigit():
+            return int(read_id[len(self.prefix):])
+        return None
+
+    @staticmethod
+    def random_bases(rng, length):
+        return ''.join(rng.choice(NUCLEOTIDES) for i in range(length))
+
+    @staticmethod
+    def mutate(rng, germline, rate):
+        return ''.join(rng.choice(NUCLEOTIDES.replace(base, '')) if rng.random() < rate else base
+                       for base in germline)
+
+    def add_indel(self, rng, query, germline):
+        """Inserts or deletes bases in the middle of an aligned V gene"""
+        position = rng.randint(30, len(query) - 30)
+        length = rng.choice([3, 3, 1, 6, 2, 3])
+        if rng.random() < 0.5:
+            return (query[:position] + self.random_bases(rng, length) + query[position:],
+                    germline[:position] + '-' * length + germline[position:])
+        return query[:position] + '-' * length + query[position + length:], germline
+
+    def is_productive(self, rearrangement):
+        """Whether the V and J genes of a read are in the same frame with no stop codon between them"""
+        v = rearrangement.segments['V']
+        j = rearrangement.segments['J']
+        v_frame = (-v.germline_start) % 3
+        j_frame = j.query_start + (self.germlines.j_frames[j.name] - j.germline_start) % 3
+        return (j_frame - v_frame) % 3 == 0 and '*' not in translate(rearrangement.sequence[v_frame:])
+
+    def rearrange(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        rate = rng.uniform(0, 2 * self.mutation_rate)
+        heavy = self.heavy_loci and (rng.random() < self.heavy_fraction or not self.light_loci)
+        locus = rng.choice(self.heavy_loci if heavy else self.light_loci)
+        productive = rng.random() < self.productive_fraction
+
+        for attempt in range(100):
+            rearrangement = self.recombine(rng, index, locus, rate)
+            if not productive or self.is_productive(rearrangement):
+                break
+
+        return rearrangement
+
+    def recombine(self, rng, index, locus, rate):
+        germlines = self.germlines
+        heavy = locus in self.heavy_loci
+        segments = {}
+
+        # Reads start somewhere in FR1 and the V gene loses a few bases to the junction
+        v_name = rng.choice(germlines.loci[locus]['V'])
+        v_gene = germlines.genes['V'][v_name]
+        v_start = rng.randint(0, 20)
+        v_end = len(v_gene) - rng.randint(0, 4)
+        v_germline = v_gene[v_start:v_end]
+        v_query = self.mutate(rng, v_germline, rate)
+        if rng.random() < self.indel_rate:
+            v_query, v_germline = self.add_indel(rng, v_query, v_germline)
+        segments['V'] = Segment(v_name, v_query, v_germline, 0, v_start)
+        position = segments['V'].query_end
+
+        np1 = self.random_bases(rng, rng.randint(0, self.max_n_length if heavy else 4))
+        position += len(np1)
+        np2 = ''
+        if heavy:
+            d_name = rng.choice(list(germlines.genes['D']))
+            d_gene = germlines.genes['D'][d_name]
+            d_start = rng.randint(0, min(4, len(d_gene) // 4))
+            d_end = len(d_gene) - rng.randint(0, min(4, len(d_gene) // 4))
+            segments['D'] = Segment(d_name, self.mutate(rng, d_gene[d_start:d_end], rate / 2), d_gene[d_start:d_end],
+                                    position, d_start)
+            position = segments['D'].query_end
+            np2 = self.random_bases(rng, rng.randint(0, self.max_n_length))
+            position += len(np2)
+
+        # The J gene is trimmed at most up to the last base of the CDR3 so the FR4 stays intact
+        j_name = rng.choice(germlines.loci[locus]['J'])
+        j_gene = germlines.genes['J'][j_name]
+        j_start = rng.randint(0, min(6, germlines.j_cdr3_ends[j_name]))
+        segments['J'] = Segment(j_name, self.mutate(rng, j_gene[j_start:], rate / 2), j_gene[j_start:], position,
+                                j_start)
+
+        return Rearrangement(self.read_id(index), locus, segments, np1, np2)
+
+    def write(self, path, num_reads, fastq=False):
+        with open(path, 'w') as fout:
+            for index in range(num_reads):
+                rearrangement = self.rearrange(index)
+                if fastq:
+                    fout.write('@{0}\n{1}\n+\n{2}\n'.format(rearrangement.read_id, rearrangement.sequence,
+                                                           'I' * len(rearrangement.sequence)))
+                else:
+                    fout.write('>{0}\n{1}\n'.format(rearrangement.read_id, rearrangement.sequence))
+
+
+def spec_file(reads_file):
+    """The JSON spec saved next to a file of reads"""
+    return os.path.splitext(reads_file)[0] + '.repertoire.json'
+
+
+def default_igdata():
+    try:
+        from crowelab_pyir import arg_parse
+        return arg_parse.PyIrArgumentParser._get_igdata_dir()
+    except Exception:
+        return os.environ.get('IGDATA', '')
+
+
+def load_germlines(igdata, species='human', receptor='Ig'):
+    """Loads the germline library, falling back to synthetic germlines if `pyir setup` hasn't been run"""
+    suffix = 'TCR' if receptor == 'TCR' else 'gl'
+    if igdata and os.path.exists(os.path.join(igdata, receptor, species, species + '_' + suffix + '_V.fasta')):
+        return Germlines.load(igdata, species, receptor)
+
+    sys.stderr.write('No germline library found in {0}, using synthetic germlines. Run `pyir setup` to benchmark '
+                     'with real germline genes\n'.format(igdata))
+    return Germlines.synthetic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic repertoire for benchmarking PyIR')
+    parser.add_argument('num_reads', type=int, help='Number of reads to generate')
+    parser.add_argument('out', help='FASTA (or FASTQ with --fastq) file to write. The spec fake_igblastn.py needs is '
+                                    'written next to it')
+    parser.add_argument('--fastq', action='store_true', help='Write FASTQ instead of FASTA')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, which also prefixes the read ids')
+    parser.add_argument('--mutation_rate', type=float, default=0.05, help='Average somatic mutation rate')
+    parser.add_argument('--indel_rate', type=float, default=0.02, help='Fraction of reads with an indel in V')
+    parser.add_argument('--heavy_fraction', type=float, default=0.6, help='Fraction of heavy chain reads')
+    parser.add_argument('--productive_fraction', type=float, default=0.85, help='Fraction of productive reads')
+    parser.add_argument('--igdata', default=None, help='IGDATA directory holding the germline library')
+    parser.add_argument('--species', default='human')
+    parser.add_argument('--receptor', default='Ig', choices=['Ig', 'TCR'])
+    parser.add_argument('--synthetic', action='store_true', help='Use synthetic germline genes')
+    args = parser.parse_args()
+
+    germlines = Germlines.synthetic() if args.synthetic else \
+        load_germlines(args.igdata or default_igdata(), args.species, args.receptor)
+    repertoire = Repertoire(germlines, args.seed, args.mutation_rate, args.indel_rate, args.heavy_fraction,
+                            args.productive_fraction)
+    repertoire.write(args.out, args.num_reads, args.fastq)
+    repertoire.save(spec_file(args.out))
+    print('Wrote {0:,} reads to {1}'.format(args.num_reads, args.out))
+    print('export FAKE_IGBLAST_REPERTOIRE={0}'.format(os.path.abspath(spec_file(args.out))))
+
+
+if __name__ == '__main__':
+    main()
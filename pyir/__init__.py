@@ -1 +1,3 @@
-from .factory import PyIR
\ No newline at end of file
+from .factory import PyIR
+from .index import IndexedOutput
+from .reader import read_results
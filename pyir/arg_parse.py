@@ -1,11 +1,62 @@
 #!/usr/bin/env python
 import argparse
-import multiprocessing
+import json
 import sys
 import os
-import pkg_resources
 import subprocess
 import tempfile
+import threading
+
+from . import columnar, filters, tune
+
+_data_dir = None
+
+
+def data_path(*parts):
+    """Path to a file or folder in PyIR's data directory"""
+    global _data_dir
+    if _data_dir is None:
+        try:
+            from importlib.resources import files
+            _data_dir = str(files(__package__) / 'data')
+        except ImportError:
+            _data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    return os.path.join(_data_dir, *parts)
+
+
+def state_file():
+    """Per-user file remembering which IgBLAST executables have already been checked"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'pyir', 'state.json')
+
+
+def load_state():
+    try:
+        with open(state_file(), 'r') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    """Saves the state file, ignoring failures such as a read-only home directory"""
+    try:
+        os.makedirs(os.path.dirname(state_file()), exist_ok=True)
+        tmp_file = '{0}.{1}.{2}'.format(state_file(), os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as fout:
+            json.dump(state, fout)
+        os.replace(tmp_file, state_file())
+    except OSError:
+        pass
+
+
+def executable_key(path):
+    """Identifies a version of an executable by its modification time and size"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
 
 
 class PyIrArgumentParser():
@@ -30,7 +81,8 @@ class PyIrArgumentParser():
         necessary_arguments.add_argument(
             'query',
             metavar="query.fasta",
-            help='The fasta or fastq file to be run through the protocol'
+            help='The fasta or fastq file to be run through the protocol, \'setup\' to build the germline databases or '
+                 '\'tune\' to find the fastest settings for this machine'
         )
 
         general_args = self.arg_parse.add_argument_group(
@@ -58,10 +110,10 @@ class PyIrArgumentParser():
             "-m",
             "--multi",
             dest='multi',
-            default=multiprocessing.cpu_count(),
+            default=None,
             type=int,
-            help="Number of threads to process with. Default is as many cores are available (" + str(
-                multiprocessing.cpu_count()) + ")"
+            help="Number of threads to process with. Default is the value found by `pyir tune`, or as many cores are "
+                 "available (" + str(os.cpu_count()) + ")"
         )
 
         general_args.add_argument(
@@ -75,12 +127,15 @@ class PyIrArgumentParser():
         general_args.add_argument(
             '--outfmt',
             dest='outfmt',
-            choices={'lsjson', 'json', 'tsv', 'dict'},
+            choices={'lsjson', 'json', 'tsv', 'dict', 'parquet', 'arrow', 'sqlite'},
             default='lsjson',
             help='Output format. Default is a line-separated JSON file, where each line contains an individual JSON '
                  'object. \'json\' format outputs a file in true JSON format, where the top-level object is an array '
                  'that contains each sequence with analysis as a JSON object. \'dict\' format only available in API '
-                 'mode and uses significantly more memory'
+                 'mode and uses significantly more memory. \'parquet\' and \'arrow\' (Arrow IPC, also known as '
+                 'Feather) write typed columns for dataframe libraries; they need pyarrow, AIRR output and are not '
+                 'gzipped. \'sqlite\' writes an indexed SQLite database with a typed \'sequences\' table; it needs '
+                 'AIRR output and is not gzipped'
         )
 
         general_args.add_argument(
@@ -106,6 +161,104 @@ class PyIrArgumentParser():
             help="Pretty json output"
         )
 
+        general_args.add_argument(
+            '--fields',
+            dest='fields',
+            type=self._field_list_parse,
+            default=None,
+            help="Comma separated AIRR fields to output, in this order, e.g. 'sequence_id,v_call,j_call,cdr3_aa'. "
+                 "Only these fields are built and written in every output format, which makes output smaller and "
+                 "faster. sequence_id is always included. Default is every field"
+        )
+
+        general_args.add_argument(
+            "--fast_json",
+            action='store_true',
+            default=False,
+            help="Write compact JSON, without spaces after separators and with non-ASCII characters unescaped, using "
+                 "orjson when it is installed. Several times faster to encode than the default output. Has no effect "
+                 "with --pretty"
+        )
+
+        general_args.add_argument(
+            "--compact_dict",
+            action='store_true',
+            default=False,
+            help="With the dict output format, return each record as a compact read-only mapping instead of a dict. "
+                 "Fields are read the same way, e.g. record['v_call'], and the records take about a tenth of the "
+                 "memory"
+        )
+
+        general_args.add_argument(
+            "--shared_memory",
+            action='store_true',
+            default=False,
+            help="With the dict output format, workers pass their records to the main process through shared memory "
+                 "instead of pickling them through a pipe, and records are returned as read-only mappings that read "
+                 "their fields from it, as with --compact_dict but uncompressed unless it is given too. Keeps the main "
+                 "process from becoming the bottleneck with many processes. Needs Python 3.8 or later"
+        )
+
+        general_args.add_argument(
+            "--ordered",
+            action='store_true',
+            default=False,
+            help="Write the records in the order of the input sequences. By default the chunks are written in the order "
+                 "they finish. lsjson, json and tsv output is written as the chunks finish, each once the ones before "
+                 "it are. Up to 4 chunks per process are run ahead of a slow chunk, whose results wait until it "
+                 "finishes"
+        )
+
+        general_args.add_argument(
+            '--sort_by',
+            dest='sort_by',
+            type=self._sort_field_parse,
+            default=None,
+            help="Comma separated AIRR fields to sort the output by, e.g. 'v_call,cdr3_aa'. Workers sort their chunks "
+                 "and the chunks are merged into the output file, so any number of records can be sorted. Values are "
+                 "compared as their column types, with empty values first. Available with the lsjson, json, tsv, "
+                 "parquet and arrow output formats"
+        )
+
+        general_args.add_argument(
+            '--sort_memory',
+            dest='sort_memory',
+            type=int,
+            default=256,
+            help="With --sort_by, how many MB of the sorted chunks the merge reads at once. More chunks than fit are "
+                 "merged in several passes. Default is 256"
+        )
+
+        general_args.add_argument(
+            '--partition_by',
+            dest='partition_by',
+            default=None,
+            help="AIRR field to split the output by, e.g. 'locus' or 'v_family', or the field of --additional_field. "
+                 "Records are written to one output file per value of the field, named after it, e.g. "
+                 "example.IGH.json, and the dict output format returns a dict of records per value. Workers write "
+                 "their records into the partitions, so the output is split in the same pass"
+        )
+
+        general_args.add_argument(
+            "--index",
+            action='store_true',
+            default=False,
+            help="With the lsjson and tsv output formats, also write <output>.idx, an index of where each record starts "
+                 "by sequence_id, for reading records by id with crowelab_pyir.IndexedOutput. Gzipped output is then "
+                 "compressed in small independent blocks, which gzip still reads as one file, so that a record is read "
+                 "by decompressing only its block"
+        )
+
+        general_args.add_argument(
+            '--batch_size',
+            dest='batch_size',
+            type=int,
+            default=8192,
+            help="With parquet or arrow output, IgBLAST's output is processed this many rows at a time: the PyIR "
+                 "fields and filters are computed over whole columns instead of record by record, which is several "
+                 "times faster. 0 processes every record on its own. Default is 8192"
+        )
+
         general_args.add_argument(
             "--silent",
             action='store_true',
@@ -120,7 +273,8 @@ class PyIrArgumentParser():
             type=int,
             help="How many sequences per chunk. This affects the number of chunks the input file is divided into as "
                  "well as how often progress gets updated. Ideal size varies from system to system and number of "
-                 "sequences being processed. Default chunk size determined by file size at runtime. Advanced users "
+                 "sequences being processed. Default is the value found by `pyir tune`, or a chunk size determined by "
+                 "file size at runtime. Advanced users "
                  "editing this flag with large input files should be wary of running into OS file pointer limits and "
                  "similar errors.",
         )
@@ -143,6 +297,117 @@ class PyIrArgumentParser():
             action='store_true'
         )
 
+        general_args.add_argument(
+            '--checkpoint',
+            dest='checkpoint',
+            default=False,
+            action='store_true',
+            help='Record each completed chunk in a manifest inside a working directory under --tmp_dir that is kept if '
+                 'the run fails, so that the run can be continued later with --resume'
+        )
+
+        general_args.add_argument(
+            '--resume',
+            dest='resume',
+            default=False,
+            action='store_true',
+            help='Continue a failed --checkpoint run with the same input and arguments, skipping the chunks that were '
+                 'already completed. Implies --checkpoint'
+        )
+
+        general_args.add_argument(
+            '--retries',
+            dest='retries',
+            default=1,
+            type=int,
+            help='How many times to retry a chunk that IgBLAST fails on before bisecting it to find the sequences '
+                 'causing the failure. Those sequences are written to <output>.rejects.fasta. Default is 1'
+        )
+
+        general_args.add_argument(
+            '--max_rejects',
+            dest='max_rejects',
+            default=20,
+            type=int,
+            help='Maximum number of sequences to reject in a single chunk before treating the IgBLAST failure as '
+                 'fatal. Default is 20'
+        )
+
+        general_args.add_argument(
+            '--report',
+            dest='report',
+            metavar='report.json',
+            default=None,
+            help='Write a JSON report with the wall and CPU time of each stage of the run (splitting, IgBLAST, '
+                 'parsing, filtering, serialization, concatenation and gzip), per-chunk IgBLAST timings, filter '
+                 'pass/fail counts and peak memory use to this file'
+        )
+
+        general_args.add_argument(
+            '--trace',
+            dest='trace',
+            metavar='trace.json',
+            default=None,
+            help='Write a Chrome/Perfetto trace-event file with a timeline of the splitting, queueing, IgBLAST and '
+                 'parsing of each chunk on each worker. Open it in chrome://tracing or ui.perfetto.dev'
+        )
+
+        general_args.add_argument(
+            '--metrics_file',
+            dest='metrics_file',
+            default=None,
+            help='Keep a file with live progress counts, throughput and ETA in the Prometheus text format, rewritten '
+                 'every --progress_interval seconds'
+        )
+
+        general_args.add_argument(
+            '--progress_interval',
+            dest='progress_interval',
+            default=1.0,
+            type=float,
+            help='Seconds between progress updates of the progress bar, --metrics_file and the API progress '
+                 'callback. Default is 1'
+        )
+
+        tune_args = self.arg_parse.add_argument_group(
+            title="Tuning Arguments",
+            description="Arguments for `pyir tune`, which times short runs on a sample of an input file to find the "
+                        "fastest --multi, --igblast_threads and --chunk_size for this machine and saves them to a "
+                        "per-host config file"
+        )
+
+        tune_args.add_argument(
+            '--tune_input',
+            dest='tune_input',
+            default=None,
+            help='Fasta or fastq file to take the tuning sample from. Required with `pyir tune`'
+        )
+
+        tune_args.add_argument(
+            '--tune_reads',
+            dest='tune_reads',
+            default=None,
+            type=int,
+            help='Number of reads from the start of --tune_input to time each trial on. Default is ' +
+                 str(tune.READS_PER_CORE) + ' per core'
+        )
+
+        tune_args.add_argument(
+            '--config',
+            dest='config',
+            default=tune.default_config_file(),
+            help='Config file that `pyir tune` writes and later runs read their default --multi, --igblast_threads '
+                 'and --chunk_size from. Default is ' + tune.default_config_file()
+        )
+
+        tune_args.add_argument(
+            '--no_config',
+            dest='no_config',
+            default=False,
+            action='store_true',
+            help='Ignore the settings in the config file'
+        )
+
         path_arguments = self.arg_parse.add_argument_group(
             title="Arguments related to file paths"
         )
@@ -325,6 +590,63 @@ class PyIrArgumentParser():
             help="The IgBLAST penalty value to use"
         )
 
+        blast_arguments.add_argument(
+            '--igblast_threads',
+            dest='igblast_threads',
+            type=int,
+            default=None,
+            help="Number of threads each IgBLAST process uses (-num_threads). Default is the value found by "
+                 "`pyir tune`, or 1"
+        )
+
+        two_pass_args = self.arg_parse.add_argument_group(
+            title="Two-Pass Arguments",
+            description="Arguments to run a fast first IgBLAST pass and rerun only ambiguous reads with the full "
+                        "IgBLAST settings above"
+        )
+
+        two_pass_args.add_argument(
+            '--two_pass',
+            action='store_true',
+            default=False,
+            help="Turns on two-pass annotation. AIRR output only"
+        )
+
+        two_pass_args.add_argument(
+            '--fast_word_size',
+            type=str,
+            default="15",
+            help="The IgBLAST word size to use for the first pass. Default is 15"
+        )
+
+        two_pass_args.add_argument(
+            '--rerun_v_evalue',
+            type=float,
+            default=1e-20,
+            help='Reads whose first pass V gene e-value (v_support) is above this value are rerun. Default is 1e-20'
+        )
+
+        two_pass_args.add_argument(
+            '--rerun_j_evalue',
+            type=float,
+            default=1e-5,
+            help='Reads whose first pass J gene e-value (j_support) is above this value are rerun. Default is 1e-5'
+        )
+
+        two_pass_args.add_argument(
+            '--rerun_unproductive',
+            type=self._check_bool,
+            default=True,
+            help='Whether to rerun reads that the first pass called unproductive'
+        )
+
+        two_pass_args.add_argument(
+            '--rerun_missing_cdr3',
+            type=self._check_bool,
+            default=True,
+            help='Whether to rerun reads that have no CDR3 after the first pass'
+        )
+
         filter_args = self.arg_parse.add_argument_group(
             title="Filtering Specific Arguments",
             description="Arguments to enable and control filtering on BLAST results"
@@ -390,22 +712,34 @@ class PyIrArgumentParser():
         filter_args.add_argument(
             '--filter_cdr3_length',
             type=str,
-            help='A minimum and maximum length for the CDR3 AA region, separated by a comma. Default: 3,50',
-            default="3,50"
+            help='A minimum and maximum length for the CDR3 AA region, separated by a comma, e.g. 3,50. The maximum '
+                 'is exclusive. Default is no CDR3 length filter',
+            default=None
         )
 
         filter_args.add_argument(
             '--filter_cdr3_quality',
             type=float,
-            help='Minimum Phred score allowed in CDR3 region (fastq files in legacy mode only)',
-            default=30
+            help='Minimum Phred score allowed in CDR3 region (fastq files in legacy mode only), e.g. 30. Default is '
+                 'no quality filter',
+            default=None
         )
 
         filter_args.add_argument(
             '--filter_fr3_c_codon',
             type=self._check_bool,
             help='Whether to filter out sequences that are missing a \'C\' codon in the last 3 proteins of the AA string',
-            default=True
+            default=False
+        )
+
+        filter_args.add_argument(
+            '--filter_expression',
+            type=str,
+            help="Only keep records for which this expression holds, e.g. \"v_identity >= 90 and 8 <= cdr3_aa_length "
+                 "<= 20\". Fields are compared with numbers, strings, True/False or lists and combined with and, or, "
+                 "not and parentheses. Numeric fields are compared as numbers, flags such as productive as "
+                 "True/False. Applied with or without --enable_filter. AIRR output only",
+            default=None
         )
 
     def parse_arguments(self, overrides=None):
@@ -414,7 +748,9 @@ class PyIrArgumentParser():
         Main function for parsing arguments"""
         arguments = self.arg_parse.parse_args(overrides)
 
-        os.environ['IGDATA'] = arguments.igdata
+        # IGDATA is only passed to IgBLAST through its environment, so that PyIR objects with different settings can
+        # run side by side in one process
+        arguments.igdata = os.path.abspath(arguments.igdata)
         self._set_germline_databases(arguments)
 
         #Default case
@@ -422,10 +758,20 @@ class PyIrArgumentParser():
             arguments.executable = self.get_igblast(arguments.sequence_type)
         self._validate_executable(arguments.executable)
 
+        self._apply_config(arguments)
+
+        # `pyir tune` reads its sample from --tune_input
+        query = arguments.query
+        if query == 'tune':
+            if not arguments.tune_input or not os.path.exists(arguments.tune_input):
+                raise argparse.ArgumentTypeError("pyir tune needs an input file to sample from. Set --tune_input to a "
+                                                 "fasta or fastq file")
+            query = arguments.tune_input
+
         if not arguments.input_type:
-            if '.fastq' in arguments.query:
+            if '.fastq' in query:
                 arguments.input_type = 'fastq'
-            elif '.fasta' in arguments.query or arguments.query.endswith('.fa'):
+            elif '.fasta' in query or query.endswith('.fa'):
                 arguments.input_type = 'fasta'
             else:
                 if not arguments.silent:
@@ -439,9 +785,98 @@ class PyIrArgumentParser():
             raise argparse.ArgumentTypeError("Sequence type set to protein but species is not human. Set -s "
                                              "flag to human")
 
+        if (arguments.checkpoint or arguments.resume) and arguments.outfmt == 'dict':
+            raise argparse.ArgumentTypeError("Checkpointing is not available with the 'dict' output format")
+
+        if arguments.outfmt in columnar.FORMATS:
+            if arguments.legacy:
+                raise argparse.ArgumentTypeError("Parquet and Arrow output are only available with AIRR output. "
+                                                 "Remove the --legacy flag")
+            if not columnar.available():
+                raise argparse.ArgumentTypeError("Parquet and Arrow output need pyarrow. Install it with "
+                                                 "pip3 install pyarrow")
+
+        if arguments.compact_dict and (arguments.outfmt != 'dict' or arguments.legacy):
+            raise argparse.ArgumentTypeError("--compact_dict is only available with AIRR output in the 'dict' output "
+                                             "format")
+
+        if arguments.shared_memory:
+            if arguments.outfmt != 'dict' or arguments.legacy:
+                raise argparse.ArgumentTypeError("--shared_memory is only available with AIRR output in the 'dict' "
+                                                 "output format")
+            if sys.version_info < (3, 8):
+                raise argparse.ArgumentTypeError("--shared_memory needs Python 3.8 or later")
+
+        if arguments.batch_size < 0:
+            raise argparse.ArgumentTypeError("--batch_size can't be negative")
+
+        if arguments.outfmt == 'sqlite' and arguments.legacy:
+            raise argparse.ArgumentTypeError("SQLite output is only available with AIRR output. Remove the --legacy "
+                                             "flag")
+
+        if arguments.fields and arguments.legacy:
+            raise argparse.ArgumentTypeError("--fields is only available with AIRR output. Remove the --legacy flag")
+
+        if arguments.sort_by:
+            if arguments.legacy or arguments.outfmt not in ['lsjson', 'json', 'tsv', 'parquet', 'arrow']:
+                raise argparse.ArgumentTypeError("--sort_by is only available with AIRR output in the lsjson, json, "
+                                                 "tsv, parquet and arrow output formats")
+            missing = [field for field in arguments.sort_by if arguments.fields and field not in arguments.fields]
+            if missing:
+                raise argparse.ArgumentTypeError("--sort_by fields {0} are not in --fields".format(','.join(missing)))
+            if arguments.sort_memory < 1:
+                raise argparse.ArgumentTypeError("--sort_memory must be at least 1 MB")
+
+        if arguments.partition_by:
+            if arguments.legacy:
+                raise argparse.ArgumentTypeError("--partition_by is only available with AIRR output. Remove the "
+                                                 "--legacy flag")
+            if arguments.checkpoint or arguments.resume:
+                raise argparse.ArgumentTypeError("--partition_by can't be used with --checkpoint or --resume")
+            if columnar.field_type(arguments.partition_by) == 'float':
+                raise argparse.ArgumentTypeError("--partition_by needs a field with a small set of values, such as "
+                                                 "locus or v_family, not a number such as {0}".format(
+                                                     arguments.partition_by))
+            if arguments.fields and arguments.partition_by not in arguments.fields:
+                raise argparse.ArgumentTypeError("--partition_by field {0} is not in --fields".format(
+                    arguments.partition_by))
+
+        if arguments.index and (arguments.legacy or arguments.pretty or arguments.outfmt not in ['lsjson', 'tsv']):
+            raise argparse.ArgumentTypeError("--index is only available with AIRR output in the lsjson and tsv output "
+                                             "formats, without --pretty")
+
+        if arguments.filter_expression:
+            if arguments.legacy:
+                raise argparse.ArgumentTypeError("--filter_expression is only available with AIRR output. Remove the "
+                                                 "--legacy flag")
+            try:
+                filters.parse_expression(arguments.filter_expression)
+            except ValueError as e:
+                raise argparse.ArgumentTypeError(str(e))
+
+        if arguments.two_pass and arguments.legacy:
+            raise argparse.ArgumentTypeError("Two-pass annotation is only available with AIRR output. Remove the "
+                                             "--legacy flag to use --two_pass")
+
 
         return arguments.__dict__
 
+    @staticmethod
+    def _apply_config(arguments):
+        """Fills in --multi, --igblast_threads and --chunk_size from the `pyir tune` config file where they weren't
+        given, then falls back to the built-in defaults. chunk_size left as None is picked from the input size"""
+        config = {}
+        if arguments.query != 'tune' and not arguments.no_config:
+            config = tune.load_config(arguments.config)
+        arguments.tuned = [key for key in tune.TUNED_ARGS if getattr(arguments, key) is None and key in config]
+        for key in arguments.tuned:
+            setattr(arguments, key, config[key])
+
+        if arguments.multi is None:
+            arguments.multi = os.cpu_count()
+        if arguments.igblast_threads is None:
+            arguments.igblast_threads = 1
+
     @staticmethod
     def _check_d_match_validity(amount):
         """Checks that the D gene nucleotide matches argument is valid"""
@@ -454,7 +889,6 @@ class PyIrArgumentParser():
     def _validate_path(path):
         """Checks that the given IGDATA path exists"""
         if os.path.exists(os.path.abspath(path)):
-            os.environ['IGDATA'] = os.path.abspath(path)
             return os.path.abspath(path)
         raise argparse.ArgumentTypeError("{0} does not exist. Did you use setup.py correctly? "
                                          "Or do you have another location?".format(path))
@@ -476,10 +910,26 @@ class PyIrArgumentParser():
         except:
             raise argparse.ArgumentTypeError("comma separated error with {0}".format(keyvaluestring))
 
+    @staticmethod
+    def _field_list_parse(fields):
+        """Splits a comma separated list of fields, always starting it with sequence_id"""
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        if not fields:
+            raise argparse.ArgumentTypeError("No fields given to --fields")
+        return ['sequence_id'] + [field for field in fields if field != 'sequence_id']
+
+    @staticmethod
+    def _sort_field_parse(fields):
+        """Splits a comma separated list of fields to sort by"""
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        if not fields:
+            raise argparse.ArgumentTypeError("No fields given to --sort_by")
+        return fields
+
     @staticmethod
     def _get_igdata_dir():
-        if os.path.exists(pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab_pyir"), "crowelab_pyir/data/germlines")):
-            return pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab-pyir"), "crowelab_pyir/data/germlines")
+        if os.path.exists(data_path('germlines')):
+            return data_path('germlines')
         elif 'IGDATA' in os.environ:
             return os.environ['IGDATA']
         else:
@@ -487,17 +937,26 @@ class PyIrArgumentParser():
 
     @staticmethod
     def test_igblast(path):
+        """Checks that IgBLAST runs. Executables that passed are remembered in the state file until they change"""
+        state = load_state()
+        key = executable_key(path)
+        if key and state.get('igblast', {}).get(path) == key:
+            return path
+
         try:
             subprocess.check_call([path, '-h'],stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return path
         except:
             print('Error with igblast:')
             subprocess.call([path, '-h'])
             sys.exit()
 
+        state.setdefault('igblast', {})[path] = key
+        save_state(state)
+        return path
+
     def get_igblast(self, sequence_type):
         """Checks that the given IGBlast executable exists"""
-        igblast_dir = pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab-pyir"), "crowelab_pyir/data/bin")
+        igblast_dir = data_path('bin')
         if 'linux' in sys.platform:
             if sequence_type == 'nucl':
                 return self.test_igblast(os.path.join(igblast_dir,'igblastn_linux'))
@@ -519,14 +978,10 @@ class PyIrArgumentParser():
     @staticmethod
     def _get_aux_dir():
         """Checks that the given PyIR aux_data directory exists"""
-        if not os.path.exists(
-                pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab-pyir"),
-                                                "crowelab_pyir/data/germlines/aux_data")):
-            raise ValueError("No aux directory found:", pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab-pyir"),
-                                                "crowelab_pyir/data/germlines/aux_data"))
+        if not os.path.exists(data_path('germlines', 'aux_data')):
+            raise ValueError("No aux directory found:", data_path('germlines', 'aux_data'))
         else:
-            return pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab-pyir"),
-                                                   "crowelab_pyir/data/germlines/aux_data")
+            return data_path('germlines', 'aux_data')
 
     @staticmethod
     def _check_bool(val):
@@ -0,0 +1,319 @@
+"""Vectorized processing of IgBLAST's AIRR output for Parquet and Arrow output.
+
+AirrParser hands BatchProcessor --batch_size lines of IgBLAST's output at a time. pyarrow's CSV reader splits
+them into Arrow columns, the PyIR fields are computed and the filters evaluated over the whole batch with
+pyarrow.compute, and the records that pass are appended to the chunk's output as one table, without a dict being
+built for any record. The results are the same as those of the per-record path: only the FWR4 recovery and the amino acid check still run in
+Python, on the rows that need them."""
+import ast
+import functools
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+from . import columnar, filters, progress
+from .parsers import FWR4_FIELDS, FWR4_INPUTS
+
+# Values of a flag column, as ColumnBuffer converts them
+TRUE_VALUES = pa.array([value for value, flag in columnar.BOOL_VALUES.items() if flag])
+FALSE_VALUES = pa.array([value for value, flag in columnar.BOOL_VALUES.items() if not flag])
+ARROW_TYPES = {'int': pa.int64(), 'float': pa.float64()}
+# The PyIR fields that are integers in a built record, so they can't be compared with a string
+INT_FIELDS = {'cdr3_aa_length', 'fwr4_start', 'fwr4_end'}
+
+COMPARISONS = {ast.Eq: pc.equal, ast.NotEq: pc.not_equal, ast.Lt: pc.less, ast.LtE: pc.less_equal,
+               ast.Gt: pc.greater, ast.GtE: pc.greater_equal}
+PYTHON_COMPARISONS = {ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b, ast.Lt: lambda a, b: a < b,
+                      ast.LtE: lambda a, b: a <= b, ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b}
+
+
+class Columns:
+    """The columns of one batch of lines of IgBLAST's output, read as strings, numbers or flags the way the
+    per-record path reads them. constants are fields with the same value in every row"""
+    def __init__(self, lines, header, constants):
+        self.header = header
+        self.constants = constants
+        self.table = csv.read_csv(io.BytesIO(''.join(lines).encode('utf-8')),
+                                  read_options=csv.ReadOptions(column_names=header),
+                                  parse_options=csv.ParseOptions(delimiter='\t', quote_char=False),
+                                  convert_options=csv.ConvertOptions(column_types={key: pa.string() for key in header}))
+        self.num_rows = self.table.num_rows
+        self.arrays = {}
+        self.values = {}
+
+    def raw(self, name):
+        """The values of an IgBLAST column as a list of strings"""
+        if name not in self.values:
+            self.values[name] = self.string(name).to_pylist()
+        return self.values[name]
+
+    def patch(self, name, index, value):
+        self.raw(name)[index] = str(value)
+        self.arrays.pop(name, None)
+
+    def has(self, name):
+        return name in self.constants or name in self.header or name in filters.DERIVED_FIELDS
+
+    def string(self, name):
+        if name not in self.arrays:
+            if name in self.constants:
+                self.arrays[name] = pa.array([self.constants[name]] * self.num_rows, type=pa.string())
+            elif name in self.values:
+                self.arrays[name] = pa.array(self.values[name], type=pa.string())
+            elif name in self.header:
+                self.arrays[name] = self.table.column(name).combine_chunks()
+            elif name == 'cdr3_aa_length':
+                self.arrays[name] = pc.cast(pc.utf8_length(self.string('cdr3_aa')), pa.string())
+            else:
+                source, template = filters.DERIVED_FIELDS[name]
+                self.arrays[name] = pc.replace_substring_regex(self.string(source), pattern='[,*].*',
+                                                               replacement='', max_replacements=1)
+        return self.arrays[name]
+
+    def number(self, name):
+        """A numeric column as floats, NaN where it is empty"""
+        strings = self.string(name)
+        return pc.cast(pc.if_else(pc.equal(strings, ''), 'nan', strings), pa.float64())
+
+    def flag(self, name):
+        return pc.equal(self.string(name), 'T')
+
+    def full(self, value):
+        return pa.array([bool(value)] * self.num_rows, type=pa.bool_())
+
+
+def output_column(key, strings):
+    """A column of the output, converted from strings the way ColumnBuffer converts the values of a record"""
+    field_type = columnar.field_type(key)
+    if field_type == 'string':
+        return strings
+    elif field_type == 'bool':
+        return pc.if_else(pc.is_in(strings, value_set=TRUE_VALUES), True,
+                          pc.if_else(pc.is_in(strings, value_set=FALSE_VALUES), False, pa.scalar(None, pa.bool_())))
+    return pc.cast(pc.if_else(pc.equal(strings, ''), pa.scalar(None, pa.string()), strings), ARROW_TYPES[field_type])
+
+
+def category(value):
+    """The kind of value a constant of an expression is compared as"""
+    if isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, (int, float)):
+        return 'number'
+    elif isinstance(value, str):
+        return 'string'
+    raise NotImplementedError(repr(value))
+
+
+def translate(node, raw=False):
+    """Translates a node of a parsed --filter_expression, following filters.render_expression, into (kind, value).
+    kind is 'mask', 'bool', 'number' or 'string' for a function of Columns returning an array, 'constant' for a
+    Python value and 'list' for a list of them. Raises NotImplementedError for what only the per-record path
+    evaluates the same way, such as comparisons of a string with a number"""
+    if isinstance(node, ast.BoolOp):
+        masks = [truth(value) for value in node.values]
+        combine = pc.and_ if isinstance(node.op, ast.And) else pc.or_
+        return 'mask', lambda columns: functools.reduce(combine, [mask(columns) for mask in masks])
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        mask = truth(node.operand)
+        return 'mask', lambda columns: pc.invert(mask(columns))
+    elif isinstance(node, ast.UnaryOp):
+        kind, value = translate(node.operand, raw)
+        if kind == 'constant' and category(value) == 'number':
+            return 'constant', -value
+        elif kind == 'number':
+            return 'number', lambda columns: pc.negate(value(columns))
+        raise NotImplementedError('-')
+    elif isinstance(node, ast.Compare):
+        nodes = [node.left] + node.comparators
+        raw = any(filters.is_string(operand) for operand in nodes)
+        operands = [translate(operand, raw) for operand in nodes]
+        masks = [compare(left, operator, right) for left, operator, right in
+                 zip(operands, node.ops, operands[1:])]
+        # Empty fields fail != and not in as well
+        for left, operator, right in zip(nodes, node.ops, nodes[1:]):
+            if isinstance(operator, (ast.NotEq, ast.NotIn)):
+                for field, other in [(left, right), (right, left)]:
+                    if isinstance(field, ast.Name) and not (isinstance(other, ast.Constant) and other.value == ''):
+                        masks.append(lambda columns, name=field.id: pc.not_equal(columns.string(name), ''))
+        return 'mask', lambda columns: functools.reduce(pc.and_, [mask(columns) for mask in masks])
+    elif isinstance(node, ast.Name):
+        name = node.id
+        field_type = columnar.field_type(name)
+        if raw and name in INT_FIELDS:
+            raise NotImplementedError(name)
+        elif raw or field_type == 'string':
+            return 'string', lambda columns: columns.string(name)
+        elif field_type == 'bool':
+            return 'bool', lambda columns: columns.flag(name)
+        return 'number', lambda columns: columns.number(name)
+    elif isinstance(node, (ast.Tuple, ast.List)):
+        elements = [translate(element, raw) for element in node.elts]
+        if any(kind != 'constant' for kind, value in elements):
+            raise NotImplementedError('list')
+        return 'list', [value for kind, value in elements]
+    return 'constant', node.value
+
+
+def truth(node):
+    """A function of Columns returning where a node of the expression is true"""
+    kind, value = translate(node)
+    if kind in ('mask', 'bool'):
+        return value
+    elif kind == 'string':
+        return lambda columns: pc.not_equal(value(columns), '')
+    elif kind == 'number':
+        # NaN is true, as it is in Python
+        return lambda columns: pc.not_equal(value(columns), 0)
+    return lambda columns: columns.full(value)
+
+
+def compare(left, operator, right):
+    """A function of Columns returning the result of one comparison between two translated operands"""
+    (left_kind, left_value), (right_kind, right_value) = left, right
+
+    def kind_of(kind, value):
+        return category(value) if kind == 'constant' else kind
+
+    def operand(kind, value, columns):
+        return value if kind == 'constant' else value(columns)
+
+    if type(operator) in (ast.In, ast.NotIn):
+        negate = isinstance(operator, ast.NotIn)
+        if right_kind == 'list':
+            left_type = kind_of(left_kind, left_value)
+            if left_type == 'mask' or any(category(element) != left_type for element in right_value):
+                raise NotImplementedError('in')
+            if left_kind == 'constant':
+                return lambda columns: columns.full((left_value in right_value) != negate)
+            value_set = pa.array(right_value, type={'bool': pa.bool_(), 'number': pa.float64(),
+                                                    'string': pa.string()}[left_type])
+            mask = lambda columns: pc.is_in(left_value(columns), value_set=value_set)
+        elif right_kind == 'string' and left_kind == 'constant' and category(left_value) == 'string':
+            mask = lambda columns: pc.match_substring(right_value(columns), left_value)
+        else:
+            raise NotImplementedError('in')
+        return (lambda columns: pc.invert(mask(columns))) if negate else mask
+
+    left_type, right_type = kind_of(left_kind, left_value), kind_of(right_kind, right_value)
+    if left_type != right_type or left_type in ('mask', 'list') or \
+            (left_type == 'bool' and type(operator) not in (ast.Eq, ast.NotEq)):
+        raise NotImplementedError('comparison')
+    if left_kind == 'constant' and right_kind == 'constant':
+        result = PYTHON_COMPARISONS[type(operator)](left_value, right_value)
+        return lambda columns: columns.full(result)
+
+    function = COMPARISONS[type(operator)]
+    return lambda columns: function(operand(left_kind, left_value, columns), operand(right_kind, right_value, columns))
+
+
+class BatchProcessor:
+    """Filters and writes the records of an AirrParser a batch of IgBLAST rows at a time. Raises
+    NotImplementedError when the filters can't be evaluated over columns, so the parser keeps the per-record path"""
+    def __init__(self, parser, size):
+        self.parser = parser
+        self.size = size
+        self.filters = parser.filters
+        self.constants = {}
+        if 'additional_field' in parser.args and parser.args['additional_field']:
+            self.constants[parser.args['additional_field'][0]] = parser.args['additional_field'][1]
+        self.conditions = self.compile_conditions()
+
+        if parser.stats:
+            self.filter = parser.stats.timed('prefilter', self.filter)
+            self.write = parser.stats.timed('write', self.write)
+
+    def compile_conditions(self):
+        """The (name, condition) of each check, in the order they run, where condition(columns, remaining) returns
+        where the check passes. remaining is where the checks before it passed"""
+        fil = self.filters
+        masks = {
+            '_e_seq_dict_filter': lambda c: pc.and_(pc.less_equal(c.number('v_support'), fil.min_v_evalue),
+                                                    pc.less_equal(c.number('j_support'), fil.min_j_evalue)),
+            '_productive_filter': lambda c: pc.is_in(c.string('productive'), value_set=pa.array(['Yes', 'T'])),
+            '_stop_codon_filter': lambda c: pc.is_in(c.string('stop_codon'), value_set=pa.array(['No', 'F'])),
+            '_vj_frame_filter': lambda c: pc.is_in(c.string('vj_in_frame'), value_set=pa.array(['In-frame', 'T'])),
+            '_nt_filter': lambda c: pc.invert(pc.match_substring(
+                pc.utf8_slice_codeunits(c.string('sequence_alignment'), 2, -3), 'N')),
+            '_cdr3_filter': lambda c: pc.and_(pc.less_equal(fil.min_cdr3_length, pc.utf8_length(c.string('cdr3_aa'))),
+                                              pc.less(pc.utf8_length(c.string('cdr3_aa')), fil.max_cdr3_length)),
+            '_fr3_filter': lambda c: pc.match_substring(pc.utf8_slice_codeunits(c.string('fwr3_aa'), -3), 'C')
+        }
+
+        # With --debug the filters run per record, so that they print why a record failed
+        if fil.debug and fil.active:
+            raise NotImplementedError('--debug')
+
+        conditions = []
+        for check in fil.filters:
+            name = check.__name__
+            if name == '_aa_filter':
+                conditions.append((name, self.aa_mask))
+            elif name in masks:
+                conditions.append((name, lambda columns, remaining, mask=masks[name]: mask(columns)))
+            else:
+                raise NotImplementedError(name)
+        if fil.expression is not None:
+            mask = truth(fil.expression.body)
+            conditions.append(('_expression_filter', lambda columns, remaining: mask(columns)))
+        return conditions
+
+    @staticmethod
+    def aa_mask(columns, remaining):
+        """The amino acid check, run in Python on the rows that passed the checks before it"""
+        return pa.array([keep and filters.aa_check(sequence_alignment_aa, cdr3_aa) for keep, sequence_alignment_aa,
+                         cdr3_aa in zip(remaining.to_pylist(), columns.raw('sequence_alignment_aa'),
+                                        columns.raw('cdr3_aa'))], type=pa.bool_())
+
+    def process(self, lines):
+        """Processes a batch of lines of IgBLAST's output"""
+        parser = self.parser
+        columns = Columns(lines, parser.header_keys, self.constants)
+        if parser.recover_fwr4:
+            self.recover_fwr4(columns)
+        mask = self.filter(columns) if self.filters.active else None
+        passed = self.write(columns, mask)
+
+        parser.total_parsed += columns.num_rows
+        parser.total_passed += passed
+        if parser.progress:
+            parser.progress.add(progress.PARSED, columns.num_rows)
+            parser.progress.add(progress.PASSED, passed)
+
+    def recover_fwr4(self, columns):
+        """Runs the parser's FWR4 recovery on the rows it can change"""
+        empty = [pc.equal(columns.string(key), '') for key in ('fwr4', 'fwr4_aa')]
+        present = [pc.not_equal(columns.string(key), '') for key in ('cdr3', 'cdr3_aa')]
+        candidates = functools.reduce(pc.and_, empty + present + [columns.flag('productive')])
+        for index in pc.indices_nonzero(candidates).to_pylist():
+            d = {key: columns.raw(key)[index] for key in FWR4_FIELDS + FWR4_INPUTS}
+            self.parser.fill_fwr4(d)
+            for key in FWR4_FIELDS:
+                if d[key] != columns.raw(key)[index]:
+                    columns.patch(key, index, d[key])
+
+    def filter(self, columns):
+        """Returns where every check passes, counting the rows each check rejects"""
+        remaining = columns.full(True)
+        for name, condition in self.conditions:
+            passed = condition(columns, remaining)
+            self.filters.failures[name] += pc.sum(pc.and_(remaining, pc.invert(passed))).as_py() or 0
+            remaining = pc.and_(remaining, passed)
+        self.filters.total_filtered += columns.num_rows
+        return remaining
+
+    def write(self, columns, mask):
+        """Writes the rows where mask is set, or every row, to the output as a table and returns how many"""
+        schema = columnar.schema(self.parser.out_keys)
+        num_rows = columns.num_rows if mask is None else pc.sum(mask).as_py() or 0
+        arrays = []
+        for field in schema:
+            if not columns.has(field.name):
+                arrays.append(pa.nulls(num_rows, field.type))
+                continue
+            strings = columns.string(field.name)
+            arrays.append(output_column(field.name, strings if mask is None else strings.filter(mask)))
+
+        self.parser.formatter.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        return num_rows
@@ -0,0 +1,199 @@
+"""Parquet and Arrow IPC (Feather v2) output.
+
+Workers collect the AIRR fields of a chunk's records in typed columns and write them as Arrow record batches to
+their chunk file. The parent reads the batches back, without any JSON or text in between, and appends them to the
+final file in row groups of at least ROW_GROUP_SIZE records. pyarrow is only needed when one of these formats is
+used."""
+FORMATS = ['parquet', 'arrow']
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+# Records per Parquet row group. Chunks are much smaller, so their batches are combined before writing
+ROW_GROUP_SIZE = 65536
+
+BOOL_FIELDS = {'stop_codon', 'vj_in_frame', 'v_frameshift', 'productive', 'rev_comp', 'complete_vdj'}
+INT_SUFFIXES = ('_start', '_end', '_length')
+FLOAT_SUFFIXES = ('_score', '_identity', '_support')
+BOOL_VALUES = {'T': True, 'F': False, 'true': True, 'false': False, 'TRUE': True, 'FALSE': False}
+
+
+def available():
+    """Whether pyarrow is installed, without the cost of importing it"""
+    import importlib.util
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def field_type(name):
+    """The column type of an AIRR field: 'int', 'float', 'bool' or 'string'"""
+    if name in BOOL_FIELDS:
+        return 'bool'
+    elif name.endswith(INT_SUFFIXES):
+        return 'int'
+    elif name.endswith(FLOAT_SUFFIXES):
+        return 'float'
+    return 'string'
+
+
+def to_int(value):
+    return None if value == '' or value is None else int(value)
+
+
+def to_float(value):
+    return None if value == '' or value is None else float(value)
+
+
+def to_bool(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    return BOOL_VALUES.get(value)
+
+
+def to_string(value):
+    return value if isinstance(value, str) or value is None else str(value)
+
+
+CONVERTERS = {'int': to_int, 'float': to_float, 'bool': to_bool, 'string': to_string}
+
+
+def schema(keys):
+    import pyarrow as pa
+
+    types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(), 'string': pa.string()}
+    return pa.schema([(key, types[field_type(key)]) for key in keys])
+
+
+class ColumnBuffer:
+    """Collects the records of a chunk column by column, converting each value to its column type. Whole Arrow
+    tables of records can be appended as well, as the batch path does"""
+    def __init__(self):
+        self.keys = []
+        self.converters = []
+        self.columns = []
+        self.tables = []
+
+    def __len__(self):
+        return (len(self.columns[0]) if self.columns else 0) + sum(table.num_rows for table in self.tables)
+
+    def set_keys(self, keys):
+        if keys == self.keys:
+            return
+        self.keys = list(keys)
+        self.converters = [CONVERTERS[field_type(key)] for key in self.keys]
+        self.columns = [[] for key in self.keys]
+
+    def append(self, d):
+        for key, convert, column in zip(self.keys, self.converters, self.columns):
+            column.append(convert(d.get(key)))
+
+    def append_table(self, table):
+        """Appends a table with the schema of the keys, after any records appended before it"""
+        self.flush()
+        self.tables.append(table)
+
+    def flush(self):
+        """Moves the records appended one by one into a table"""
+        if self.columns and self.columns[0]:
+            batch_schema = schema(self.keys)
+            self.tables.append(self.table(batch_schema))
+            self.columns = [[] for key in self.keys]
+
+    def table(self, batch_schema):
+        import pyarrow as pa
+
+        return pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in
+                                     zip(self.columns, batch_schema)], schema=batch_schema)
+
+    def sort(self, fields):
+        """Sorts the records by fields, as --sort_by does"""
+        import pyarrow as pa
+        from . import sort
+
+        self.flush()
+        if self.tables:
+            self.tables = [sort.sort_table(pa.concat_tables(self.tables), fields)]
+
+    def truncate(self, length):
+        self.flush()
+        kept = []
+        for table in self.tables:
+            if length <= 0:
+                break
+            kept.append(table.slice(0, length))
+            length -= table.num_rows
+        self.tables = kept
+
+    def write(self, path):
+        """Writes the records to path as Arrow record batches"""
+        import pyarrow as pa
+
+        batch_schema = schema(self.keys)
+        self.flush()
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, batch_schema) as writer:
+                if not self.tables:
+                    writer.write_table(self.table(batch_schema))
+                for table in self.tables:
+                    writer.write_table(table)
+
+
+def conform(table, target):
+    """Reorders the columns of a chunk's table to the target schema, adding missing ones as nulls"""
+    import pyarrow as pa
+
+    if table.schema.equals(target):
+        return table
+    columns = [table.column(field.name) if field.name in table.schema.names else pa.nulls(table.num_rows, field.type)
+               for field in target]
+    return pa.Table.from_arrays(columns, schema=target)
+
+
+def merge(chunk_files, outfile, outfmt):
+    """Appends the record batches of the chunk files to a Parquet or Arrow IPC file and returns the number of
+    records written. Only the schemas are read up front, to find the widest one, and the chunks are then read one at a
+    time, so at most about a row group is held at once"""
+    import pyarrow as pa
+
+    schemas = {}
+    for path in chunk_files:
+        with pa.memory_map(path, 'r') as source:
+            chunk_schema = pa.ipc.open_file(source).schema
+        if len(chunk_schema):
+            schemas[path] = chunk_schema
+
+    target = max(schemas.values(), key=len) if schemas else pa.schema([])
+    with pa.OSFile(outfile, 'wb') as sink:
+        total = 0
+        pending = []
+        pending_rows = 0
+        with new_writer(sink, target, outfmt) as writer:
+            for path in schemas:
+                with pa.memory_map(path, 'r') as source:
+                    table = pa.ipc.open_file(source).read_all()
+                pending.append(conform(table, target))
+                pending_rows += table.num_rows
+                if pending_rows >= ROW_GROUP_SIZE:
+                    write_table(writer, pa.concat_tables(pending), outfmt)
+                    total += pending_rows
+                    pending = []
+                    pending_rows = 0
+            if pending:
+                write_table(writer, pa.concat_tables(pending), outfmt)
+                total += pending_rows
+
+    return total
+
+
+def new_writer(sink, target, outfmt):
+    """Returns the writer of the final Parquet or Arrow IPC file"""
+    import pyarrow as pa
+
+    if outfmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(sink, target)
+    options = pa.ipc.IpcWriteOptions(compression='lz4' if pa.Codec.is_available('lz4') else None)
+    return pa.ipc.new_file(sink, target, options=options)
+
+
+def write_table(writer, table, outfmt):
+    if outfmt == 'parquet':
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
+    else:
+        writer.write_table(table, max_chunksize=ROW_GROUP_SIZE)
@@ -0,0 +1,98 @@
+"""SQLite output.
+
+Workers write their chunks as TSV. The parent streams the chunks into a single table of a new database in large
+transactions, letting SQLite convert each value to its column type, and builds the indexes once every record is
+loaded, which is much faster than keeping them up to date during the load."""
+import os
+import sqlite3
+
+from . import columnar
+
+EXTENSION = '.sqlite'
+TABLE = 'sequences'
+# Fields indexed after the load, for the usual per-sample queries on germlines and CDR3
+INDEXED_FIELDS = ['sequence_id', 'v_family', 'j_family', 'cdr3_aa', 'cdr3_aa_length']
+# Records inserted per transaction
+TRANSACTION_SIZE = 200000
+
+SQL_TYPES = {'int': 'INTEGER', 'float': 'REAL', 'bool': 'BOOLEAN', 'string': 'TEXT'}
+# How a TSV value is bound for each column type. Empty numbers become NULL and IgBLAST's T/F become 1/0
+PLACEHOLDERS = {
+    'int': "NULLIF(?, '')",
+    'float': "NULLIF(?, '')",
+    'bool': "CASE ? WHEN 'T' THEN 1 WHEN 'F' THEN 0 END",
+    'string': '?'
+}
+
+
+def quote(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def create_table(keys):
+    return 'CREATE TABLE {0} ({1})'.format(TABLE, ', '.join(
+        '{0} {1}'.format(quote(key), SQL_TYPES[columnar.field_type(key)]) for key in keys))
+
+
+def insert_statement(keys):
+    return 'INSERT INTO {0} VALUES ({1})'.format(TABLE, ', '.join(
+        PLACEHOLDERS[columnar.field_type(key)] for key in keys))
+
+
+def read_rows(fin, header, keys):
+    """Yields the rows of a TSV chunk with their values in the order of keys"""
+    rows = (line.rstrip('\n').split('\t') for line in fin)
+    if header == keys:
+        return rows
+
+    indexes = [header.index(key) if key in header else None for key in keys]
+    return ([row[index] if index is not None else '' for index in indexes] for row in rows)
+
+
+def merge(chunk_files, outfile, default_keys):
+    """Loads the TSV chunk files into a new SQLite database, indexes it and returns the number of records loaded.
+    The columns are those of the first chunk with records, or default_keys if there are none"""
+    if os.path.exists(outfile):
+        os.remove(outfile)
+
+    connection = sqlite3.connect(outfile, isolation_level=None)
+    try:
+        # The database is rebuilt from the chunks if the load fails, so there is nothing to journal
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+
+        keys = None
+        total = 0
+        pending = 0
+        connection.execute('BEGIN')
+        for path in chunk_files:
+            with open(path, 'r') as fin:
+                header = fin.readline().rstrip('\n').split('\t')
+                if header == ['']:
+                    continue
+                if keys is None:
+                    keys = header
+                    connection.execute(create_table(keys))
+                    insert = insert_statement(keys)
+
+                pending += connection.executemany(insert, read_rows(fin, header, keys)).rowcount
+            if pending >= TRANSACTION_SIZE:
+                connection.execute('COMMIT')
+                connection.execute('BEGIN')
+                total += pending
+                pending = 0
+
+        if keys is None:
+            keys = default_keys
+            connection.execute(create_table(keys))
+        connection.execute('COMMIT')
+        total += pending
+
+        for key in INDEXED_FIELDS:
+            if key in keys:
+                connection.execute('CREATE INDEX {0} ON {1} ({2})'.format(quote(TABLE + '_' + key), TABLE, quote(key)))
+        connection.execute('ANALYZE')
+    finally:
+        connection.close()
+
+    return total
@@ -1,24 +1,41 @@
+import collections
 import functools
-import multiprocessing
-import pkg_resources
+import hashlib
+import json
 import os
-from . import arg_parse, igblast
+from . import arg_parse, columnar, database, igblast, index, parsers, progress, records, report, sort, tune
 import shutil
 import signal
+import itertools
 import subprocess
 import tempfile
+import threading
 import time
-import tqdm
 import sys
 
 IGBLAST_TSV_HEADER = ['sequence_id','sequence','locus','stop_codon','vj_in_frame','v_frameshift','productive','rev_comp','complete_vdj','v_call','d_call','j_call','sequence_alignment','germline_alignment','sequence_alignment_aa','germline_alignment_aa','v_alignment_start','v_alignment_end','d_alignment_start','d_alignment_end','j_alignment_start','j_alignment_end','v_sequence_alignment','v_sequence_alignment_aa','v_germline_alignment','v_germline_alignment_aa','d_sequence_alignment','d_sequence_alignment_aa','d_germline_alignment','d_germline_alignment_aa','j_sequence_alignment','j_sequence_alignment_aa','j_germline_alignment','j_germline_alignment_aa','fwr1','fwr1_aa','cdr1','cdr1_aa','fwr2','fwr2_aa','cdr2','cdr2_aa','fwr3','fwr3_aa','fwr4','fwr4_aa','cdr3','cdr3_aa','junction','junction_length','junction_aa','junction_aa_length','v_score','d_score','j_score','v_cigar','d_cigar','j_cigar','v_support','d_support','j_support','v_identity','d_identity','j_identity','v_sequence_start','v_sequence_end','v_germline_start','v_germline_end','d_sequence_start','d_sequence_end','d_germline_start','d_germline_end','j_sequence_start','j_sequence_end','j_germline_start','j_germline_end','fwr1_start','fwr1_end','cdr1_start','cdr1_end','fwr2_start','fwr2_end','cdr2_start','cdr2_end','fwr3_start','fwr3_end','fwr4_start','fwr4_end','cdr3_start','cdr3_end','np1','np1_length','np2','np2_length']
 MAX_CHUNK_SIZE = 1000
+# With --ordered, chunks per process that are run ahead of the next chunk to be written
+ORDERED_AHEAD = 4
+MANIFEST_FILE = 'manifest.jsonl'
+# Arguments that don't change the analysis results and so aren't part of a checkpoint's identity: how the run is
+# executed, instrumented and reported, and how the final output is written from the chunks
+CHECKPOINT_VOLATILE_ARGS = ['multi', 'silent', 'debug', 'print_args', 'tmp_dir', 'gzip', 'checkpoint', 'resume',
+                            'igblast_threads', 'config', 'no_config', 'tuned', 'tune_input', 'tune_reads', 'ordered',
+                            'sort_memory', 'report', 'trace', 'metrics_file', 'progress_interval', 'index',
+                            'partition_by']
 
 class PyIR():
-    """The primary class for PyIR"""
-    def __init__(self, query=None, args=None, is_api=True):
+    """The primary class for PyIR
+
+    progress_callback, if given, is called from a background thread about every --progress_interval seconds with a
+    dict of live counts ('read', 'sent', 'parsed', 'passed', 'written'), throughput, ETA and the number of seconds
+    since a record was last parsed"""
+    def __init__(self, query=None, args=None, is_api=True, progress_callback=None):
         self.is_api = is_api
+        self.progress_callback = progress_callback
         if not self.is_api:
+            self.argv = sys.argv[1:]
             self.args = arg_parse.PyIrArgumentParser().parse_arguments()
         else:
             if not query:
@@ -34,9 +51,11 @@ class PyIR():
                     for item in args:
                         args_formatted.append(item)
 
-            self.args = arg_parse.PyIrArgumentParser().parse_arguments(args_formatted)
+            self.argv = [str(item) for item in args_formatted]
+            self.args = arg_parse.PyIrArgumentParser().parse_arguments(self.argv)
 
         self.setup = True if self.args['query'] == 'setup' else False
+        self.tune = self.args['query'] == 'tune'
 
         # self.args = args
         self.legacy = self.args['legacy']
@@ -44,23 +63,42 @@ class PyIR():
         self.silent = self.args['silent']
         self.num_procs = self.args['multi']
         if not os.path.exists(self.args['tmp_dir']):
-            os.makedirs(self.args['tmp_dir'])
+            os.makedirs(self.args['tmp_dir'], exist_ok=True)
 
         self.input_file = self.args['query']
         self.input_type = self.args['input_type']
 
-        if not self.setup:
+        if not self.setup and not self.tune:
             self.chunk_size = self.args['chunk_size'] if self.args['chunk_size'] else self.get_chunk_size()
-            self.tmp_dir = tempfile.mkdtemp(dir=self.args['tmp_dir'])
-            self.args['tmp_dir'] = self.tmp_dir
             self.output_file = self.args['out'] if self.args['out'] else self.input_file.split('.')[0]
+            self.rejects_file = self.output_file + '.rejects.fasta'
+            self.reject_files = []
+            self.output_extension = ''
             if self.args['outfmt'] in ['json', 'lsjson']:
-                self.output_file += '.json'
+                self.output_extension = '.json'
             elif self.args['outfmt'] == 'tsv':
-                self.output_file += '.tsv'
+                self.output_extension = '.tsv'
+            elif self.args['outfmt'] in columnar.FORMATS:
+                self.output_extension = columnar.EXTENSIONS[self.args['outfmt']]
+            elif self.args['outfmt'] == 'sqlite':
+                self.output_extension = database.EXTENSION
+            self.output_file += self.output_extension
+
+            # Checkpointed runs keep their chunks in a directory derived from the input and settings so that a
+            # later --resume run can find the chunks that were already completed
+            self.checkpoint = self.args['checkpoint'] or self.args['resume']
+            if self.checkpoint:
+                self.tmp_dir = self.get_checkpoint_dir()
+                if os.path.exists(self.tmp_dir) and not self.args['resume']:
+                    shutil.rmtree(self.tmp_dir)
+                if not os.path.exists(self.tmp_dir):
+                    os.makedirs(self.tmp_dir)
+            else:
+                self.tmp_dir = tempfile.mkdtemp(dir=self.args['tmp_dir'])
+            self.args['tmp_dir'] = self.tmp_dir
+            self.completed_chunks = {}
         else:
-            self.output_folder = self.args['out'].rstrip('/\\') if self.args['out'] else \
-                pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab_pyir"), "crowelab_pyir/data/germlines")
+            self.output_folder = self.args['out'].rstrip('/\\') if self.args['out'] else arg_parse.data_path('germlines')
 
 #        self.tsv_headers = []
 
@@ -80,7 +118,7 @@ class PyIR():
 #       Filtering Arguments
 #
 #
-        self.use_filter = self.args['enable_filter']
+        self.use_filter = self.args['enable_filter'] or bool(self.args['filter_expression'])
 
 #        if self.args['outfmt'] == 'tsv':
 #            self.outkeys = IGBLAST_TSV_HEADER
@@ -90,15 +128,15 @@ class PyIR():
 
         self.gzip_output = self.args['gzip']
         self.progress = None
+        self.monitor = None
+        self.total_passed = 0
+        self.report = report.RunReport(bool(self.args['report']), bool(self.args['trace']))
 
     def run_setup(self):
-        if not os.path.exists(
-                pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab_pyir"), "crowelab_pyir/data/bin")):
+        if not os.path.exists(arg_parse.data_path('bin')):
             raise FileNotFoundError("Missing package bin directory -- was PyIR installed correctly?")
 
-        baseArgs = [sys.executable, pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab_pyir"),
-                                                    "crowelab_pyir/data/bin/setup_germline_library.py"),
-                    pkg_resources.resource_filename(pkg_resources.Requirement.parse("crowelab_pyir"), "crowelab_pyir/data"),
+        baseArgs = [sys.executable, arg_parse.data_path('bin', 'setup_germline_library.py'), arg_parse.data_path(),
                     self.output_folder]
 
         subprocess.run(baseArgs)
@@ -111,19 +149,61 @@ class PyIR():
         4. Takes chunked results, combines into one and zips up output"""
         if self.setup:
             return self.run_setup()
+        if self.tune:
+            return tune.Tuner(self.args, self.argv).run()
+
+        self.mp_context = self.pool_context()
 
+        # Live counts are only kept when something will report them
+        if not self.silent or self.progress_callback or self.args['metrics_file']:
+            self.progress = progress.Progress(self.num_procs, self.mp_context)
 
         if not self.silent:
             start = time.time()
             print('Splitting input {0} file {1}'.format(self.input_type, self.input_file))
 
-        num_seqs, input_files = self.split_input_file()
+        with self.report.stage('split'):
+            num_seqs, input_files = self.split_input_file()
+        self.report.set_records('split', num_seqs)
 
         if not self.silent:
             print('{0:,} sequences successfully split into {1} pieces'.format(num_seqs, len(input_files)))
+
+        remaining_seqs = num_seqs
+        if self.checkpoint:
+            self.completed_chunks = self.load_manifest(input_files, num_seqs) if self.args['resume'] else {}
+            self.start_manifest(num_seqs)
+            remaining_seqs -= sum(entry['num_seqs'] for entry in self.completed_chunks.values())
+            input_files = [f for i, f in enumerate(input_files) if i not in self.completed_chunks]
+            if self.progress:
+                for entry in self.completed_chunks.values():
+                    self.progress.add(progress.SENT, entry['num_seqs'])
+                    self.progress.add(progress.PARSED, entry['total_parsed'])
+                    self.progress.add(progress.PASSED, entry['total_passed'])
+                    self.progress.add(progress.WRITTEN, entry['total_passed'])
+            if self.completed_chunks and not self.silent:
+                print('Resuming: {0} pieces already completed, {1} remaining'.format(len(self.completed_chunks),
+                                                                                  len(input_files)))
+
+        if not self.silent:
+            if self.args['tuned']:
+                print('Using tuned {0} from {1}'.format(', '.join('--{0} {1}'.format(key, self.args[key])
+                                                                  for key in self.args['tuned']), self.args['config']))
             print('Starting process pool using {0} processors'.format(self.num_procs))
 
-        output = self.run_pool(input_files, num_seqs)
+        with self.report.stage('pool', remaining_seqs):
+            output = self.run_pool(input_files, num_seqs)
+
+        if self.checkpoint:
+            output = [self.completed_chunks[i]['output'] for i in sorted(self.completed_chunks)]
+            self.reject_files = [self.completed_chunks[i]['rejects'] for i in sorted(self.completed_chunks)
+                                 if self.completed_chunks[i]['rejects']]
+
+        if self.reject_files:
+            num_rejected = self.write_rejects()
+            if not self.silent:
+                print('Warning: IgBLAST failed on {0:,} sequences, written to {1}'.format(num_rejected,
+                                                                                     self.rejects_file))
 
         if not self.silent:
             end = time.time()
@@ -134,28 +214,99 @@ class PyIR():
         if not output:
             print('Error: No output')
             return None
-        elif self.args['outfmt'] in ['lsjson', 'json', 'tsv']:
-            self.concat_files(output, self.output_file)
+        elif self.args['outfmt'] in ['lsjson', 'json', 'tsv', 'sqlite'] + columnar.FORMATS:
+            with self.report.stage('concat'):
+                if self.args['partition_by']:
+                    result_files = {}
+                    for name, files in self.partition_outputs(output).items():
+                        result_files[name] = self.partition_file(name)
+                        self.concat_files(files, result_files[name])
+                else:
+                    result_files = {None: self.output_file}
+                    if not self.stream_output():
+                        self.concat_files(output, self.output_file)
+            self.report_finished()
 
             if not self.debug:
                 shutil.rmtree(self.tmp_dir)
 
-            if self.gzip_output:
+            # Parquet and Arrow files are compressed internally, and SQLite databases are queried in place
+            suffix = ''
+            if self.gzip_output and self.args['outfmt'] not in ['sqlite'] + columnar.FORMATS:
                 if not self.silent:
                     print("Zipping up final output")
-                subprocess.check_call(['gzip', '-f', self.output_file])
+                with self.report.stage('gzip'):
+                    if self.args['index']:
+                        # Compressed in members that records can be read from on their own, and indexed in the same pass
+                        for path in result_files.values():
+                            index.build(path, self.args['outfmt'], True)
+                    else:
+                        subprocess.check_call(['gzip', '-f'] + list(result_files.values()))
+                suffix = '.gz'
+            elif self.args['index']:
+                with self.report.stage('index'):
+                    for path in result_files.values():
+                        index.build(path, self.args['outfmt'], False)
+            self.write_report(num_seqs)
 
-                if not self.silent:
-                    print("Analysis complete, result file: {0}.gz".format(self.output_file))
-                return os.path.join(os.getcwd(), self.output_file + '.gz')
-            else:
-                if not self.silent:
-                    print("Analysis complete, result file: {0}".format(self.output_file))
-                return os.path.join(os.getcwd(), self.output_file)
+            if not self.silent:
+                print("Analysis complete, result file{0}: {1}".format(
+                    's' if len(result_files) > 1 else '', ', '.join(path + suffix for path in result_files.values())))
+            if self.args['partition_by']:
+                return {name: os.path.join(os.getcwd(), path + suffix) for name, path in result_files.items()}
+            return os.path.join(os.getcwd(), self.output_file + suffix)
         elif self.args['outfmt'] in ['dict']:
+            with self.report.stage('merge'):
+                if self.args['partition_by']:
+                    result = {name: {key: val for d in chunks for key, val in d.items()}
+                              for name, chunks in self.partition_outputs(output).items()}
+                else:
+                    result = {key: val for d in output for key, val in d.items()}
+            self.report_finished()
+            self.write_report(num_seqs)
+
             if not self.silent:
                 print("Analysis complete, returning dictionary")
-            return {key: val for d in output for key, val in d.items()}
+            return result
+
+    def partition_file(self, name):
+        """The output file of a partition, named after it, e.g. example.IGH.tsv"""
+        return self.output_file[:len(self.output_file) - len(self.output_extension)] + '.' + name + \
+            self.output_extension
+
+    @staticmethod
+    def partition_outputs(output):
+        """The chunk outputs of each partition, in the order of the chunks, by partition name"""
+        partitions = {}
+        for chunk in output:
+            for name, chunk_output in chunk.items():
+                partitions.setdefault(name, []).append(chunk_output)
+        return {name: partitions[name] for name in sorted(partitions)}
+
+    def receive(self, chunk_output):
+        """Maps the records of a chunk, or of each of its partitions, that were sent through shared memory"""
+        if self.args['partition_by']:
+            return {name: self.receive_records(partition) for name, partition in chunk_output.items()}
+        return self.receive_records(chunk_output)
+
+    @staticmethod
+    def receive_records(chunk_output):
+        if isinstance(chunk_output, records.SharedRecords):
+            return chunk_output.receive()
+        return chunk_output
+
+    def report_finished(self):
+        """Reports the final counts once the output is complete"""
+        if self.monitor:
+            self.monitor.update(finished=True)
+
+    def write_report(self, num_seqs):
+        """Writes the --report and --trace files, if they were requested"""
+        self.report.write(self.args['report'], input=os.path.abspath(self.input_file), num_seqs=num_seqs,
+                          num_chunks=len(self.chunk_starts) - 1, chunk_size=self.chunk_size,
+                          processes=self.num_procs, outfmt=self.args['outfmt'])
+        if self.args['trace']:
+            self.report.write_trace(self.args['trace'])
 
     def get_chunk_size(self):
         """Takes input file and uses file size to determine optimal chunk size."""
@@ -165,14 +316,114 @@ class PyIR():
         elif self.input_type == 'fastq':
             return min(int((0.0000006180413705570910 * input_file_size) + 44.6), MAX_CHUNK_SIZE)
 
+    def get_checkpoint_dir(self):
+        """Returns the working directory for a checkpointed run, which depends only on the input file and the
+        arguments that affect its results"""
+        stat = os.stat(self.input_file)
+        settings = {key: val for key, val in self.args.items() if key not in CHECKPOINT_VOLATILE_ARGS}
+        settings['chunk_size'] = self.chunk_size
+        key = json.dumps([os.path.abspath(self.input_file), stat.st_size, stat.st_mtime,
+                          os.path.abspath(self.output_file), settings], sort_keys=True, default=str)
+        return os.path.join(os.path.abspath(self.args['tmp_dir']),
+                            'pyir_checkpoint_' + hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def checksum(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fin:
+            for block in iter(functools.partial(fin.read, 1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def chunk_input_name(self, input_file):
+        """The chunk file holding the complete input for a piece (the fastq file for fastq input)"""
+        return input_file.name if self.input_type == 'fasta' else input_file[1].name
+
+    def load_manifest(self, input_files, num_seqs):
+        """Reads the manifest of a previous run and returns the chunks whose input and output are unchanged"""
+        manifest = os.path.join(self.tmp_dir, MANIFEST_FILE)
+        completed = {}
+        if not os.path.exists(manifest):
+            return completed
+
+        with open(manifest, 'r') as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written line from an interrupted run
+                    continue
+
+                if 'chunk' not in entry:
+                    if entry['num_seqs'] != num_seqs or entry['num_chunks'] != len(input_files):
+                        if not self.silent:
+                            print('Warning: Input no longer matches checkpoint, starting from the beginning')
+                        return {}
+                    continue
+
+                index = entry['chunk']
+                if index < len(input_files) and os.path.exists(entry['output']) and \
+                        entry['input_checksum'] == self.checksum(self.chunk_input_name(input_files[index])) and \
+                        entry['output_checksum'] == self.checksum(entry['output']):
+                    completed[index] = entry
+                elif self.debug:
+                    print("Checkpointed chunk", index, "failed validation and will be rerun")
+
+        return completed
+
+    def start_manifest(self, num_seqs):
+        """Rewrites the manifest with the run header and the chunks that are still valid"""
+        with open(os.path.join(self.tmp_dir, MANIFEST_FILE), 'w') as fout:
+            fout.write(json.dumps({'input': os.path.abspath(self.input_file), 'num_seqs': num_seqs,
+                                   'num_chunks': len(self.chunk_starts) - 1, 'chunk_size': self.chunk_size}) + '\n')
+            for index in sorted(self.completed_chunks):
+                fout.write(json.dumps(self.completed_chunks[index]) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def record_chunk(self, index, result):
+        """Durably appends a completed chunk to the manifest"""
+        entry = {
+            'chunk': index,
+            'start': self.chunk_starts[index],
+            'num_seqs': self.chunk_starts[index + 1] - self.chunk_starts[index],
+            'input': result[2],
+            'input_checksum': self.checksum(result[2] if self.input_type == 'fasta' else result[2][1]),
+            'output': result[0],
+            'output_checksum': self.checksum(result[0]),
+            'total_parsed': result[1],
+            'total_passed': result[3],
+            'rejects': result[4]
+        }
+        self.completed_chunks[index] = entry
+
+        with open(os.path.join(self.tmp_dir, MANIFEST_FILE), 'a') as fout:
+            fout.write(json.dumps(entry) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def add_chunk_start(self, num_seqs):
+        """Records where a new chunk starts in the input, which is also how far the splitter has read"""
+        if self.progress:
+            self.progress.add(progress.READ, num_seqs - self.chunk_starts[-1])
+        self.chunk_starts.append(num_seqs)
+
+    def new_chunk_file(self, index, suffix=''):
+        """Chunk files are named by their position so that splitting the same input always gives the same files"""
+        if not suffix or suffix == '.fasta':
+            self.report.chunk_split()
+        return open(os.path.join(self.tmp_dir, 'pyir_chunk_{0:06d}{1}'.format(index, suffix)), 'w')
+
     def split_input_file(self):
         num_seqs = 0
         pieces = []
+        # Index of the first sequence in each piece, plus the total at the end
+        self.chunk_starts = [0]
 
         if self.input_type == 'fasta':
             index = 0
             lines = 0
-            fout = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False, dir=self.tmp_dir)
+            fout = self.new_chunk_file(index)
             pieces.append(fout)
 
             with open(self.input_file, 'r') as fin:
@@ -200,9 +451,10 @@ class PyIR():
                         num_seqs += 1
                         fout.close()
 
-                        fout = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False, dir=self.tmp_dir)
-                        pieces.append(fout)
                         index += 1
+                        fout = self.new_chunk_file(index)
+                        pieces.append(fout)
+                        self.add_chunk_start(num_seqs)
                         seq = ''
                     else:
                         lines += 1
@@ -211,13 +463,14 @@ class PyIR():
             fout.write(seq)
             num_seqs += 1
             fout.close()
+            self.add_chunk_start(num_seqs)
             return [num_seqs, pieces]
         elif self.input_type == 'fastq':
             index = 0
             lines = 0
 
-            fout_fasta = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False, dir=self.tmp_dir)
-            fout = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False, dir=self.tmp_dir)
+            fout_fasta = self.new_chunk_file(index, '.fasta')
+            fout = self.new_chunk_file(index, '.fastq')
             pieces.append((fout_fasta, fout))
 
             with open(self.input_file, 'r') as fin:
@@ -239,15 +492,13 @@ class PyIR():
                         lines += 1
 
                         if lines/2 // self.chunk_size > index:
+                            index += 1
                             fout_fasta.close()
-                            fout_fasta = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False,
-                                                                     dir=self.tmp_dir)
+                            fout_fasta = self.new_chunk_file(index, '.fasta')
                             fout.close()
-                            fout = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', delete=False,
-                                                                        dir=self.tmp_dir)
+                            fout = self.new_chunk_file(index, '.fastq')
                             pieces.append((fout_fasta, fout))
-
-                            index += 1
+                            self.add_chunk_start(num_seqs + 1)
 
                         line = fin.readline()
                         lines += 1
@@ -255,36 +506,81 @@ class PyIR():
 
             fout_fasta.close()
             fout.close()
+            self.add_chunk_start(num_seqs)
             return [num_seqs, pieces]
 
     def run_pool(self, input_files, total_seqs):
         """Creates a multiprocessing pool and runs all o"""
+        # Imported here so that setup, tune and argument errors don't pay for it
+        import tqdm
+
         output_files = []
-        with multiprocessing.Pool(processes=self.num_procs) as p:
+        if self.args['shared_memory']:
+            records.share_tracker()
+        with self.mp_context.Pool(processes=self.num_procs, initializer=igblast.init_worker,
+                                  initargs=(self.progress,)) as p:
             func = functools.partial(igblast.run, self.args)
 
             results = []
 
             if self.input_type == 'fasta':
-                pool_results = p.imap_unordered(func, [x.name for x in input_files])
+                chunks = [x.name for x in input_files]
             elif self.input_type == 'fastq':
-                pool_results = p.imap_unordered(func, [(x[0].name, x[1].name) for x in input_files])
-
-            if not self.silent:
-                with tqdm.tqdm(total=total_seqs, unit='seq') as pbar:
-                    for x in pool_results:
-                        if x[0]:
-                            pbar.update(x[1])
-                            results.append(x)
-                    pbar.close()
+                chunks = [(x[0].name, x[1].name) for x in input_files]
+            if self.args['ordered']:
+                pool_results = self.ordered_results(p, func, chunks)
             else:
+                pool_results = p.imap_unordered(func, chunks)
+
+            # The progress bar follows the records parsed by the workers rather than finished chunks
+            pbar = tqdm.tqdm(total=total_seqs, unit='seq') if not self.silent else None
+            if self.progress:
+                self.monitor = progress.ProgressMonitor(self.progress, total_seqs, self.args['progress_interval'],
+                                                        self.progress_callback, self.args['metrics_file'], pbar)
+                self.monitor.start()
+
+            # With --ordered, text output is written as the chunks come back, each once the ones before it are
+            fout = None
+            try:
                 for x in pool_results:
-                    results.append(x)
+                    # Shared memory is copied out and released as it arrives, so no segment is left behind if the
+                    # run fails
+                    x = (self.receive(x[0]),) + tuple(x[1:])
+                    # The chunk's records are written to its output by now, so they count as written as each chunk
+                    # comes back rather than once the final output is put together
+                    if self.progress:
+                        self.progress.add(progress.WRITTEN, x[3])
+                    if x[0]:
+                        results.append(x)
+                        if self.checkpoint:
+                            self.record_chunk(self.chunk_index(x[2]), x)
+                        if self.stream_output():
+                            if fout is None:
+                                fout = open(self.output_file, 'w')
+                            self.append_chunk(fout, x[0])
+                if fout is not None and self.args['outfmt'] == 'json':
+                    fout.seek(fout.tell() - 2, 0)
+                    fout.write('\n]\n')
+            finally:
+                if fout is not None:
+                    fout.close()
+                if self.monitor:
+                    self.monitor.stop()
+                if pbar is not None:
+                    pbar.close()
+
+            # Sorted output is merged in input order, so that records with equal keys keep it
+            if self.args['sort_by'] and not self.args['ordered']:
+                results.sort(key=lambda result: self.chunk_index(result[2]))
 
             total_passed = 0
             for result in results:
                 output_files.append(result[0])
                 total_passed += result[3]
+                self.report.add_chunk(result[5])
+                if result[4]:
+                    self.reject_files.append(result[4])
+            self.total_passed += total_passed
 
             if self.use_filter:
                 if not self.silent:
@@ -292,8 +588,83 @@ class PyIR():
 
         return output_files
 
+    def ordered_results(self, pool, func, chunks):
+        """Runs the chunks on the pool and yields their results in input order. Only ORDERED_AHEAD chunks per process
+        are run ahead of the next result, so a slow chunk holds back that many finished ones rather than the rest of
+        the run"""
+        chunks = iter(chunks)
+        pending = collections.deque(pool.apply_async(func, (chunk,))
+                                    for chunk in itertools.islice(chunks, ORDERED_AHEAD * self.num_procs))
+        while pending:
+            result = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(func, (chunk,)))
+            yield result
+
+    def stream_output(self):
+        """Whether ordered lsjson, json or tsv output is written as the chunks come back rather than concatenated once
+        every chunk is done. Sorted, partitioned and checkpointed output is put together at the end"""
+        return self.args['ordered'] and self.args['outfmt'] in ['lsjson', 'json', 'tsv'] and \
+            not (self.args['sort_by'] or self.args['partition_by'] or self.checkpoint)
+
+    def append_chunk(self, fout, chunk_file):
+        """Appends a chunk's output to the final lsjson, json or tsv file, as concat_files would, and removes it"""
+        with open(chunk_file, 'r') as fin:
+            if self.args['outfmt'] == 'tsv':
+                header = fin.readline()
+                if not fout.tell():
+                    fout.write(header)
+            elif self.args['outfmt'] == 'json' and not fout.tell():
+                fout.write('[\n')
+            shutil.copyfileobj(fin, fout)
+        os.remove(chunk_file)
+
+    @staticmethod
+    def pool_context():
+        """Returns the multiprocessing context for the worker pool. Forking while other threads run can leave the
+        workers holding locks that those threads had, so when PyIR runs next to other threads, such as concurrent jobs
+        in a service, the workers come from a fork server"""
+        import multiprocessing
+
+        if threading.active_count() > 1 and multiprocessing.get_start_method() == 'fork' and \
+                'forkserver' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('forkserver')
+        return multiprocessing.get_context()
+
+    def write_rejects(self):
+        """Combines the sequences each chunk couldn't process into one fasta file and returns how many there are"""
+        num_rejected = 0
+        with open(self.rejects_file, 'w') as fout:
+            for f in self.reject_files:
+                with open(f, 'r') as fin:
+                    for line in fin:
+                        if line.startswith('>'):
+                            num_rejected += 1
+                        fout.write(line)
+
+        return num_rejected
+
+    @staticmethod
+    def chunk_index(input_file):
+        """Recovers the chunk index from the name given to it by new_chunk_file"""
+        name = input_file if isinstance(input_file, str) else input_file[0]
+        return int(os.path.basename(name).split('_')[-1].split('.')[0])
+
     def concat_files(self, list_of_files, outfile):
         """Concatenate a list of files"""
+        if self.args['sort_by']:
+            sort.merge(list_of_files, outfile, self.args['outfmt'], self.args['sort_by'], self.args['sort_memory'])
+            return
+        elif self.args['outfmt'] in columnar.FORMATS:
+            columnar.merge(list_of_files, outfile, self.args['outfmt'])
+            return
+        elif self.args['outfmt'] == 'sqlite':
+            default_keys = list(parsers.IGBLAST_TSV_HEADER)
+            if self.args['additional_field']:
+                default_keys.append(self.args['additional_field'][0])
+            database.merge(list_of_files, outfile, default_keys + parsers.PYIR_FIELDS)
+            return
+
         with open(outfile, 'w') as fout:
             if self.args['outfmt'] == 'lsjson':
                 concat_cmd = ['cat'] + list_of_files
@@ -1,6 +1,12 @@
+import ast
+import collections
 import re
+import sys
+
+from . import columnar
 
 AA_PATTERN = re.compile('(WG|FG)')
+NAN = float('nan')
 
 AIRR_TO_LEGACY = {
     'v_support': 'Top V gene e_value',
@@ -11,14 +17,166 @@ AIRR_TO_LEGACY = {
     'sequence_alignment': 'NT-Trimmed'
 }
 
+# AIRR fields read by each filter, kept by AirrParser even when --fields leaves them out of the output
+FILTER_FIELDS = {
+    '_e_seq_dict_filter': ['v_support', 'j_support'],
+    '_productive_filter': ['productive'],
+    '_stop_codon_filter': ['stop_codon'],
+    '_vj_frame_filter': ['vj_in_frame'],
+    '_aa_filter': ['sequence_alignment_aa', 'cdr3_aa'],
+    '_nt_filter': ['sequence_alignment'],
+    '_cdr3_filter': ['cdr3_aa'],
+    '_fr3_filter': ['fwr3_aa']
+}
+
+# The conditions the AIRR filters compile to. Fields are given as {field} and replaced by how they are read
+AIRR_CONDITIONS = {
+    '_e_seq_dict_filter': "{v_support} != '' and {j_support} != '' and float({v_support}) <= min_v_evalue and "
+                          "float({j_support}) <= min_j_evalue",
+    '_productive_filter': "{productive} in ('Yes', 'T')",
+    '_stop_codon_filter': "{stop_codon} in ('No', 'F')",
+    '_vj_frame_filter': "{vj_in_frame} in ('In-frame', 'T')",
+    '_aa_filter': "aa_check({sequence_alignment_aa}, {cdr3_aa})",
+    '_nt_filter': "'N' not in {sequence_alignment}[2:-3]",
+    '_cdr3_filter': "min_cdr3_length <= len({cdr3_aa}) < max_cdr3_length",
+    '_fr3_filter': "'C' in {fwr3_aa}[-3:]"
+}
+
+# The PyIR fields a filter can read before the record is built, as the IgBLAST column they are computed from and
+# how. Other PyIR fields are only available once the record is complete
+FAMILY_TEMPLATE = "{0}.split(',')[0].split('*')[0]"
+DERIVED_FIELDS = {
+    'v_family': ('v_call', FAMILY_TEMPLATE),
+    'd_family': ('d_call', FAMILY_TEMPLATE),
+    'j_family': ('j_call', FAMILY_TEMPLATE),
+    'c_family': ('c_call', FAMILY_TEMPLATE),
+    'cdr3_aa_length': ('cdr3_aa', 'len({0})')
+}
+# Fields PyIR may change after IgBLAST's output is read, so they can't be filtered on before the record is built
+LATE_FIELDS = {'fwr4', 'fwr4_aa', 'fwr4_start', 'fwr4_end'}
+
+EXPRESSION_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.Compare,
+                    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Name, ast.Load,
+                    ast.Constant, ast.Tuple, ast.List)
+
+
+def number(value):
+    """A numeric field as a float, NaN when it is empty so that every comparison with it fails"""
+    return float(value) if value != '' else NAN
+
+
+def aa_check(sequence_alignment_aa, cdr3_aa):
+    """No stop codon in the translation, and the canonical WG or FG after the CDR3"""
+    if '*' in sequence_alignment_aa or cdr3_aa == '':
+        return False
+
+    start = sequence_alignment_aa.find(cdr3_aa)
+    if start < 0:
+        return AA_PATTERN.search(cdr3_aa[:-5 if len(cdr3_aa) >= 5 else -1*(len(cdr3_aa)-1)]) is not None
+
+    # The text between the first and any second occurrence of the CDR3
+    after = sequence_alignment_aa[start + len(cdr3_aa):]
+    end = after.find(cdr3_aa)
+    return AA_PATTERN.search(after if end < 0 else after[:end]) is not None
+
+
+class LegacyLiterals(ast.NodeTransformer):
+    """Python 3.7 and older parse literals as Num, Str and NameConstant. They are turned into the Constant nodes later
+    versions give, which is all the rest of the filters handle"""
+    def visit_Num(self, node):
+        return ast.copy_location(ast.Constant(value=node.n), node)
+
+    def visit_Str(self, node):
+        return ast.copy_location(ast.Constant(value=node.s), node)
+
+    def visit_NameConstant(self, node):
+        return ast.copy_location(ast.Constant(value=node.value), node)
+
+
+def parse_expression(text):
+    """Parses a --filter_expression, such as 'v_identity >= 90 and 8 <= cdr3_aa_length <= 20'. Expressions are
+    comparisons of fields with numbers, strings, True/False or lists, combined with and, or, not and parentheses"""
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError("Invalid filter expression '{0}': {1}".format(text, e.msg))
+    if sys.version_info < (3, 8):
+        tree = LegacyLiterals().visit(tree)
+
+    for node in ast.walk(tree):
+        if not isinstance(node, EXPRESSION_NODES):
+            raise ValueError("Invalid filter expression '{0}': {1} isn't supported".format(
+                text, type(node).__name__))
+    return tree
+
+
+def expression_fields(tree):
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+
+def is_string(node):
+    """Whether an operand is a string, or a list or tuple of strings, which fields are then compared with raw"""
+    if isinstance(node, (ast.Tuple, ast.List)):
+        return any(is_string(element) for element in node.elts)
+    return isinstance(node, ast.Constant) and isinstance(node.value, str)
+
+
+def render_expression(node, access, raw=False):
+    """Python source for a parsed expression, reading fields with access(field). Numeric fields are compared as
+    numbers and flags as booleans, unless raw is set because they are compared with a string.
+
+    Empty fields fail every comparison. != and not in would otherwise be true for them, so they also check that the
+    fields they compare aren't empty, unless the field is compared with '' itself"""
+    if isinstance(node, ast.Expression):
+        return render_expression(node.body, access)
+    elif isinstance(node, ast.BoolOp):
+        operator = ' and ' if isinstance(node.op, ast.And) else ' or '
+        return '(' + operator.join(render_expression(value, access) for value in node.values) + ')'
+    elif isinstance(node, ast.UnaryOp):
+        operator = 'not ' if isinstance(node.op, ast.Not) else '-'
+        return '(' + operator + render_expression(node.operand, access, raw) + ')'
+    elif isinstance(node, ast.Compare):
+        operands = [node.left] + node.comparators
+        raw = any(is_string(operand) for operand in operands)
+        operators = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+                     ast.In: 'in', ast.NotIn: 'not in'}
+        source = render_expression(node.left, access, raw)
+        guards = []
+        for left, operator, comparator in zip(operands, node.ops, node.comparators):
+            source += ' {0} {1}'.format(operators[type(operator)], render_expression(comparator, access, raw))
+            if isinstance(operator, (ast.NotEq, ast.NotIn)):
+                for field, other in [(left, comparator), (comparator, left)]:
+                    guard = "{0} != ''".format(access(field.id)) if isinstance(field, ast.Name) else None
+                    if guard and guard not in guards and not (isinstance(other, ast.Constant) and other.value == ''):
+                        guards.append(guard)
+        return '(' + ' and '.join(guards + [source]) + ')'
+    elif isinstance(node, ast.Name):
+        field_type = columnar.field_type(node.id)
+        if raw or field_type == 'string':
+            return access(node.id)
+        elif field_type == 'bool':
+            return "({0} == 'T')".format(access(node.id))
+        return 'number({0})'.format(access(node.id))
+    elif isinstance(node, (ast.Tuple, ast.List)):
+        return '(' + ''.join(render_expression(element, access, raw) + ', ' for element in node.elts) + ')'
+    return repr(node.value)
+
 class PyIRFilters:
+    """The filters enabled on the command line. For AIRR output they are compiled, together with any
+    --filter_expression, into a single predicate: run_filters on parsed records, and row_filter on IgBLAST's raw
+    columns so that rejected records are never built. Legacy records, and with --debug AIRR records too, are checked
+    by each filter method in turn, which prints why a record failed"""
     def __init__(self, args):
         self.debug = args['debug']
         self.legacy = args['legacy']
         self.is_fastq = True if args['input_type'] == 'fastq' else False
 
+        # Number of records each filter rejected, for the --report file
+        self.total_filtered = 0
+        self.failures = collections.Counter()
+
+        self.filters = []
         if args['enable_filter']:
-            self.filters = []
             self.min_v_evalue = args['filter_v_evalue']
             self.min_j_evalue = args['filter_j_evalue']
             self.filters.append(self._e_seq_dict_filter)
@@ -32,12 +190,23 @@ class PyIRFilters:
                 self.filters.append(self._aa_filter)
             if args['filter_nt_strings']:
                 self.filters.append(self._nt_filter)
+            if args.get('filter_cdr3_length'):
+                min,max = args['filter_cdr3_length'].split(',')
+                self.min_cdr3_length = int(min)
+                self.max_cdr3_length = int(max)
+                self.filters.append(self._cdr3_filter)
+            if args.get('filter_cdr3_quality') is not None and self.is_fastq and self.legacy:
+                self.min_cdr3_quality = args['filter_cdr3_quality']
+                self.filters.append(self._quality_filter)
+            if args.get('filter_fr3_c_codon'):
+                self.filters.append(self._fr3_filter)
 
-            min,max = args['filter_cdr3_length'].split(',')
-            self.min_cdr3_length = int(min)
-            self.max_cdr3_length = int(max)
-        else:
-            self.filters = []
+        self.expression = parse_expression(args['filter_expression']) if args.get('filter_expression') else None
+        self.active = bool(self.filters) or self.expression is not None
+        if self.expression is not None:
+            self.expression_check = self.compile_expression()
+        if not self.legacy and not self.debug:
+            self.run_filters = self.compile(lambda field: 'r[{0!r}]'.format(field))
 
     def get_seqdict_field(self, field):
         if self.legacy:
@@ -46,13 +215,113 @@ class PyIRFilters:
             return field
 
 
+    def conditions(self):
+        """The (name, fields, render) of each compiled check, where render(access) returns its Python source"""
+        conditions = []
+        for fil in self.filters:
+            template = AIRR_CONDITIONS[fil.__name__]
+            fields = FILTER_FIELDS[fil.__name__]
+            conditions.append((fil.__name__, fields, lambda access, template=template, fields=fields:
+                               template.format(**{field: access(field) for field in fields})))
+        if self.expression is not None:
+            conditions.append(('_expression_filter', expression_fields(self.expression),
+                               lambda access: render_expression(self.expression, access)))
+        return conditions
+
+    def compile(self, access):
+        """Compiles the checks into one function of a record, reading each field with the source access(field)"""
+        lines = ['def predicate(r):', '    self.total_filtered += 1']
+        for name, fields, render in self.conditions():
+            lines.extend(['    if not ({0}):'.format(render(access)),
+                          '        failures[{0!r}] += 1'.format(name),
+                          '        return False'])
+        lines.append('    return True')
+
+        namespace = {
+            'self': self,
+            'failures': self.failures,
+            'number': number,
+            'aa_check': aa_check,
+            'min_v_evalue': getattr(self, 'min_v_evalue', None),
+            'min_j_evalue': getattr(self, 'min_j_evalue', None),
+            'min_cdr3_length': getattr(self, 'min_cdr3_length', None),
+            'max_cdr3_length': getattr(self, 'max_cdr3_length', None)
+        }
+        exec(compile('\n'.join(lines), '<pyir filters>', 'exec'), namespace)
+        return namespace['predicate']
+
+    def compile_expression(self):
+        """Compiles the --filter_expression on its own into a function of a record, for run_filters"""
+        namespace = {'number': number}
+        source = 'def check(r):\n    return {0}'.format(render_expression(self.expression,
+                                                                         lambda field: 'r[{0!r}]'.format(field)))
+        exec(compile(source, '<pyir filters>', 'exec'), namespace)
+        return namespace['check']
+
+    def row_filter(self, header, constants=None):
+        """Returns the checks compiled for IgBLAST's raw columns in the order of header, or None if they read a field
+        that only exists once the record is built. constants are fields with the same value for every record. With
+        --debug it is None, so that records are built and run_filters prints why they failed"""
+        if self.debug:
+            return None
+        constants = constants or {}
+        columns = {key: index for index, key in enumerate(header)}
+
+        def access(field):
+            if field in constants:
+                return repr(constants[field])
+            elif field in LATE_FIELDS:
+                raise KeyError(field)
+            elif field in columns:
+                return 'r[{0}]'.format(columns[field])
+            source, template = DERIVED_FIELDS[field]
+            return template.format('r[{0}]'.format(columns[source]))
+
+        try:
+            return self.compile(access)
+        except KeyError:
+            return None
+
     def run_filters(self, seq_dict):
+        self.total_filtered += 1
         for fil in self.filters:
             if not fil(seq_dict):
+                self.failures[fil.__name__] += 1
                 return False
+        if self.expression is not None and not self._expression_filter(seq_dict):
+            self.failures['_expression_filter'] += 1
+            return False
 
         return True
 
+    def fields(self):
+        """The AIRR fields the enabled filters read"""
+        fields = {field for fil in self.filters for field in FILTER_FIELDS.get(fil.__name__, [])}
+        if self.expression is not None:
+            fields.update(expression_fields(self.expression))
+        return fields
+
+    def get_counts(self):
+        """Returns how many records passed and failed each filter. Filters run in order and stop at the first
+        failure, so each filter only sees the records that passed the ones before it"""
+        counts = collections.OrderedDict()
+        remaining = self.total_filtered
+        names = [fil.__name__ for fil in self.filters] + (['_expression_filter'] if self.expression is not None else [])
+        for name in names:
+            failed = self.failures[name]
+            counts[name.strip('_')] = {'passed': remaining - failed, 'failed': failed}
+            remaining -= failed
+
+        return counts
+
+    def _expression_filter(self, seq_dict):
+        if self.expression_check(seq_dict):
+            return True
+        if self.debug:
+            print("Filter expression failed --", ', '.join('{0}: {1}'.format(field, seq_dict.get(field))
+                                                         for field in sorted(expression_fields(self.expression))))
+        return False
+
     def _e_seq_dict_filter(self, seq_dict):
         if self.get_seqdict_field('v_support') in seq_dict and self.get_seqdict_field('j_support') in seq_dict and \
                 seq_dict[self.get_seqdict_field('v_support')] and seq_dict[self.get_seqdict_field('j_support')]:
@@ -101,22 +370,7 @@ class PyIRFilters:
                     print("AA failed -- AA:", seq_dict['AA'])
                 return False
         else:
-            if '*' not in seq_dict['sequence_alignment_aa'] and seq_dict['cdr3_aa'] != '':
-                cdr3_split = seq_dict['sequence_alignment_aa'].split(seq_dict['cdr3_aa'])
-                if len(cdr3_split) < 2:
-                    if re.search(AA_PATTERN, seq_dict['cdr3_aa'][:-5 if len(seq_dict['cdr3_aa']) >= 5 else -1*(len(seq_dict['cdr3_aa'])-1)]):
-                        return True
-                    else:
-                        return False
-                else:
-                    if re.search(AA_PATTERN, seq_dict['sequence_alignment_aa'].split(seq_dict['cdr3_aa'])[1]):
-                        return True
-                    else:
-                        return False
-            else:
-                if self.debug:
-                    print("AA failed -- AA:", seq_dict['sequence_alignment_aa'])
-                return False
+            return aa_check(seq_dict['sequence_alignment_aa'], seq_dict['cdr3_aa'])
 
     def _nt_filter(self, seq_dict):
         if 'N' not in seq_dict[self.get_seqdict_field('sequence_alignment')][2:-3]:
@@ -154,7 +408,7 @@ class PyIRFilters:
             if self.legacy:
                 if 'CDR3' in seq_dict:
                     if 'Lowest Phred' in seq_dict['CDR3']:
-                        if seq_dict['CDR3']['Lowest Phred'] >= 30:
+                        if seq_dict['CDR3']['Lowest Phred'] >= self.min_cdr3_quality:
                             return True
                     else:
                         if self.debug:
@@ -186,7 +440,7 @@ class PyIRFilters:
                     print("FR3 'C' filter failed -- FR3 missing from query")
                 return False
         else:
-            if 'fr3_aa' in seq_dict and 'C' in seq_dict['fr3_aa'][-3:]:
+            if 'fwr3_aa' in seq_dict and 'C' in seq_dict['fwr3_aa'][-3:]:
                 return True
             else:
                 return False
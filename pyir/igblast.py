@@ -1,8 +1,20 @@
 import os
-from . import parsers
+from . import parsers, progress, report
 import tempfile
 import signal
 
+# The progress.Progress counters shared with the parent, set in each worker process by init_worker
+shared_progress = None
+# Fields of the first-pass records read by needs_rerun and run_two_pass, kept when --fields leaves them out
+RERUN_FIELDS = ['sequence_id', 'sequence', 'v_support', 'j_support', 'productive', 'cdr3']
+
+
+def init_worker(worker_progress):
+    global shared_progress
+    shared_progress = worker_progress
+    if shared_progress:
+        shared_progress.attach()
+
 
 def run(args, input_file):
     igblast_run = IgBlastRun(args)
@@ -42,9 +54,45 @@ class IgBlastRun():
         self.blast_outfmt = '3' if args['legacy'] else '19'
 
         # Collect IgBLAST variables and prepare for\
-        self.collected_args = [
+        self.collected_args = self.build_args(args['num_V_alignments'], args['num_D_alignments'],
+                                              args['num_J_alignments'], args['word_size'])
+
+        if self.args['debug']:
+            print("running pyir with args:", ' '.join(self.collected_args + [args['query']]))
+
+        # Two-pass mode runs every read with lean settings first and only reruns the ambiguous ones with the
+        # full settings above
+        self.two_pass = args['two_pass']
+        if self.two_pass:
+            self.fast_args = self.build_args('1', '1', '1', args['fast_word_size'])
+            self.rerun_v_evalue = args['rerun_v_evalue']
+            self.rerun_j_evalue = args['rerun_j_evalue']
+            self.rerun_unproductive = args['rerun_unproductive']
+            self.rerun_missing_cdr3 = args['rerun_missing_cdr3']
+
+            if self.args['debug']:
+                print("running pyir first pass with args:", ' '.join(self.fast_args + [args['query']]))
+
+        self.input_type = args['input_type']
+        self.use_filter = args['enable_filter']
+
+        # Failed IgBLAST runs are retried, then bisected until the sequences that make IgBLAST fail are isolated
+        self.retries = args['retries']
+        self.max_rejects = args['max_rejects']
+        self.reject_file = None
+        self.total_rejected = 0
+        self.progress = shared_progress
+
+        # Internal use variables
+        self.query = None
+        self.seqs = None
+
+    def build_args(self, num_V_alignments, num_D_alignments, num_J_alignments, word_size):
+        """Returns the IgBLAST command line (up to and including '-query') for the given alignment settings"""
+        args = self.args
+        collected_args = [
             args['executable'],
-            '-num_alignments_V', args['num_V_alignments'],
+            '-num_alignments_V', num_V_alignments,
             '-organism', args['species'],
             '-ig_seqtype', args['receptor'],
             '-germline_db_V', args['germlineV'],
@@ -52,39 +100,155 @@ class IgBlastRun():
             '-domain_system', 'imgt',
             '-num_alignments', '1',
             '-num_descriptions', '1',
-            '-num_threads', '1',
+            '-num_threads', str(args['igblast_threads']),
             '-extend_align5end']
 
         if args['sequence_type'] == 'nucl':
-            self.collected_args.extend(['-num_alignments_D', args['num_D_alignments'], '-num_alignments_J',
-                                        args['num_J_alignments'], '-auxiliary_data',
-                                        os.path.join(args['aux'], args['species'] + '_gl.aux'), '-germline_db_D',
-                                        args['germlineD'], '-germline_db_J', args['germlineJ'], '-min_D_match',
-                                        args['minD'], '-c_region_db', args['germlineC'], '-show_translation'])
+            collected_args.extend(['-num_alignments_D', num_D_alignments, '-num_alignments_J',
+                                   num_J_alignments, '-auxiliary_data',
+                                   os.path.join(args['aux'], args['species'] + '_gl.aux'), '-germline_db_D',
+                                   args['germlineD'], '-germline_db_J', args['germlineJ'], '-min_D_match',
+                                   args['minD'], '-c_region_db', args['germlineC'], '-show_translation'])
 
-        if args['word_size']:
-            self.collected_args.extend(['-word_size', args['word_size']])
+        if word_size:
+            collected_args.extend(['-word_size', word_size])
 
         if args['gapopen']:
-            self.collected_args.extend(['-gapopen', args['gapopen']])
+            collected_args.extend(['-gapopen', args['gapopen']])
 
         if args['penalty']:
-            self.collected_args.extend(['-penalty', args['penalty']])
+            collected_args.extend(['-penalty', args['penalty']])
 
         if args['reward']:
-            self.collected_args.extend(['-reward', args['reward']])
-
-        self.collected_args.append('-query')
-
-        if self.args['debug']:
-            print("running pyir with args:", ' '.join(self.collected_args + [args['query']]))
-
-        self.input_type = args['input_type']
-        self.use_filter = args['enable_filter']
-
-        # Internal use variables
-        self.query = None
-        self.seqs = None
+            collected_args.extend(['-reward', args['reward']])
+
+        collected_args.append('-query')
+        return collected_args
+
+    def needs_rerun(self, d):
+        """Returns True if a first-pass record is ambiguous enough to be rerun with the full IgBLAST settings"""
+        if not d['v_support'] or float(d['v_support']) > self.rerun_v_evalue:
+            return True
+        if not d['j_support'] or float(d['j_support']) > self.rerun_j_evalue:
+            return True
+        if self.rerun_unproductive and d['productive'] != 'T':
+            return True
+        if self.rerun_missing_cdr3 and not d['cdr3']:
+            return True
+        return False
+
+    def run_with_recovery(self, run, query):
+        """Calls run(query), retrying it if IgBLAST fails. If it still fails the query is bisected so that the
+        sequences IgBLAST can't process end up in the reject file and the rest are run normally.
+
+        run must raise parsers.IgBlastError without leaving partial output behind. Returns the list of values
+        returned by each successful call of run"""
+        for attempt in range(self.retries + 1):
+            try:
+                return [run(query)]
+            except parsers.IgBlastError as e:
+                error = e
+                if self.debug:
+                    print("IgBLAST failed on", query, "attempt", attempt + 1, "--", e)
+
+        return self.bisect(run, self.read_fasta(query), error)
+
+    def bisect(self, run, records, error):
+        if len(records) == 1:
+            self.reject(records[0], error)
+            return []
+
+        results = []
+        middle = len(records) // 2
+        for half in (records[:middle], records[middle:]):
+            piece = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', suffix='.fasta', delete=False,
+                                                dir=self.tmp_dir)
+            with piece:
+                for header, seq in half:
+                    piece.write('>' + header + '\n' + seq + '\n')
+
+            try:
+                results.append(run(piece.name))
+            except parsers.IgBlastError as e:
+                results.extend(self.bisect(run, half, e))
+
+        return results
+
+    def reject(self, record, error):
+        """Writes a sequence that IgBLAST fails on to this chunk's reject file"""
+        self.total_rejected += 1
+        if self.total_rejected > self.max_rejects:
+            raise error
+
+        if not self.reject_file:
+            self.reject_file = tempfile.NamedTemporaryFile(prefix='pyir_', suffix='.rejects.fasta', delete=False,
+                                                           dir=self.tmp_dir).name
+
+        header, seq = record
+        stderr_lines = error.stderr.strip().splitlines()
+        with open(self.reject_file, 'a') as fout:
+            fout.write('>{0} igblast_returncode={1} igblast_stderr="{2}"\n{3}\n'.format(
+                header, error.returncode, stderr_lines[-1] if stderr_lines else '', seq))
+
+    @staticmethod
+    def read_fasta(input_file):
+        """Returns the (header, sequence) pairs of a chunk fasta file"""
+        records = []
+        with open(input_file, 'r') as fin:
+            for line in fin:
+                if line.startswith('>'):
+                    records.append([line[1:].strip(), ''])
+                elif records:
+                    records[-1][1] += line.strip()
+
+        return records
+
+    def run_parser(self, parser, cmd, query):
+        """Runs one IgBLAST command through the parser with retries, discarding the output of failed runs"""
+        def run(piece):
+            state = parser.mark()
+            try:
+                parser.process(cmd + [piece])
+            except parsers.IgBlastError:
+                parser.rollback(state)
+                raise
+
+        self.run_with_recovery(run, query)
+
+    def run_chunk(self, parser, query):
+        self.run_parser(parser, self.collected_args, query)
+        parser.close()
+
+    def collect_records(self, parser, cmd, query):
+        """Returns the records of one IgBLAST command without writing them, with retries"""
+        results = self.run_with_recovery(lambda piece: list(parser.iter_records(cmd + [piece])), query)
+        return [d for records in results for d in records]
+
+    def run_two_pass(self, parser, query):
+        """Runs the fast pass over the whole chunk, reruns the ambiguous reads with full sensitivity and writes the
+        merged records in their original order"""
+        records = self.collect_records(parser, self.fast_args, query)
+
+        rerun_ids = set()
+        rerun_file = tempfile.NamedTemporaryFile(mode='w', prefix='pyir_', suffix='.fasta', delete=False,
+                                                 dir=self.tmp_dir)
+        with rerun_file:
+            for d in records:
+                if self.needs_rerun(d):
+                    rerun_ids.add(d['sequence_id'])
+                    rerun_file.write('>' + d['sequence_id'] + '\n' + d['sequence'] + '\n')
+
+        if self.debug:
+            print("rerunning", len(rerun_ids), "of", len(records), "sequences with full sensitivity")
+
+        if rerun_ids:
+            rerun = {d['sequence_id']: d for d in self.collect_records(parser, self.collected_args, rerun_file.name)}
+            records = [rerun.get(d['sequence_id'], d) for d in records]
+
+        for d in records:
+            parser.write_record(d)
+
+        parser.close()
 
     def get_seqs_dict(self, input_file):
         retval = {}
@@ -131,22 +295,29 @@ class IgBlastRun():
         else:
             query = input_file[0]
 
+        stats = report.ChunkStats(input_file, self.args['trace']) if self.args['report'] or self.args['trace'] \
+            else None
+
         output_file = tempfile.NamedTemporaryFile(prefix='pyir_', suffix=".json", delete=False, dir=self.tmp_dir).name
         if self.legacy:
             seqs = self.get_seqs_dict(input_file)
-            parser = parsers.LegacyParser(seqs, output_file, self.args)
+            parser = parsers.LegacyParser(seqs, output_file, self.args, stats, self.progress)
         else:
-            parser = parsers.AirrParser(output_file, self.args)
+            parser = parsers.AirrParser(output_file, self.args, stats, self.progress,
+                                        RERUN_FIELDS if self.two_pass else ())
 
-        collected_args = self.collected_args[:]
-        collected_args.append(query)
+        if self.progress:
+            with open(query, 'r') as fin:
+                self.progress.add(progress.SENT, sum(1 for line in fin if line.startswith('>')))
 
         # make sure this process is terminated on keyboard interrupt
         signal.signal(signal.SIGINT, self.signal_handler)
 
-        parser.parse(collected_args)
+        run = self.run_two_pass if self.two_pass else self.run_chunk
+        if stats:
+            run = stats.timed('chunk', run, span=True)
+        run(parser, query)
 
-        if self.args['outfmt'] == 'dict':
-            return parser.out_d, parser.total_parsed, input_file, parser.total_passed
-        else:
-            return output_file, parser.total_parsed, input_file, parser.total_passed
+        chunk_stats = stats.to_dict(parser) if stats else None
+        return parser.formatter.result(), parser.total_parsed, input_file, parser.total_passed, self.reject_file, \
+            chunk_stats
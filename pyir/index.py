@@ -0,0 +1,263 @@
+"""Byte-offset index of lsjson and TSV output.
+
+With --index, <output>.idx is written next to the output file. It maps each sequence_id to where its record starts
+and is sorted by sequence_id, so that IndexedOutput finds records by id, or by a range of ids, with a binary search
+over the memory-mapped index and reads only those records.
+
+Gzipped output is then written as independent gzip members of about BLOCK_SIZE bytes of records each, as bgzip does.
+Any gzip reader still reads it as one file, and a record is read by decompressing only its member. Each entry of the
+index has the offset of the record's member in the compressed file and of the record in the decompressed member. For
+uncompressed output the first is the offset of the record and the second is 0.
+
+The index is built in the pass that compresses the output, or in one read of it when it isn't compressed. Its entries
+are sorted in runs of SORT_RUN that are merged, so building it takes bounded memory."""
+import heapq
+import json
+import mmap
+import os
+import re
+import tempfile
+import zlib
+
+INDEX_EXTENSION = '.idx'
+INDEX_VERSION = 1
+FORMATS = ['lsjson', 'tsv']
+# Records are compressed in members of at least this many bytes, as in BGZF
+BLOCK_SIZE = 65536
+# gzip's default level, as the output is compressed with otherwise
+GZIP_LEVEL = 6
+# Index entries sorted in memory at once
+SORT_RUN = 1000000
+READ_SIZE = 65536
+
+# sequence_id is the first field of AIRR records, so it is read without parsing the rest of the line
+JSON_ID = re.compile(rb'\{\s*"sequence_id"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def index_file(path):
+    return path + INDEX_EXTENSION
+
+
+def record_id(line, id_column):
+    """The sequence_id of a record's line, id_column being its column in TSV output and None in lsjson output"""
+    if id_column is not None:
+        return line.split(b'\t', id_column + 1)[id_column].decode('utf-8')
+    match = JSON_ID.match(line)
+    if match:
+        return json.loads(match.group(1))
+    return json.loads(line)['sequence_id']
+
+
+def parse_entry(line):
+    sequence_id, start, offset = line.rstrip(b'\n').split(b'\t')
+    return sequence_id.decode('utf-8'), int(start), int(offset)
+
+
+def write_entries(fout, entries):
+    fout.writelines('{0}\t{1}\t{2}\n'.format(*entry).encode('utf-8') for entry in entries)
+
+
+class IndexWriter:
+    """Collects the entries of an index and writes them sorted by sequence_id"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.runs = []
+        self.total = 0
+
+    def add(self, sequence_id, start, offset):
+        self.entries.append((sequence_id, start, offset))
+        self.total += 1
+        if len(self.entries) >= SORT_RUN:
+            self.entries.sort()
+            with tempfile.NamedTemporaryFile(prefix='pyir_index_', dir=os.path.dirname(os.path.abspath(self.path)),
+                                             delete=False) as run:
+                write_entries(run, self.entries)
+            self.runs.append(run.name)
+            self.entries = []
+
+    def write(self, metadata):
+        """Writes the index with a first line holding metadata"""
+        self.entries.sort()
+        metadata = dict(metadata, version=INDEX_VERSION, records=self.total)
+        runs = [open(path, 'rb') for path in self.runs]
+        try:
+            with open(self.path, 'wb') as fout:
+                fout.write(('#' + json.dumps(metadata) + '\n').encode('utf-8'))
+                write_entries(fout, heapq.merge(self.entries, *[map(parse_entry, run) for run in runs]))
+        finally:
+            for run in runs:
+                run.close()
+                os.remove(run.name)
+
+
+def build(path, outfmt, compress):
+    """Indexes an lsjson or TSV output file. With compress, the file is replaced by its gzipped version, written in
+    members of BLOCK_SIZE, as gzip -f would. Returns the path of the indexed output file"""
+    output_path = path + '.gz' if compress else path
+    writer = IndexWriter(index_file(output_path))
+    metadata = {'format': outfmt, 'gzip': compress}
+    id_column = None
+
+    with open(path, 'rb') as fin:
+        header = b''
+        if outfmt == 'tsv':
+            header = fin.readline()
+            metadata['keys'] = header.decode('utf-8').rstrip('\n').split('\t')
+            id_column = metadata['keys'].index('sequence_id') if 'sequence_id' in metadata['keys'] else 0
+
+        if not compress:
+            position = len(header)
+            for line in fin:
+                writer.add(record_id(line, id_column), position, 0)
+                position += len(line)
+        else:
+            with open(output_path, 'wb') as fout:
+                block = [header]
+                block_size = len(header)
+                for line in fin:
+                    writer.add(record_id(line, id_column), fout.tell(), block_size)
+                    block.append(line)
+                    block_size += len(line)
+                    if block_size >= BLOCK_SIZE:
+                        write_member(fout, b''.join(block))
+                        block = []
+                        block_size = 0
+                if block_size:
+                    write_member(fout, b''.join(block))
+
+    writer.write(metadata)
+    if compress:
+        os.remove(path)
+    return output_path
+
+
+def write_member(fout, data):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    fout.write(compressor.compress(data) + compressor.flush())
+
+
+class IndexedOutput:
+    """Random access to the records of lsjson or TSV output written with --index, gzipped or not.
+
+    with IndexedOutput('example.json.gz') as results:
+        record = results['read_1']
+        records = results.fetch(['read_1', 'read_2'])
+        for record in results.id_range('read_100', 'read_199'):
+            ...
+
+    Records are dicts, as json.loads gives them for lsjson output and with every value a string for TSV output. If
+    several records have the same sequence_id, the first one written is returned"""
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_handle = open(index_path or index_file(path), 'rb')
+        self.metadata = json.loads(self.index_handle.readline()[1:])
+        if self.metadata.get('version') != INDEX_VERSION:
+            raise ValueError('{0} is not a PyIR index of version {1}'.format(self.index_handle.name, INDEX_VERSION))
+        self.index = mmap.mmap(self.index_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.entries_start = self.index_handle.tell()
+
+        self.fin = open(path, 'rb')
+        self.gzip = self.metadata['gzip']
+        self.data = None if self.gzip or not os.path.getsize(path) else \
+            mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = self.metadata.get('keys')
+        # The last gzip member read, as (offset, decompressed data)
+        self.block = (None, None)
+
+    def close(self):
+        for view in (self.index, self.data):
+            if view is not None:
+                view.close()
+        self.index_handle.close()
+        self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.metadata['records']
+
+    def __contains__(self, sequence_id):
+        return self.find(sequence_id) is not None
+
+    def __getitem__(self, sequence_id):
+        entry = self.find(sequence_id)
+        if entry is None:
+            raise KeyError(sequence_id)
+        return self.read(entry)
+
+    def get(self, sequence_id, default=None):
+        entry = self.find(sequence_id)
+        return default if entry is None else self.read(entry)
+
+    def fetch(self, sequence_ids):
+        """The records of the ids found, by id. Records are read in file order, so that each gzip member is only
+        decompressed once however many of the records are in it"""
+        entries = [entry for entry in map(self.find, set(sequence_ids)) if entry is not None]
+        entries.sort(key=lambda entry: entry[1:])
+        return {entry[0]: self.read(entry) for entry in entries}
+
+    def id_range(self, first, last):
+        """Yields the records whose sequence_id is between first and last, both included, in sequence_id order"""
+        target = last.encode('utf-8')
+        position = self.seek(first)
+        while position < len(self.index):
+            end = self.index.find(b'\n', position)
+            line = self.index[position:end]
+            if line[:line.index(b'\t')] > target:
+                break
+            yield self.read(parse_entry(line))
+            position = end + 1
+
+    def seek(self, sequence_id):
+        """The position in the index of the first entry whose id isn't before sequence_id"""
+        target = sequence_id.encode('utf-8')
+        low, high = self.entries_start, len(self.index)
+        while low < high:
+            middle = (low + high) // 2
+            start = self.index.rfind(b'\n', low, middle) + 1 or low
+            end = self.index.find(b'\n', start)
+            if self.index[start:self.index.find(b'\t', start)] < target:
+                low = end + 1
+            else:
+                high = start
+        return low
+
+    def find(self, sequence_id):
+        """The index entry (sequence_id, start, offset) of a record, or None"""
+        position = self.seek(sequence_id)
+        if position >= len(self.index):
+            return None
+        entry = parse_entry(self.index[position:self.index.find(b'\n', position)])
+        return entry if entry[0] == sequence_id else None
+
+    def read(self, entry):
+        sequence_id, start, offset = entry
+        if self.gzip:
+            data = self.read_block(start)
+            start = offset
+        else:
+            data = self.data
+        end = data.find(b'\n', start)
+        line = data[start:end if end >= 0 else len(data)]
+        if self.keys is None:
+            return json.loads(line)
+        return dict(zip(self.keys, line.decode('utf-8').split('\t')))
+
+    def read_block(self, start):
+        """Decompresses the gzip member starting at start"""
+        if self.block[0] != start:
+            self.fin.seek(start)
+            decompressor = zlib.decompressobj(31)
+            pieces = []
+            while not decompressor.eof:
+                data = self.fin.read(READ_SIZE)
+                if not data:
+                    break
+                pieces.append(decompressor.decompress(data))
+            self.block = (start, b''.join(pieces))
+        return self.block[1]
@@ -1,29 +1,307 @@
 import json
+import operator
+import re
 from abc import ABCMeta, abstractmethod
 
+from . import columnar, records, sort
+
+# Records formatted before they are written to the chunk file in one call
+BATCH_SIZE = 1000
+
+
+def json_encoder(args):
+    """Returns the function that turns a record into JSON text.
+
+    By default the output of the json module is kept byte for byte. With --fast_json records are written compactly,
+    without spaces after separators and with non-ASCII characters left unescaped, using orjson when it is installed
+    and the json module otherwise. Pretty output always uses the json module"""
+    if args['pretty']:
+        return lambda d: json.dumps(d, indent=4, separators=(',', ':'))
+    elif not args.get('fast_json'):
+        return json.dumps
+
+    try:
+        import orjson
+    except ImportError:
+        return json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+    dumps = orjson.dumps
+    return lambda d: dumps(d).decode('utf-8')
+
 
 class BaseFormatter:
+    """Writes the records of one chunk to its output.
+
+    mark() returns the state of the output, and rollback(state) discards everything written after it"""
     __metaclass__ = ABCMeta
 
-    def __init__(self, args):
+    def __init__(self, out_file, args):
+        self.out_file = out_file
         self.args = args
 
+    def set_keys(self, keys):
+        """Called with the output fields of AIRR records before the first record is written"""
+        pass
+
     @abstractmethod
-    def format(self, parser_output, args):
+    def write(self, d):
+        pass
+
+    @abstractmethod
+    def mark(self):
+        pass
+
+    @abstractmethod
+    def rollback(self, state):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def result(self):
+        """What the worker returns for the chunk, by default the chunk's output file"""
+        return self.out_file
+
+
+class TextFormatter(BaseFormatter):
+    """Formats records as text and writes them to the chunk file in batches of BATCH_SIZE. With --sort_by the records
+    are kept until the chunk is closed, then written sorted along with their keys file"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.fout = open(out_file, 'w')
+        self.batch = []
+        self.sort_key = sort.record_key(args['sort_by']) if args.get('sort_by') else None
+        self.sorted = []
+
+    @abstractmethod
+    def format(self, d):
+        pass
+
+    def write(self, d):
+        if self.sort_key:
+            self.sorted.append((self.sort_key(d), self.format(d)))
+            return
+        self.batch.append(self.format(d))
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.fout.write(''.join(self.batch))
+            self.batch = []
+
+    def mark(self):
+        self.flush()
+        return self.fout.tell(), len(self.sorted)
+
+    def rollback(self, state):
+        position, length = state
+        self.batch = []
+        del self.sorted[length:]
+        self.fout.seek(position)
+        self.fout.truncate()
+
+    def close(self):
+        self.flush()
+        if self.sort_key:
+            with open(sort.keys_file(self.out_file), 'w') as fkeys:
+                sort.write_text_run(self.fout, fkeys, sorted(self.sorted, key=operator.itemgetter(0)))
+        self.fout.close()
+
+
+class LsJsonFormatter(TextFormatter):
+    """One JSON object per line"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.encode = json_encoder(args)
+
+    def format(self, d):
+        return self.encode(d) + '\n'
+
+
+class JsonFormatter(LsJsonFormatter):
+    """JSON objects separated by commas, put in an array when the chunks are concatenated"""
+    def format(self, d):
+        return self.encode(d) + ',\n'
+
+
+class TsvFormatter(TextFormatter):
+    """Tab-separated values with a header line. Also the chunk format of SQLite output"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.keys = []
+
+    def set_keys(self, keys):
+        self.keys = list(keys)
+        self.batch.append('\t'.join(self.keys) + '\n')
+
+    def format(self, d):
+        return '\t'.join([str(d[key]) for key in self.keys]) + '\n'
+
+
+class DictFormatter(BaseFormatter):
+    """Keeps the records in memory, by sequence id"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.out_d = {}
+
+    def write(self, d):
+        self.out_d[d['sequence_id']] = d
+
+    def mark(self):
+        return len(self.out_d)
+
+    def rollback(self, state):
+        while len(self.out_d) > state:
+            self.out_d.popitem()
+
+    def close(self):
         pass
 
+    def result(self):
+        """The records, or with --shared_memory the shared memory segment they were packed into"""
+        if self.args.get('shared_memory') and self.out_d:
+            try:
+                return records.SharedRecords.send(self.out_d)
+            except ValueError:
+                pass
+        return self.out_d
+
+
+class CompactDictFormatter(DictFormatter):
+    """Keeps the records in memory as compact records, by sequence id. Records that can't be compacted are kept as
+    dicts"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.fields = {}
+        self.ints = {}
+        self.codec = records.default_codec()
+
+    def write(self, d):
+        names = tuple(d)
+        fields = self.fields.get(names)
+        if fields is None:
+            fields = self.fields[names] = records.RecordKeys(names, self.codec)
+        try:
+            self.out_d[d['sequence_id']] = records.CompactRecord.from_dict(d, fields, self.ints)
+        except ValueError:
+            self.out_d[d['sequence_id']] = d
+
+
+class ColumnarFormatter(BaseFormatter):
+    """Collects the records in typed columns, written as Arrow record batches when the chunk is closed"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.columns = columnar.ColumnBuffer()
+
+    def set_keys(self, keys):
+        self.columns.set_keys(keys)
+
+    def write(self, d):
+        self.columns.append(d)
 
-class JsonFormatter(BaseFormatter):
-    def format(self, parser_output):
-        return json.dumps(parser_output, indent=4, separators=(',',':')) if self.args['pretty'] else json.dumps(parser_output)
+    def write_table(self, table):
+        """Writes a table of records built by the batch path"""
+        self.columns.append_table(table)
 
+    def mark(self):
+        return len(self.columns)
 
+    def rollback(self, state):
+        self.columns.truncate(state)
+
+    def close(self):
+        if self.args.get('sort_by'):
+            self.columns.sort(self.args['sort_by'])
+        self.columns.write(self.out_file)
+
+
+def partition_name(value):
+    """The name of the partition of records with value in the --partition_by field, as used in file names"""
+    if isinstance(value, bool):
+        value = 'T' if value else 'F'
+    name = re.sub(r'[^\w.-]', '_', '' if value is None else str(value))
+    return name or 'unassigned'
+
+
+class PartitionedFormatter(BaseFormatter):
+    """Routes each record to the formatter of its partition, by the value of the --partition_by field. Every
+    partition has its own chunk file, named after the chunk's, and its own buffer. result() returns the result of each
+    partition by name"""
+    def __init__(self, out_file, args):
+        super().__init__(out_file, args)
+        self.field = args['partition_by']
+        self.keys = None
+        self.partitions = {}
+        # The state of each partition when it was created, which rolling back past its creation returns it to
+        self.created = {}
+
+    def partition(self, name):
+        formatter = self.partitions.get(name)
+        if formatter is None:
+            formatter = self.partitions[name] = new_formatter('{0}.{1}'.format(self.out_file, name), self.args)
+            if self.keys is not None:
+                formatter.set_keys(self.keys)
+            self.created[name] = formatter.mark()
+        return formatter
+
+    def set_keys(self, keys):
+        self.keys = keys
+        for formatter in self.partitions.values():
+            formatter.set_keys(keys)
+
+    def write(self, d):
+        self.partition(partition_name(d.get(self.field))).write(d)
+
+    def write_table(self, table):
+        """Splits a table of records built by the batch path between the partitions"""
+        import pyarrow.compute as pc
+
+        if self.field not in table.schema.names:
+            self.partition(partition_name(None)).write_table(table)
+            return
+        column = table.column(self.field)
+        for value in pc.unique(column).to_pylist():
+            mask = pc.is_null(column) if value is None else pc.equal(column, value)
+            self.partition(partition_name(value)).write_table(table.filter(mask))
+
+    def mark(self):
+        return {name: formatter.mark() for name, formatter in self.partitions.items()}
+
+    def rollback(self, state):
+        for name, formatter in self.partitions.items():
+            formatter.rollback(state.get(name, self.created[name]))
+
+    def close(self):
+        for formatter in self.partitions.values():
+            formatter.close()
+
+    def result(self):
+        return {name: formatter.result() for name, formatter in self.partitions.items()}
+
+
+# Adding an output format only needs a formatter here and a choice of --outfmt
 format_type_mapping = {
+    'lsjson': LsJsonFormatter,
     'json': JsonFormatter,
+    'tsv': TsvFormatter,
+    'sqlite': TsvFormatter,
+    'dict': DictFormatter,
+    'parquet': ColumnarFormatter,
+    'arrow': ColumnarFormatter
 }
 
 
-def get_formatter(args):
-    """Returns formatter class given the command line arguments"""
-    return format_type_mapping[args['out_format']](args)
+def get_formatter(out_file, args):
+    """Returns the formatter of the output format given in the command line arguments"""
+    if args.get('partition_by'):
+        return PartitionedFormatter(out_file, args)
+    return new_formatter(out_file, args)
+
 
+def new_formatter(out_file, args):
+    """Returns the formatter writing a single output file in the output format"""
+    if args['outfmt'] == 'dict' and args.get('compact_dict'):
+        return CompactDictFormatter(out_file, args)
+    return format_type_mapping[args['outfmt']](out_file, args)
@@ -1,10 +1,12 @@
 from abc import ABCMeta, abstractmethod
 import collections
-import json
 import os
 import re
-from . import filters
+from . import columnar, filters, output
 import subprocess
+import tempfile
+import time
+from .report import children_cpu_time
 
 REVERSE_COMPLEMENT = {
     'A': 'T',
@@ -15,6 +17,70 @@ REVERSE_COMPLEMENT = {
 
 IGBLAST_TSV_HEADER = ['sequence_id','sequence','locus','stop_codon','vj_in_frame','v_frameshift','productive','rev_comp','complete_vdj','v_call','d_call','j_call','sequence_alignment','germline_alignment','sequence_alignment_aa','germline_alignment_aa','v_alignment_start','v_alignment_end','d_alignment_start','d_alignment_end','j_alignment_start','j_alignment_end','v_sequence_alignment','v_sequence_alignment_aa','v_germline_alignment','v_germline_alignment_aa','d_sequence_alignment','d_sequence_alignment_aa','d_germline_alignment','d_germline_alignment_aa','j_sequence_alignment','j_sequence_alignment_aa','j_germline_alignment','j_germline_alignment_aa','fwr1','fwr1_aa','cdr1','cdr1_aa','fwr2','fwr2_aa','cdr2','cdr2_aa','fwr3','fwr3_aa','fwr4','fwr4_aa','cdr3','cdr3_aa','junction','junction_length','junction_aa','junction_aa_length','v_score','d_score','j_score','v_cigar','d_cigar','j_cigar','v_support','d_support','j_support','v_identity','d_identity','j_identity','v_sequence_start','v_sequence_end','v_germline_start','v_germline_end','d_sequence_start','d_sequence_end','d_germline_start','d_germline_end','j_sequence_start','j_sequence_end','j_germline_start','j_germline_end','fwr1_start','fwr1_end','cdr1_start','cdr1_end','fwr2_start','fwr2_end','cdr2_start','cdr2_end','fwr3_start','fwr3_end','fwr4_start','fwr4_end','cdr3_start','cdr3_end','np1','np1_length','np2','np2_length']
 
+# Fields PyIR adds to the end of every AIRR record
+PYIR_FIELDS = ['v_family', 'd_family', 'j_family', 'c_family', 'cdr3_aa_length']
+# The PyIR family fields and the IgBLAST calls they are taken from
+FAMILY_FIELDS = [('v_family', 'v_call'), ('d_family', 'd_call'), ('j_family', 'j_call'), ('c_family', 'c_call')]
+# The FWR4 fields PyIR fills in when IgBLAST leaves them empty, and the fields it needs to do so
+FWR4_FIELDS = ['fwr4', 'fwr4_aa', 'fwr4_start', 'fwr4_end']
+FWR4_INPUTS = ['cdr3', 'cdr3_aa', 'productive', 'sequence', 'sequence_alignment', 'sequence_alignment_aa']
+
+# Only the end of IgBLAST's stderr is kept when it fails
+MAX_STDERR_BYTES = 8192
+
+
+def text_after(alignment, region):
+    """The part of an alignment after the first occurrence of region, or None if region isn't in it. region is
+    matched as plain text, not as a regular expression, and again against the alignment without its gaps when a gap
+    falls inside it"""
+    index = alignment.find(region)
+    if index >= 0:
+        return alignment[index + len(region):]
+
+    if '-' in alignment:
+        ungapped = alignment.replace('-', '')
+        index = ungapped.find(region)
+        if index >= 0:
+            return ungapped[index + len(region):]
+    return None
+
+
+class IgBlastError(RuntimeError):
+    """Raised when IgBLAST exits with a non-zero return code"""
+    def __init__(self, returncode, stderr):
+        super().__init__(returncode, stderr)
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def __str__(self):
+        return "IgBLAST exited with return code {0}: {1}".format(self.returncode, self.stderr.strip())
+
+
+def run_igblast(cmd, igdata, stats=None):
+    """Runs IgBLAST and yields its output lines. stderr goes to a temporary file rather than a pipe so that a noisy
+    IgBLAST can't block, and the end of it is attached to the IgBlastError raised if IgBLAST fails.
+
+    If a report.ChunkStats is given, the time spent waiting on IgBLAST is added to it"""
+    with tempfile.TemporaryFile() as stderr:
+        if stats:
+            start = time.perf_counter()
+            children_cpu = children_cpu_time()
+
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                                   universal_newlines=True, env=dict(os.environ, IGDATA=igdata))
+        for line in (stats.timed_lines(process.stdout, start) if stats else process.stdout):
+            yield line
+
+        process.stdout.close()
+        returncode = process.wait()
+        if stats:
+            stats.add_igblast_run(start, children_cpu, process.pid)
+
+        if returncode != 0:
+            stderr.seek(max(0, stderr.tell() - MAX_STDERR_BYTES))
+            raise IgBlastError(process.returncode, stderr.read().decode(errors='replace'))
+
+
 class BaseParser:
     """Parsing super class used by parsers below.
 
@@ -570,41 +636,50 @@ class AlignmentParser(BaseParser):
 class LegacyParser():
     """This class manages the overall parsing, including what parsers and filters are being included"""
 
-    def __init__(self, seq_dict, out_file, args):
+    def __init__(self, seq_dict, out_file, args, stats=None, progress=None):
         self.args = args
+        self.stats = stats
+        self.progress = progress
 
-        if self.args['outfmt'] in ['lsjson', 'json']:
-            self.out_file = open(out_file, 'w')
-        elif self.args['outfmt'] == 'dict':
-            self.out_d = collections.OrderedDict()
-        elif self.args['outfmt'] == 'tsv':
+        if self.args['outfmt'] == 'tsv':
             raise NotImplementedError("TSV outputting unsupported with legacy output; use non-legacy mode")
+        self.formatter = output.get_formatter(out_file, args)
 
-        self.current_d = collections.OrderedDict()
+        self.seq_dict = seq_dict
         self.filters = filters.PyIRFilters(args)
 
         self.total_parsed = 0
         self.total_passed = 0
         self.end_regex = re.compile('^Effective search space used:.*$')
+        self.reset_parsers()
+
+        if self.stats:
+            self.filters.run_filters = self.stats.timed('filter', self.filters.run_filters)
+            self.write_record = self.stats.timed('write', self.write_record)
+
+    def reset_parsers(self):
+        self.current_d = collections.OrderedDict()
 
         # The parsers must be initialized in order of appearance in BLAST output for PyIR to work
         self.parsers = [
-            QueryParser(seq_dict),
+            QueryParser(self.seq_dict),
             SignificantAlignmentParser(),
             VDJSummaryParser(),
             AlignmentSummaryParser(),
-            AlignmentParser(args['input_type'], seq_dict)
+            AlignmentParser(self.args['input_type'], self.seq_dict)
         ]
 
     def parse(self, cmd):
+        self.process(cmd)
+        self.close()
+
+    def process(self, cmd):
+        """Runs IgBLAST and writes every parsed record that passes the filters"""
         previous_line_whitespace = False
         parser_index = 0
         triggered = False
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                                   universal_newlines=True, env=dict(os.environ, IGDATA=self.args['igdata']))
-
-        for line in process.stdout:
+        for line in run_igblast(cmd, self.args['igdata'], self.stats):
             if line.isspace():
                 previous_line_whitespace = True
                 continue
@@ -639,145 +714,247 @@ class LegacyParser():
 
             # If we match with the ending line, save our results and reset for next sequence
             if re.match(self.end_regex, line):
-                should_write = True
-                did_parse = True
                 if 'additional_field' in self.args and self.args['additional_field']:
                     self.current_d[self.args['additional_field'][0]] = self.args['additional_field'][1]
 
-                if self.args['enable_filter']:
-                    should_write = self.filters.run_filters(self.current_d)
-
-                if should_write:
-                    if self.args['outfmt'] == 'lsjson':
-                        if self.args['pretty']:
-                            self.out_file.write(json.dumps(self.current_d, indent=4, separators=(',', ':')) + '\n')
-                        else:
-                            self.out_file.write(json.dumps(self.current_d) + '\n')
-                    elif self.args['outfmt'] == 'json':
-                        if self.args['pretty']:
-                            self.out_file.write(json.dumps(self.current_d, indent=4, separators=(',', ':')) + ',\n')
-                        else:
-                            self.out_file.write(json.dumps(self.current_d) + ',\n')
-                    elif self.args['outfmt'] == 'dict':
-                        self.out_d[self.current_d['sequence_id']] = self.current_d
-
-                    self.total_passed += 1
+                self.write_record(self.current_d)
 
                 self.current_d = {}
-                self.total_parsed += 1
                 parser_index = 0
 
-        self.out_file.close()
+    def write_record(self, d):
+        """Filters a single parsed record and writes it to the output if it passes"""
+        should_write = True
+        if self.filters.active:
+            should_write = self.filters.run_filters(d)
+
+        if should_write:
+            self.formatter.write(d)
+            self.total_passed += 1
+
+        self.total_parsed += 1
+        if self.progress:
+            self.progress.add_record(should_write)
+
+    def mark(self):
+        """Returns the output state, so that the records from a failed IgBLAST run can be discarded by rollback"""
+        return self.formatter.mark(), self.total_parsed, self.total_passed
+
+    def rollback(self, state):
+        position, self.total_parsed, self.total_passed = state
+        self.formatter.rollback(position)
+        self.reset_parsers()
+
+    def close(self):
+        self.formatter.close()
 
 
 class AirrParser():
-    def __init__(self, out_file, args):
+    """Parses IgBLAST's AIRR output. needed_fields are fields the caller reads from the records of iter_records,
+    which are kept even when --fields leaves them out of the output"""
+    def __init__(self, out_file, args, stats=None, progress=None, needed_fields=()):
         self.args = args
+        self.stats = stats
+        self.progress = progress
+        self.needed_fields = set(needed_fields)
         self.total_parsed = 0
         self.total_passed = 0
 
         self.header_keys = []
         self.out_keys = []
 
-        if self.args['outfmt'] == 'dict':
-            self.out_d = {}
-        else:
-            self.out_file = open(out_file, 'w')
+        # What is built for each record, set from the IgBLAST header by set_keys. Without --fields it is everything
+        self.columns = None
+        self.families = FAMILY_FIELDS
+        self.cdr3_aa_length = True
+        self.recover_fwr4 = True
+        self.project = False
+        # The filters compiled for IgBLAST's raw columns, set by set_keys when the filters allow it
+        self.row_filter = None
 
+        self.formatter = output.get_formatter(out_file, args)
         self.filters = filters.PyIRFilters(args)
 
+        # The vectorized path of columnar output, processing --batch_size rows at a time. Filters it can't evaluate
+        # over columns keep the per-record path
+        self.batch = None
+        if self.args.get('batch_size') and self.args['outfmt'] in columnar.FORMATS:
+            from .batch import BatchProcessor
+            try:
+                self.batch = BatchProcessor(self, self.args['batch_size'])
+            except NotImplementedError:
+                pass
+
+        if self.stats:
+            self.filters.run_filters = self.stats.timed('filter', self.filters.run_filters)
+            self.write_record = self.stats.timed('write', self.write_record)
+
     def parse(self, cmd):
-        first = True
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                                   universal_newlines=True, env=dict(os.environ, IGDATA=self.args['igdata']))
-        for line in process.stdout:
-            #Take line from input and split by tab
-            linesplit = line.strip('\n').split('\t')
+        self.process(cmd)
+        self.close()
+
+    def process(self, cmd):
+        """Runs IgBLAST and writes every parsed record that passes the filters. Records are checked on their raw
+        columns when possible, so the rejected ones are never built"""
+        if self.batch is not None:
+            lines = []
+            for line in self.iter_lines(cmd):
+                lines.append(line)
+                if len(lines) == self.batch.size:
+                    self.batch.process(lines)
+                    lines = []
+            if lines:
+                self.batch.process(lines)
+            return
 
-            #
-            # Main parsing function
-            ########################################################
+        for d in self.iter_records(cmd, prefilter=True):
+            self.write_record(d, filtered=self.row_filter is not None)
 
+    def iter_lines(self, cmd):
+        """Runs IgBLAST and yields each line of its output after the header, setting the keys from the header"""
+        first = not self.header_keys
+        for line in run_igblast(cmd, self.args['igdata'], self.stats):
             # This first check is to see if it's the first line of the file, if so we need to set up the dictionary by
             # reading in the keys. Otherwise, we parse as expected
             if first:
-                # Parse the keys from the tsv
-                for key in linesplit:
-                    self.header_keys.append(key)
-                    self.out_keys.append(key)
-
-                # If the user has provided an additional field, add it to the keys
-                if 'additional_field' in self.args and self.args['additional_field']:
-                    self.out_keys.extend([self.args['additional_field'][0]])
-
-                # Add PyIR fields to the keys at the end
-                self.out_keys.extend(['v_family', 'd_family', 'j_family', 'c_family', 'cdr3_aa_length'])
-
-                if self.args['outfmt'] == 'tsv':
-                    self.out_file.write('\t'.join(self.out_keys) + '\n')
-
+                self.set_keys(line.strip('\n').split('\t'))
                 first = False
+            elif not self.header_keys or (line.startswith(self.header_keys[0] + '\t') and
+                                          line.strip('\n').split('\t') == self.header_keys):
+                # Header line of a later IgBLAST run through the same parser
                 continue
             else:
-                d = {self.out_keys[index]: linesplit[index] for index in range(0, len(self.header_keys))}
+                yield line
 
-                should_write = True
-                if 'additional_field' in self.args and self.args['additional_field']:
-                    d[self.args['additional_field'][0]] = self.args['additional_field'][1]
+    def iter_rows(self, cmd):
+        """Runs IgBLAST and yields the columns of each row of its output"""
+        for line in self.iter_lines(cmd):
+            #Take line from input and split by tab
+            yield line.strip('\n').split('\t')
+
+    def iter_records(self, cmd, prefilter=False):
+        """Runs IgBLAST and yields each AIRR record with the PyIR-specific fields added, without filtering or
+        writing it. Useful when records from several IgBLAST runs need to be combined before output. With prefilter
+        set, records that fail the filters on their raw columns are counted and skipped instead"""
+        for linesplit in self.iter_rows(cmd):
+            if prefilter and self.row_filter is not None and not self.row_filter(linesplit):
+                self.count_record(False)
+                continue
+
+            if self.columns is None:
+                d = dict(zip(self.header_keys, linesplit))
+            else:
+                d = {key: linesplit[index] for key, index in self.columns}
 
-                if self.args['enable_filter']:
-                    should_write = self.filters.run_filters(d)
+            if 'additional_field' in self.args and self.args['additional_field']:
+                d[self.args['additional_field'][0]] = self.args['additional_field'][1]
 
-                #
-                # This is where we generate PyIR-specific values
+            #
+            # This is where we generate PyIR-specific values
 
-                d['v_family'] = d['v_call'].split(',')[0].split('*')[0]
-                d['d_family'] = d['d_call'].split(',')[0].split('*')[0]
-                d['j_family'] = d['j_call'].split(',')[0].split('*')[0]
-                d['c_family'] = d['c_call'].split(',')[0].split('*')[0]
+            for family, call in self.families:
+                d[family] = d[call].split(',')[0].split('*')[0]
+            if self.cdr3_aa_length:
                 d['cdr3_aa_length'] = len(d['cdr3_aa'])
 
-                # FR4 check
-                if not d['fwr4'] and not d['fwr4_aa']:
-                    if d['cdr3'] and d['cdr3_aa'] and d['productive'] == 'T':
-                        matched_cdr3 = re.search(d['cdr3'], d['sequence_alignment'])
-                        matched_cdr3_aa = re.search(d['cdr3_aa'], d['sequence_alignment_aa'])
-                        if matched_cdr3 and matched_cdr3_aa:
-                            d['fwr4'] = d['sequence_alignment'][matched_cdr3.end():]
-                            d['fwr4_aa'] = d['sequence_alignment_aa'][matched_cdr3_aa.end():]
-                            if d['fwr4'] and d['fwr4_aa']:
-                                d['fwr4'] = d['fwr4'].replace('-', '')
-                                if re.search(d['fwr4'], d['sequence']):
-                                    d['fwr4_start'] = re.search(d['fwr4'], d['sequence']).start()+1
-                                    d['fwr4_end'] = re.search(d['fwr4'], d['sequence']).end()
-
-                if should_write:
-                    if self.args['outfmt'] == 'lsjson':
-                        if self.args['pretty']:
-                            self.out_file.write(json.dumps(d, indent=4, separators=(',', ':')) + '\n')
-                        else:
-                            self.out_file.write(json.dumps(d) + '\n')
-                    elif self.args['outfmt'] == 'json':
-                        if self.args['pretty']:
-                            self.out_file.write(json.dumps(d, indent=4, separators=(',', ':')) + ',\n')
-                        else:
-                            self.out_file.write(json.dumps(d) + ',\n')
-                    elif self.args['outfmt'] == 'tsv':
-                        # Okay this seems really unnecessary to vomit the info back out from the .tsv format through
-                        # a dictionary back into a .tsv format but it's helpful for standardization and the additional
-                        # fields in the code
-                        for index in range(0, len(self.out_keys)):
-                            if index == 0:
-                                self.out_file.write(str(d[self.out_keys[index]]))
-                            else:
-                                self.out_file.write('\t' + str(d[self.out_keys[index]]))
-                        self.out_file.write('\n')
-                    elif self.args['outfmt'] == 'dict':
-                        self.out_d[d['sequence_id']] = d
-
-                    self.total_passed += 1
-
-                self.total_parsed += 1
-
-        if self.args['outfmt'] != 'dict':
-            self.out_file.close()
+            if self.recover_fwr4:
+                self.fill_fwr4(d)
+
+            yield d
+
+    @staticmethod
+    def fill_fwr4(d):
+        """Fills in FWR4 from the end of the alignment when IgBLAST left it empty for a productive record"""
+        # FR4 check
+        if d['fwr4'] or d['fwr4_aa'] or not d['cdr3'] or not d['cdr3_aa'] or d['productive'] != 'T':
+            return
+
+        fwr4 = text_after(d['sequence_alignment'], d['cdr3'])
+        fwr4_aa = text_after(d['sequence_alignment_aa'], d['cdr3_aa'])
+        if fwr4 is None or fwr4_aa is None:
+            return
+
+        d['fwr4'] = fwr4
+        d['fwr4_aa'] = fwr4_aa
+        if fwr4 and fwr4_aa:
+            d['fwr4'] = fwr4 = fwr4.replace('-', '')
+            start = d['sequence'].find(fwr4)
+            if start >= 0:
+                d['fwr4_start'] = start + 1
+                d['fwr4_end'] = start + len(fwr4)
+
+    def set_keys(self, header):
+        """Sets the output fields from IgBLAST's header line. With --fields, works out which IgBLAST columns have
+        to be read and which PyIR fields computed for the requested fields, the filters and the caller"""
+        self.header_keys = list(header)
+        additional_field = self.args['additional_field'][0] if 'additional_field' in self.args and \
+            self.args['additional_field'] else None
+
+        unknown = [key for key in self.filters.fields() if key not in self.header_keys and key not in PYIR_FIELDS
+                   and key != additional_field]
+        if unknown:
+            raise ValueError("Unknown field(s) in --filter_expression: {0}".format(', '.join(sorted(unknown))))
+        if self.filters.active:
+            constants = {additional_field: self.args['additional_field'][1]} if additional_field else {}
+            self.row_filter = self.filters.row_filter(self.header_keys, constants)
+            if self.row_filter is not None and self.stats:
+                self.row_filter = self.stats.timed('prefilter', self.row_filter)
+
+        if not self.args.get('fields'):
+            self.out_keys = self.header_keys + ([additional_field] if additional_field else []) + PYIR_FIELDS
+            self.formatter.set_keys(self.out_keys)
+            return
+
+        self.out_keys = list(self.args['fields'])
+        if additional_field and additional_field not in self.out_keys:
+            self.out_keys.append(additional_field)
+        unknown = [key for key in self.out_keys if key not in self.header_keys and key not in PYIR_FIELDS and
+                   key != additional_field]
+        if unknown:
+            raise ValueError("Unknown field(s) in --fields: {0}".format(', '.join(unknown)))
+
+        keep = set(self.out_keys) | self.filters.fields() | self.needed_fields
+        self.families = [(family, call) for family, call in FAMILY_FIELDS if family in keep]
+        keep.update(call for family, call in self.families)
+        self.cdr3_aa_length = 'cdr3_aa_length' in keep
+        self.recover_fwr4 = bool(keep & set(FWR4_FIELDS))
+        if self.cdr3_aa_length:
+            keep.add('cdr3_aa')
+        if self.recover_fwr4:
+            keep.update(FWR4_FIELDS + FWR4_INPUTS)
+
+        self.columns = [(key, index) for index, key in enumerate(self.header_keys) if key in keep]
+        # Fields only needed internally are dropped again when the record is written
+        self.project = keep != set(self.out_keys)
+        self.formatter.set_keys(self.out_keys)
+
+    def write_record(self, d, filtered=False):
+        """Filters a single parsed record and writes it to the output if it passes. filtered is set when the record
+        already passed the filters on its raw columns"""
+        should_write = True
+        if self.filters.active and not filtered:
+            should_write = self.filters.run_filters(d)
+
+        if should_write:
+            if self.project:
+                d = {key: d[key] for key in self.out_keys}
+            self.formatter.write(d)
+            self.total_passed += 1
+
+        self.count_record(should_write)
+
+    def count_record(self, passed):
+        self.total_parsed += 1
+        if self.progress:
+            self.progress.add_record(passed)
+
+    def mark(self):
+        """Returns the output state, so that the records from a failed IgBLAST run can be discarded by rollback"""
+        return self.formatter.mark(), self.total_parsed, self.total_passed, self.header_keys[:], self.out_keys[:]
+
+    def rollback(self, state):
+        position, self.total_parsed, self.total_passed, self.header_keys, self.out_keys = state
+        self.formatter.rollback(position)
+
+    def close(self):
+        self.formatter.close()
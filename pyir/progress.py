@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+# Counters shared by the parent and the workers, in pipeline order
+COUNTERS = ['read', 'sent', 'parsed', 'passed', 'written']
+READ, SENT, PARSED, PASSED, WRITTEN = range(len(COUNTERS))
+
+
+class Progress:
+    """Live sequence counts shared between the parent and the worker processes.
+
+    Every process gets its own slot of counters in shared memory, so workers can count each record without locking;
+    the parent adds the slots up when it reports progress. Slot 0 belongs to the parent. The counters are created in
+    the multiprocessing context the worker pool will use."""
+    def __init__(self, num_workers, context):
+        self.num_slots = num_workers + 1
+        self.counts = context.RawArray('q', self.num_slots * len(COUNTERS))
+        self.next_slot = context.Value('i', 1)
+        self.offset = 0
+
+    def attach(self):
+        """Claims a slot for the current worker process"""
+        with self.next_slot.get_lock():
+            slot = self.next_slot.value
+            self.next_slot.value += 1
+
+        # A worker that replaces a dead one shares a slot with it, which is safe since they never run together
+        self.offset = (1 + (slot - 1) % (self.num_slots - 1)) * len(COUNTERS)
+
+    def add(self, counter, amount=1):
+        self.counts[self.offset + counter] += amount
+
+    def add_record(self, passed):
+        self.counts[self.offset + PARSED] += 1
+        if passed:
+            self.counts[self.offset + PASSED] += 1
+
+    def totals(self):
+        totals = [0] * len(COUNTERS)
+        for index, count in enumerate(self.counts):
+            totals[index % len(COUNTERS)] += count
+        return dict(zip(COUNTERS, totals))
+
+
+class ProgressMonitor:
+    """Reports the shared Progress counts from a background thread of the parent every interval seconds: to a
+    callback, to a tqdm progress bar and to a metrics file in the Prometheus text format"""
+    def __init__(self, progress, total, interval=1.0, callback=None, metrics_file=None, pbar=None):
+        self.progress = progress
+        self.total = total
+        self.interval = interval
+        self.callback = callback
+        self.metrics_file = metrics_file
+        self.pbar = pbar
+        self.start_time = time.time()
+        self.last_parsed = 0
+        self.last_change = self.start_time
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='pyir-progress', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread, reporting the counts one last time"""
+        self.stop_event.set()
+        self.thread.join()
+        self.update()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def snapshot(self, finished=False):
+        """Returns the current counts with throughput, ETA and how long it has been since a record was parsed"""
+        now = time.time()
+        snapshot = self.progress.totals()
+        if snapshot['parsed'] != self.last_parsed:
+            self.last_parsed = snapshot['parsed']
+            self.last_change = now
+
+        elapsed = now - self.start_time
+        rate = snapshot['parsed'] / elapsed if elapsed else 0.0
+        snapshot.update({
+            'total': self.total,
+            'elapsed_seconds': round(elapsed, 3),
+            'records_per_second': round(rate, 2),
+            'eta_seconds': round((self.total - snapshot['parsed']) / rate, 1) if rate else None,
+            'seconds_since_progress': round(now - self.last_change, 3),
+            'finished': finished
+        })
+        return snapshot
+
+    def update(self, finished=False):
+        snapshot = self.snapshot(finished)
+        if self.pbar is not None:
+            self.pbar.update(snapshot['parsed'] - self.pbar.n)
+        if self.metrics_file:
+            self.write_metrics(snapshot)
+        if self.callback:
+            self.callback(snapshot)
+
+    def write_metrics(self, snapshot):
+        """Atomically replaces the metrics file so a scraper never sees a partial file"""
+        lines = ['# HELP pyir_sequences_total Sequences that reached each stage of PyIR',
+                 '# TYPE pyir_sequences_total counter']
+        lines.extend('pyir_sequences_total{{stage="{0}"}} {1}'.format(name, snapshot[name]) for name in COUNTERS)
+        gauges = [
+            ('pyir_input_sequences', 'Sequences in the input file', snapshot['total']),
+            ('pyir_records_per_second', 'Records parsed per second since the run started',
+             snapshot['records_per_second']),
+            ('pyir_eta_seconds', 'Estimated seconds until all records are parsed', snapshot['eta_seconds']),
+            ('pyir_seconds_since_progress', 'Seconds since the last record was parsed',
+             snapshot['seconds_since_progress']),
+            ('pyir_finished', 'Whether the run has finished', int(snapshot['finished']))
+        ]
+        for name, description, value in gauges:
+            if value is not None:
+                lines.extend(['# HELP {0} {1}'.format(name, description), '# TYPE {0} gauge'.format(name),
+                              '{0} {1}'.format(name, value)])
+
+        tmp_file = self.metrics_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, self.metrics_file)
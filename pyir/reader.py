@@ -0,0 +1,265 @@
+"""Reading PyIR's lsjson, json and tsv output back.
+
+read_results(path) iterates over the records of an output file, gzipped, bzip2ed, xz compressed or not. The file is
+read and decompressed in a background thread while the records are parsed. With fields, only those fields are parsed:
+each one is found in a JSON record's text and decoded on its own, and picked from the columns of TSV rows. where is
+checked on the raw values of the fields it reads before a record is built, so records it rejects are never built."""
+import bz2
+import gzip
+import itertools
+import json
+import lzma
+import queue
+import threading
+import zlib
+
+from . import filters
+
+# Decompressed bytes read at once by the background thread, and blocks it reads ahead of the parser
+READ_SIZE = 1 << 20
+READ_AHEAD = 8
+# Compressed bytes decompressed at once, about a megabyte of output
+GZIP_READ_SIZE = 1 << 18
+# Records per batch when dataframes are returned without a batch_size
+DATAFRAME_BATCH_SIZE = 10000
+
+OPENERS = [(b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open)]
+GZIP_MAGIC = b'\x1f\x8b'
+NAN = float('nan')
+
+
+def file_blocks(path):
+    """Yields the content of a file in blocks, decompressing it if it is gzip, bzip2 or xz"""
+    with open(path, 'rb') as fin:
+        magic = fin.read(6)
+        fin.seek(0)
+        if magic.startswith(GZIP_MAGIC):
+            yield from gzip_blocks(fin)
+            return
+        for prefix, opener in OPENERS:
+            if magic.startswith(prefix):
+                fin = opener(fin, 'rb')
+                break
+        yield from iter(lambda: fin.read(READ_SIZE), b'')
+
+
+def gzip_blocks(fin):
+    """Decompresses gzip content of one member or several, as with --index, a block read at a time. zlib releases the
+    GIL while it decompresses a whole block, so the records are parsed meanwhile, which the small reads of the gzip
+    module mostly prevent"""
+    decompressor = zlib.decompressobj(31)
+    member = False
+    for data in iter(lambda: fin.read(GZIP_READ_SIZE), b''):
+        while data:
+            member = True
+            block = decompressor.decompress(data)
+            if block:
+                yield block
+            data = b''
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                member = False
+    if member:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def put(blocks, item, stop):
+    """Puts item in the queue unless the reader has stopped"""
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def read_blocks(path):
+    """Yields the decompressed content of a file in blocks, read and decompressed by a background thread"""
+    blocks = queue.Queue(maxsize=READ_AHEAD)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for block in file_blocks(path):
+                if stop.is_set():
+                    break
+                put(blocks, block, stop)
+        except Exception as e:
+            put(blocks, e, stop)
+        finally:
+            put(blocks, None, stop)
+
+    thread = threading.Thread(target=read, name='pyir-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            elif isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_lines(path):
+    """Yields the lines of a file, without their line ends, in lists of the lines of each block"""
+    pending = b''
+    for block in read_blocks(path):
+        data = pending + block
+        end = data.rfind(b'\n') + 1
+        pending = data[end:]
+        if end:
+            yield data[:end - 1].decode('utf-8').split('\n')
+    if pending:
+        yield [pending.decode('utf-8')]
+
+
+def json_records(lines):
+    """Yields the text of each record of lsjson or json output. Pretty output has records over several lines, which
+    end with a closing brace at the start of a line"""
+    pretty = None
+    for block in lines:
+        for line in block:
+            if pretty is not None:
+                pretty.append(line)
+                if line.startswith('}'):
+                    yield '\n'.join(pretty).rstrip(',')
+                    pretty = None
+            elif line.startswith('{'):
+                if line == '{':
+                    pretty = [line]
+                else:
+                    yield line.rstrip(',')
+
+
+def json_values(keys, decode=json.JSONDecoder().raw_decode):
+    """Returns the function giving the values of keys in a JSON record's text, '' for those it doesn't have.
+    A key followed by a colon can't be part of a string value, whose quotes would be escaped"""
+    keys = ['"{0}":'.format(key) for key in keys]
+
+    def values(text):
+        result = []
+        for key in keys:
+            position = text.find(key)
+            if position < 0:
+                result.append('')
+                continue
+            position += len(key)
+            while text[position] == ' ':
+                position += 1
+            result.append(decode(text, position)[0])
+        return result
+    return values
+
+
+def number(value):
+    """A numeric value as a float, NaN when it is empty so that every comparison with it fails"""
+    return NAN if value == '' or value is None else float(value)
+
+
+def compile_where(where, access):
+    """Compiles a filter expression into a function of a record's raw values, reading a field with access(field)"""
+    tree = filters.parse_expression(where)
+    namespace = {'number': number}
+    source = 'def predicate(r):\n    return {0}'.format(filters.render_expression(tree, access))
+    exec(compile(source, '<pyir where>', 'exec'), namespace)
+    return namespace['predicate']
+
+
+def parse_json(lines, fields, where):
+    """Yields the records of JSON output that where lets through, with only fields if they are given"""
+    texts = json_records(lines)
+    if fields is None:
+        predicate = compile_where(where, lambda field: 'r.get({0!r}, "")'.format(field)) if where else None
+        for text in texts:
+            d = json.loads(text)
+            if predicate is None or predicate(d):
+                yield d
+        return
+
+    keys = list(fields)
+    if where:
+        keys.extend(sorted(filters.expression_fields(filters.parse_expression(where)) - set(fields)))
+    values = json_values(keys)
+    predicate = compile_where(where, lambda field: 'r[{0}]'.format(keys.index(field))) if where else None
+    for text in texts:
+        row = values(text)
+        if predicate is None or predicate(row):
+            yield dict(zip(fields, row))
+
+
+def parse_tsv(lines, fields, where):
+    """Yields the records of TSV output that where lets through, with only fields if they are given. Values are
+    strings, as they are in the file"""
+    header = None
+    for block in lines:
+        if header is None:
+            header = block[0].split('\t')
+            block = block[1:]
+            columns = {key: index for index, key in enumerate(header)}
+            keys = header if fields is None else fields
+            indexes = [columns.get(key) for key in keys]
+            predicate = compile_where(where, lambda field: 'r[{0}]'.format(columns[field]) if field in columns
+                                      else "''") if where else None
+
+        for line in block:
+            if not line:
+                continue
+            row = line.split('\t')
+            if predicate is not None and not predicate(row):
+                continue
+            if fields is None:
+                yield dict(zip(header, row))
+            else:
+                yield {key: row[index] if index is not None and index < len(row) else ''
+                       for key, index in zip(keys, indexes)}
+
+
+def batches(records, size):
+    batch = []
+    for d in records:
+        batch.append(d)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_results(path, fields=None, where=None, batch_size=None, dataframe=False):
+    """Iterates over the records of PyIR lsjson, json or tsv output, compressed or not, as dicts.
+
+    fields: the fields to read, e.g. ['sequence_id', 'v_call', 'cdr3_aa']. Default is every field.
+    where: a filter expression, as for --filter_expression, e.g. "productive == 'T' and cdr3_aa_length >= 10". It
+        can read fields that aren't in fields.
+    batch_size: yields lists of up to this many records instead of single records.
+    dataframe: yields pandas DataFrames of batch_size records, 10000 by default.
+
+    JSON records keep their JSON types. TSV values are strings, as they are in the file. Raises ValueError for an
+    invalid where expression"""
+    if where is not None:
+        filters.parse_expression(where)
+    return iterate_results(path, list(fields) if fields is not None else None, where, batch_size, dataframe)
+
+
+def iterate_results(path, fields, where, batch_size, dataframe):
+    lines = read_lines(path)
+    first = next(lines, None)
+    if first is None:
+        return
+    parse = parse_json if first[0].lstrip().startswith(('[', '{')) else parse_tsv
+    records = parse(itertools.chain([first], lines), fields, where)
+
+    if dataframe:
+        import pandas as pd
+
+        for batch in batches(records, batch_size or DATAFRAME_BATCH_SIZE):
+            yield pd.DataFrame.from_records(batch, columns=fields)
+    elif batch_size:
+        yield from batches(records, batch_size)
+    else:
+        yield from records
@@ -0,0 +1,243 @@
+"""Compact records for dict output.
+
+With --compact_dict, the dict returned by PyIR holds every record as a CompactRecord instead of a dict. Its values
+are joined into one tab-separated line and compressed, and the field names are shared by all the records of a chunk,
+which takes about a tenth of the memory of a dict of strings and pickles much faster from the workers. A record is
+decompressed when one of its fields is read. The last record read is kept decompressed, so reading several fields of
+the same record only decompresses it once.
+
+With --shared_memory, workers pack their records into shared memory instead, and the main process copies each
+chunk's data out of it in one piece and returns compact records that read their values from that copy, uncompressed
+unless --compact_dict is given too.
+
+CompactRecords are read-only mappings: record['v_call'], get(), keys(), values(), items(), len(), `in` and comparing
+with a dict work as they do for dicts. to_dict() returns the record as a dict, e.g. for json.dumps."""
+import array
+import collections.abc
+import pickle
+import struct
+import zlib
+
+from . import columnar
+
+# Records are compressed for speed; higher levels save little on text this short
+ZSTD_LEVEL = 1
+ZLIB_LEVEL = 1
+SEPARATOR = '\t'
+
+# The record read last and its values
+last_read = (None, None)
+# (compress, decompress) of each codec, created when first used
+codecs = {}
+
+
+def default_codec():
+    """zstd when pyarrow is installed, which compresses records several times faster than zlib, and zlib otherwise"""
+    if columnar.available():
+        import pyarrow as pa
+        if pa.Codec.is_available('zstd'):
+            return 'zstd'
+    return 'zlib'
+
+
+def get_codec(name):
+    """Returns the functions compress(data) and decompress(data, size) of a codec. 'none' leaves data as it is"""
+    if name not in codecs:
+        if name == 'none':
+            codecs[name] = (lambda data: data, lambda data, size: data)
+        elif name == 'zstd':
+            import pyarrow as pa
+            codec = pa.Codec('zstd', ZSTD_LEVEL)
+            codecs[name] = (lambda data: codec.compress(data, asbytes=True),
+                            lambda data, size: codec.decompress(data, decompressed_size=size, asbytes=True))
+        else:
+            codecs[name] = (lambda data: zlib.compress(data, ZLIB_LEVEL), lambda data, size: zlib.decompress(data))
+    return codecs[name]
+
+
+def share_tracker():
+    """Starts multiprocessing's resource tracker in the main process before the worker pool, so that the workers use
+    it too. A segment a worker creates is then tracked until the main process unlinks it on receiving it, and removed
+    by the tracker if the main process dies before that"""
+    from multiprocessing import resource_tracker
+    resource_tracker.ensure_running()
+
+
+def encode(d):
+    """The values of a record as one line of UTF-8 text, and the indexes of those that are integers"""
+    values = []
+    ints = []
+    for index, value in enumerate(d.values()):
+        if isinstance(value, int) and not isinstance(value, bool):
+            ints.append(index)
+            value = str(value)
+        elif not isinstance(value, str) or SEPARATOR in value:
+            raise ValueError('{0!r} cannot be stored in a compact record'.format(value))
+        values.append(value)
+    return SEPARATOR.join(values).encode('utf-8'), tuple(ints)
+
+
+def decode(fields, data, size, ints):
+    """The values of a record encoded by encode and compressed with the codec of fields"""
+    values = str(fields.decompress(data, size), 'utf-8').split(SEPARATOR)
+    for index in ints:
+        values[index] = int(values[index])
+    return values
+
+
+class RecordKeys:
+    """The field names of compact records, in order, and the codec their values are compressed with. Shared by the
+    records that have them"""
+    __slots__ = ('names', 'indexes', 'codec', 'compress', 'decompress')
+
+    def __init__(self, names, codec='zlib'):
+        self.names = tuple(names)
+        self.indexes = {name: index for index, name in enumerate(self.names)}
+        self.codec = codec
+        self.compress, self.decompress = get_codec(codec)
+
+    def __reduce__(self):
+        return RecordKeys, (self.names, self.codec)
+
+
+class CompactRecord(collections.abc.Mapping):
+    """One AIRR record, stored compressed. data is bytes, or a view of the shared memory the record was received in.
+    ints are the indexes of the values that are integers rather than strings, such as cdr3_aa_length"""
+    __slots__ = ('fields', 'data', 'size', 'ints')
+
+    def __init__(self, fields, data, size, ints=()):
+        self.fields = fields
+        self.data = data
+        self.size = size
+        self.ints = ints
+
+    @classmethod
+    def from_dict(cls, d, fields, ints_cache=None):
+        """Compacts a record with the fields of d in the order of fields. Raises ValueError for a value that isn't a
+        string or an integer, or that contains the separator, which a dict has to keep instead"""
+        data, ints = encode(d)
+        if ints_cache is not None:
+            ints = ints_cache.setdefault(ints, ints)
+        return cls(fields, fields.compress(data), len(data), ints)
+
+    def __reduce__(self):
+        return CompactRecord, (self.fields, bytes(self.data), self.size, self.ints)
+
+    def decode(self):
+        """The values of the record, in the order of its fields"""
+        global last_read
+        record, values = last_read
+        if record is self:
+            return values
+
+        values = decode(self.fields, self.data, self.size, self.ints)
+        last_read = (self, values)
+        return values
+
+    def __getitem__(self, key):
+        return self.decode()[self.fields.indexes[key]]
+
+    def __contains__(self, key):
+        return key in self.fields.indexes
+
+    def __iter__(self):
+        return iter(self.fields.names)
+
+    def __len__(self):
+        return len(self.fields.names)
+
+    def __repr__(self):
+        return 'CompactRecord({0!r})'.format(self.to_dict())
+
+    def to_dict(self):
+        return dict(zip(self.fields.names, self.decode()))
+
+
+class SharedRecords:
+    """The records of a chunk, packed by a worker into a shared memory segment. Only the name of the segment goes
+    through the pool's result pipe. receive() copies the records' data out of the segment in one piece, releases the
+    segment and returns compact records that read their values from the copy, so records are neither pickled, copied
+    through the pipe nor built in the parent. Records that weren't compacted by the worker are stored uncompressed.
+
+    The segment holds the length of a header, the header and the records' data one after the other. The header has
+    the field names and codecs, the integer field indexes and, in arrays with one item per record, the sequence ids,
+    which field names and integer fields each record has and the length and decompressed size of its data"""
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    @classmethod
+    def send(cls, out_d):
+        """Packs the records of out_d, dicts or compact records by sequence id, into a new shared memory segment.
+        Raises ValueError if a record can't be packed"""
+        fields = {}
+        ints = {}
+        field_indexes = array.array('I')
+        int_indexes = array.array('I')
+        lengths = array.array('Q')
+        sizes = array.array('Q')
+        blobs = []
+        for d in out_d.values():
+            if isinstance(d, CompactRecord):
+                key = (d.fields.names, d.fields.codec)
+                data, size, record_ints = d.data, d.size, d.ints
+            else:
+                key = (tuple(d), 'none')
+                data, record_ints = encode(d)
+                size = len(data)
+            field_indexes.append(fields.setdefault(key, len(fields)))
+            int_indexes.append(ints.setdefault(record_ints, len(ints)))
+            lengths.append(len(data))
+            sizes.append(size)
+            blobs.append(data)
+
+        header = pickle.dumps({
+            'fields': list(fields), 'ints': list(ints), 'ids': list(out_d), 'field_indexes': field_indexes,
+            'int_indexes': int_indexes, 'lengths': lengths, 'sizes': sizes
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        from multiprocessing import shared_memory
+
+        total = 8 + len(header) + sum(lengths)
+        # The segment stays registered with the resource tracker the worker shares with the main process (see
+        # share_tracker), which unregisters it when it unlinks it on receiving it
+        segment = shared_memory.SharedMemory(create=True, size=total)
+        try:
+            buf = segment.buf
+            struct.pack_into('<Q', buf, 0, len(header))
+            buf[8:8 + len(header)] = header
+            position = 8 + len(header)
+            for data in blobs:
+                buf[position:position + len(data)] = data
+                position += len(data)
+            del buf
+        finally:
+            segment.close()
+        return cls(segment.name, total)
+
+    def receive(self):
+        """Returns the records of the segment by sequence id, as compact records. Their data is copied out of the
+        segment, which is closed and removed before returning, so no file descriptor or mapping outlives the call"""
+        from multiprocessing import shared_memory
+
+        segment = shared_memory.SharedMemory(name=self.name)
+        try:
+            segment.unlink()
+            buf = segment.buf
+            header_size = struct.unpack_from('<Q', buf, 0)[0]
+            header = pickle.loads(buf[8:8 + header_size])
+            data = memoryview(bytes(buf[8 + header_size:self.size]))
+            del buf
+        finally:
+            segment.close()
+        fields = [RecordKeys(names, codec) for names, codec in header['fields']]
+        ints = header['ints']
+
+        out_d = {}
+        position = 0
+        for sequence_id, field_index, int_index, length, size in zip(
+                header['ids'], header['field_indexes'], header['int_indexes'], header['lengths'], header['sizes']):
+            out_d[sequence_id] = CompactRecord(fields[field_index], data[position:position + length], size,
+                                               ints[int_index])
+            position += length
+        return out_d
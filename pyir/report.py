@@ -0,0 +1,282 @@
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+# Waits on IgBLAST output longer than this are recorded as their own span in --trace files
+STALL_SECONDS = 0.005
+
+
+def children_cpu_time():
+    """CPU time used by the finished child processes (IgBLAST, gzip) of this process"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    """Peak resident memory of this process or of its finished children, in KB. ru_maxrss is in KB on Linux and in
+    bytes on macOS"""
+    rss = resource.getrusage(who).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def trace_event(name, start, end, pid, tid, **args):
+    """A Chrome trace-event 'complete' span. Times are in seconds since the epoch"""
+    return {'name': name, 'ph': 'X', 'ts': round(start * 1e6), 'dur': round((end - start) * 1e6),
+            'pid': pid, 'tid': tid, 'args': args}
+
+
+class ChunkStats:
+    """Timing for a single chunk, collected in the worker process and sent back to the parent for the --report file.
+
+    Time spent by IgBLAST is measured from the parser's side of the pipe: 'igblast_startup' is the time until the
+    first line of output, 'igblast_wait' is the total time the worker was blocked waiting for output, and
+    'igblast_wall' is the lifetime of the IgBLAST processes.
+
+    With trace set, spans for the chunk, each IgBLAST process and each stall waiting on IgBLAST are also kept for the
+    --trace file."""
+    def __init__(self, chunk, trace=False):
+        self.chunk = chunk
+        self.pid = os.getpid()
+        self.wall = collections.defaultdict(float)
+        self.cpu = collections.defaultdict(float)
+        self.igblast_runs = 0
+        self.trace = trace
+        self.events = []
+        self.start = time.time()
+        # Converts perf_counter values to epoch seconds so spans from every process share one timeline
+        self.clock_offset = self.start - time.perf_counter()
+
+    def timed_lines(self, lines, start):
+        """Yields IgBLAST's output lines while timing how long each one took to arrive"""
+        first = True
+        while True:
+            wait_start = time.perf_counter()
+            line = lines.readline()
+            now = time.perf_counter()
+            self.wall['igblast_wait'] += now - wait_start
+            if self.trace and now - wait_start > STALL_SECONDS:
+                self.add_span('igblast output wait', wait_start, now)
+            if first:
+                self.wall['igblast_startup'] += now - start
+                first = False
+
+            if not line:
+                return
+            yield line
+
+    def add_igblast_run(self, start, children_cpu, igblast_pid):
+        end = time.perf_counter()
+        self.igblast_runs += 1
+        self.wall['igblast'] += end - start
+        self.cpu['igblast'] += children_cpu_time() - children_cpu
+        if self.trace:
+            self.add_span('igblast', start, end, tid=igblast_pid)
+
+    def add_span(self, name, start, end, tid=None):
+        """Adds a trace span given perf_counter start and end times"""
+        self.events.append(trace_event(name, start + self.clock_offset, end + self.clock_offset, self.pid,
+                                       tid if tid else self.pid, chunk=self.chunk))
+
+    def timed(self, stage, func, span=False):
+        """Wraps func so that its wall and CPU time are added to the given stage. With span set, each call is also
+        a span in the trace"""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                self.wall[stage] += end - start
+                self.cpu[stage] += time.process_time() - cpu
+                if span and self.trace:
+                    self.add_span(stage, start, end)
+
+        return wrapper
+
+    def to_dict(self, parser):
+        """Summarizes the chunk once the parser is done. Parsing time is whatever the worker spent that wasn't waiting
+        on IgBLAST or filtering and writing records"""
+        wall = dict(self.wall)
+        cpu = dict(self.cpu)
+        wall['serialize'] = wall.get('write', 0) - wall.get('filter', 0)
+        cpu['serialize'] = cpu.get('write', 0) - cpu.get('filter', 0)
+        # Records rejected on their raw columns are filtered while parsing, outside of write
+        prefilter_wall = wall.pop('prefilter', 0)
+        prefilter_cpu = cpu.pop('prefilter', 0)
+        wall['filter'] = wall.get('filter', 0) + prefilter_wall
+        cpu['filter'] = cpu.get('filter', 0) + prefilter_cpu
+        wall['parse'] = wall.get('chunk', 0) - wall.get('igblast_wait', 0) - wall.get('write', 0) - prefilter_wall
+        cpu['parse'] = cpu.get('chunk', 0) - cpu.get('write', 0) - prefilter_cpu
+
+        return {
+            'chunk': self.chunk,
+            'pid': self.pid,
+            'start': self.start,
+            'events': self.events,
+            'igblast_runs': self.igblast_runs,
+            'records_parsed': parser.total_parsed,
+            'records_passed': parser.total_passed,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'filters': parser.filters.get_counts(),
+            'peak_rss_kb': peak_rss_kb(),
+            'igblast_peak_rss_kb': peak_rss_kb(resource.RUSAGE_CHILDREN)
+        }
+
+
+class RunReport:
+    """Collects the parent's stage timings and the workers' ChunkStats and writes them as the --report JSON file
+    and/or the --trace Chrome trace-event file"""
+    def __init__(self, enabled, trace=False):
+        self.enabled = enabled or trace
+        self.trace = trace
+        self.stages = collections.OrderedDict()
+        self.stage_starts = {}
+        self.chunks = []
+        self.chunk_split_times = []
+        self.events = []
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, records=None):
+        """Times a stage of the parent process. CPU time includes child processes such as gzip"""
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        self.stage_starts[name] = time.time()
+        cpu = time.process_time() + children_cpu_time()
+        yield
+        self.add_stage(name, time.perf_counter() - start, time.process_time() + children_cpu_time() - cpu, records)
+        if self.trace:
+            self.events.append(trace_event(name, self.stage_starts[name], time.time(), os.getpid(), os.getpid()))
+
+    def chunk_split(self):
+        """Marks that the input splitter has started a new chunk"""
+        if self.trace:
+            self.chunk_split_times.append(time.time())
+
+    def add_stage(self, name, wall, cpu, records=None):
+        self.stages[name] = {'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6)}
+        if records is not None:
+            self.set_records(name, records)
+
+    def set_records(self, name, records):
+        """Sets the number of records a finished stage processed, for stages that only know it afterwards"""
+        if not self.enabled:
+            return
+
+        stage = self.stages[name]
+        stage['records'] = records
+        stage['records_per_second'] = round(records / stage['wall_seconds'], 2) if stage['wall_seconds'] else None
+
+    def add_chunk(self, chunk_stats):
+        if chunk_stats:
+            self.chunks.append(chunk_stats)
+
+    def worker_stages(self):
+        """Sums the worker stages over all chunks. Throughput is per worker-second, not per second of the run"""
+        records = {
+            'igblast': sum(c['records_parsed'] for c in self.chunks),
+            'parse': sum(c['records_parsed'] for c in self.chunks),
+            'filter': sum(c['records_parsed'] for c in self.chunks),
+            'serialize': sum(c['records_passed'] for c in self.chunks)
+        }
+
+        stages = collections.OrderedDict()
+        for name in ['igblast', 'parse', 'filter', 'serialize']:
+            wall = sum(c['wall_seconds'].get(name, 0) for c in self.chunks)
+            cpu = sum(c['cpu_seconds'].get(name, 0) for c in self.chunks)
+            stages['worker_' + name] = {
+                'wall_seconds': round(wall, 6),
+                'cpu_seconds': round(cpu, 6),
+                'records': records[name],
+                'records_per_second': round(records[name] / wall, 2) if wall else None
+            }
+
+        stages['worker_igblast']['startup_seconds'] = round(
+            sum(c['wall_seconds'].get('igblast_startup', 0) for c in self.chunks), 6)
+        stages['worker_igblast']['wait_seconds'] = round(
+            sum(c['wall_seconds'].get('igblast_wait', 0) for c in self.chunks), 6)
+        return stages
+
+    def filter_counts(self):
+        counts = collections.OrderedDict()
+        for chunk in self.chunks:
+            for name, count in chunk['filters'].items():
+                total = counts.setdefault(name, {'passed': 0, 'failed': 0})
+                total['passed'] += count['passed']
+                total['failed'] += count['failed']
+        return counts
+
+    def write_trace(self, path):
+        """Writes the parent stages and worker spans as a trace-event file for chrome://tracing or Perfetto. Each
+        chunk's time between the pool starting and a worker picking it up is shown as a 'queue wait' async span"""
+        if not self.trace:
+            return
+
+        parent = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': parent, 'args': {'name': 'pyir parent'}}]
+        events.extend(self.events)
+
+        split_end = self.stage_starts.get('pool', time.time())
+        for index, start in enumerate(self.chunk_split_times):
+            end = self.chunk_split_times[index + 1] if index + 1 < len(self.chunk_split_times) else split_end
+            events.append(trace_event('split', start, end, parent, parent, chunk=index))
+
+        workers = set()
+        for index, chunk in enumerate(self.chunks):
+            if chunk['pid'] not in workers:
+                workers.add(chunk['pid'])
+                events.append({'name': 'process_name', 'ph': 'M', 'pid': chunk['pid'],
+                               'args': {'name': 'pyir worker {0}'.format(chunk['pid'])}})
+
+            if 'pool' in self.stage_starts:
+                queue = {'name': 'queue wait', 'cat': 'queue', 'id': index, 'pid': parent, 'tid': parent,
+                         'args': {'chunk': chunk['chunk']}}
+                events.append(dict(queue, ph='b', ts=round(self.stage_starts['pool'] * 1e6)))
+                events.append(dict(queue, ph='e', ts=round(chunk['start'] * 1e6)))
+
+            events.extend(chunk['events'])
+
+        with open(path, 'w') as fout:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fout)
+
+    def write(self, path, **run_info):
+        if not path:
+            return
+
+        worker_rss = {}
+        for chunk in self.chunks:
+            worker_rss[chunk['pid']] = max(worker_rss.get(chunk['pid'], 0), chunk['peak_rss_kb'])
+
+        report = collections.OrderedDict(run_info)
+        report['total_wall_seconds'] = round(time.perf_counter() - self.start, 6)
+        report['stages'] = collections.OrderedDict(list(self.stages.items()) + list(self.worker_stages().items()))
+        report['filters'] = self.filter_counts()
+        report['peak_rss_kb'] = {
+            'parent': peak_rss_kb(),
+            'workers': worker_rss,
+            'igblast': max([c['igblast_peak_rss_kb'] for c in self.chunks] or [0])
+        }
+        report['chunks'] = [{
+            'chunk': c['chunk'],
+            'pid': c['pid'],
+            'records_parsed': c['records_parsed'],
+            'records_passed': c['records_passed'],
+            'igblast_runs': c['igblast_runs'],
+            'igblast_startup_seconds': round(c['wall_seconds'].get('igblast_startup', 0), 6),
+            'igblast_search_seconds': round(c['wall_seconds'].get('igblast', 0) -
+                                            c['wall_seconds'].get('igblast_startup', 0), 6),
+            'wall_seconds': {key: round(val, 6) for key, val in c['wall_seconds'].items()},
+            'cpu_seconds': {key: round(val, 6) for key, val in c['cpu_seconds'].items()}
+        } for c in self.chunks]
+
+        with open(path, 'w') as fout:
+            json.dump(report, fout, indent=4)
@@ -0,0 +1,312 @@
+"""Sorted output.
+
+With --sort_by, each worker sorts the records of its chunk before writing it, and the parent merges the sorted
+chunks into the final file with a streaming k-way merge. Text chunks (lsjson, json, tsv) are written with a keys file
+holding the length and sort key of each record, so the parent reads the records' text without parsing it. Parquet and
+Arrow chunks are merged a slice of rows at a time with pyarrow.
+
+Values are compared as their column types, e.g. cdr3_aa_length as a number, with empty values first, which is also
+the order pyarrow sorts the typed columns in. Records with equal keys keep their input order.
+
+The parent reads at most about --sort_memory MB of the chunks at once. When there are more chunks than can be read
+together within it, groups of them are first merged into larger runs, which are then merged in turn."""
+import heapq
+import json
+import operator
+import os
+import tempfile
+
+from . import columnar
+
+KEYS_EXTENSION = '.keys'
+# Smallest read buffer of each run being merged, which sets how many runs are merged at once
+MIN_RUN_BUFFER = 1 << 20
+# Runs merged at once whatever the memory, to stay well within the usual limit of open files
+MAX_FAN_IN = 256
+# Fewest rows read from a Parquet or Arrow run at once
+MIN_SLICE_ROWS = 64
+# Records written to a text run in one call
+WRITE_BATCH = 1000
+
+
+def keys_file(path):
+    return path + KEYS_EXTENSION
+
+
+def value_key(value):
+    """Sorts empty values first, without comparing them to values of another type"""
+    return (0, 0) if value is None else (1, value)
+
+
+def record_key(fields):
+    """Returns the function giving the sort key of a record dict"""
+    converters = [(field, columnar.CONVERTERS[columnar.field_type(field)]) for field in fields]
+
+    def key(d):
+        return [value_key(convert(d.get(field))) for field, convert in converters]
+    return key
+
+
+def sort_table(table, fields):
+    """Sorts an Arrow table by the fields it has, with empty values first"""
+    import pyarrow.compute as pc
+
+    fields = [field for field in fields if field in table.schema.names]
+    if not fields or table.num_rows < 2:
+        return table
+    try:
+        indices = pc.sort_indices(table, sort_keys=[(field, 'ascending', 'at_start') for field in fields])
+    except (TypeError, ValueError):
+        # pyarrow before 25 takes one null placement for every key
+        indices = pc.sort_indices(table, sort_keys=[(field, 'ascending') for field in fields],
+                                  null_placement='at_start')
+    return table.take(indices)
+
+
+def merge_plan(sort_memory):
+    """The number of runs merged at once and the read buffer of each, from --sort_memory in MB"""
+    memory = sort_memory << 20
+    fan_in = max(2, min(MAX_FAN_IN, memory // MIN_RUN_BUFFER))
+    return fan_in, max(memory // fan_in, MIN_RUN_BUFFER)
+
+
+def merge_runs(runs, fan_in, merge_group, work_dir):
+    """Merges groups of fan_in runs with merge_group(group, path) until at most fan_in are left, and returns those.
+    The intermediate runs are removed once they are merged"""
+    intermediate = set()
+    while len(runs) > fan_in:
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start:start + fan_in]
+            with tempfile.NamedTemporaryFile(prefix='pyir_run_', dir=work_dir, delete=False) as run:
+                path = run.name
+            merge_group(group, path)
+            merged.append(path)
+            for done in intermediate.intersection(group):
+                remove_run(done)
+                intermediate.remove(done)
+        intermediate.update(merged)
+        runs = merged
+    return runs, intermediate
+
+
+def remove_run(path):
+    os.remove(path)
+    if os.path.exists(keys_file(path)):
+        os.remove(keys_file(path))
+
+
+def merge(chunk_files, outfile, outfmt, fields, sort_memory):
+    """Merges sorted chunk files into the final output file and returns the number of records written"""
+    fan_in, run_buffer = merge_plan(sort_memory)
+    work_dir = os.path.dirname(os.path.abspath(chunk_files[0]))
+    if outfmt in columnar.FORMATS:
+        memory = sort_memory << 20
+        group_merge = lambda group, path: merge_tables(group, path, 'ipc', fields, memory)
+        runs, intermediate = merge_runs(chunk_files, fan_in, group_merge, work_dir)
+        total = merge_tables(runs, outfile, outfmt, fields, memory)
+    else:
+        group_merge = lambda group, path: merge_text(group, path, outfmt, run_buffer, True)
+        runs, intermediate = merge_runs(chunk_files, fan_in, group_merge, work_dir)
+        total = merge_text(runs, outfile, outfmt, run_buffer, False)
+
+    for path in intermediate:
+        remove_run(path)
+    return total
+
+
+def write_text_run(fout, fkeys, records):
+    """Writes the text of sorted (key, text) records to fout, and their length and key to fkeys"""
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    total = 0
+    texts = []
+    keys = []
+    for key, text in records:
+        texts.append(text)
+        keys.append(encode([len(text), key]))
+        if len(texts) >= WRITE_BATCH:
+            fout.write(''.join(texts))
+            fkeys.write('\n'.join(keys) + '\n')
+            total += len(texts)
+            texts = []
+            keys = []
+    if texts:
+        fout.write(''.join(texts))
+        fkeys.write('\n'.join(keys) + '\n')
+        total += len(texts)
+    return total
+
+
+def read_text_run(path, outfmt, run_buffer):
+    """Yields the (key, text) of the records of a sorted text run"""
+    with open(path, 'r', buffering=run_buffer // 2) as fin, \
+            open(keys_file(path), 'r', buffering=run_buffer // 2) as fkeys:
+        if outfmt == 'tsv':
+            fin.readline()
+        for line in fkeys:
+            length, key = json.loads(line)
+            yield key, fin.read(length)
+
+
+def merge_text(runs, outfile, outfmt, run_buffer, keep_keys):
+    """Merges sorted text runs into outfile. keep_keys writes outfile as a run for a later merge, and otherwise it is
+    written as the final lsjson, json or tsv file, as concatenating the chunks would"""
+    records = heapq.merge(*[read_text_run(path, outfmt, run_buffer) for path in runs], key=operator.itemgetter(0))
+    with open(outfile, 'w') as fout:
+        if outfmt == 'tsv':
+            # As with concatenated chunks, the header is that of the first one
+            with open(runs[0], 'r') as fin:
+                fout.write(fin.readline())
+        elif outfmt == 'json' and not keep_keys:
+            fout.write('[\n')
+
+        if keep_keys:
+            with open(keys_file(outfile), 'w') as fkeys:
+                return write_text_run(fout, fkeys, records)
+
+        total = 0
+        for key, text in records:
+            fout.write(text)
+            total += 1
+        if outfmt == 'json':
+            fout.seek(fout.tell() - 2, 0)
+            fout.write('\n]\n')
+    return total
+
+
+class TableRun:
+    """A sorted Parquet or Arrow chunk or run, read a slice of rows at a time in the target schema"""
+    def __init__(self, path, target, fields, run_buffer):
+        import pyarrow as pa
+
+        self.source = pa.memory_map(path, 'r')
+        self.reader = pa.ipc.open_file(self.source)
+        self.target = target
+        self.fields = [field for field in fields if field in target.names]
+        self.run_buffer = run_buffer
+        self.batch_index = 0
+        self.offset = 0
+        self.rows = None
+        self.table = None
+        self.keys = None
+
+    def close(self):
+        self.source.close()
+
+    def read(self):
+        """Reads the next slice of rows into table. Returns False at the end of the run"""
+        import pyarrow as pa
+
+        while self.batch_index < self.reader.num_record_batches:
+            batch = self.reader.get_batch(self.batch_index)
+            if self.offset < batch.num_rows:
+                if self.rows is None:
+                    row_bytes = max(batch.nbytes // batch.num_rows, 1)
+                    self.rows = max(MIN_SLICE_ROWS, self.run_buffer // row_bytes)
+                piece = batch.slice(self.offset, self.rows)
+                self.offset += piece.num_rows
+                self.table = columnar.conform(pa.Table.from_batches([piece]), self.target)
+                self.keys = None
+                return True
+            self.batch_index += 1
+            self.offset = 0
+        self.table = None
+        return False
+
+    def key(self, index):
+        """The sort key of a row of the current slice, in the same form as record_key gives"""
+        if self.keys is None:
+            self.keys = list(zip(*[self.table.column(field).to_pylist() for field in self.fields]))
+        return [value_key(value) for value in self.keys[index]]
+
+    def count_before(self, cutoff, inclusive):
+        """The number of rows of the slice that sort before cutoff, or before or at it when inclusive"""
+        low, high = 0, self.table.num_rows
+        while low < high:
+            middle = (low + high) // 2
+            key = self.key(middle)
+            if key < cutoff or (inclusive and key == cutoff):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def consume(self, count):
+        """Drops the first count rows of the slice, reading the next slice once it is used up"""
+        if not count:
+            return True
+        elif count >= self.table.num_rows:
+            return self.read()
+        self.table = self.table.slice(count)
+        self.keys = self.keys[count:] if self.keys is not None else None
+        return True
+
+
+def merge_tables(runs, outfile, outfmt, fields, memory):
+    """Merges sorted Parquet or Arrow runs into outfile, 'ipc' writing it as a run for a later merge. Half of memory
+    holds the slices read from the runs and half the rows taken from them.
+
+    Each step finds the run whose current slice ends with the smallest key, takes from every run the rows that sort
+    before the end of that slice, and sorts only those with pyarrow. Every row taken is written, so no row is sorted
+    twice however the runs overlap"""
+    import pyarrow as pa
+
+    schemas = []
+    for path in runs:
+        with pa.memory_map(path, 'r') as source:
+            schemas.append(pa.ipc.open_file(source).schema)
+    target = max(schemas, key=len) if schemas else pa.schema([])
+
+    active = []
+    run_buffer = memory // (2 * max(len(runs), 1))
+    for path in runs:
+        run = TableRun(path, target, fields, run_buffer)
+        if run.read():
+            active.append(run)
+        else:
+            run.close()
+
+    total = 0
+    with pa.OSFile(outfile, 'wb') as sink:
+        if outfmt == 'ipc':
+            writer = pa.ipc.new_file(sink, target)
+        else:
+            writer = columnar.new_writer(sink, target, outfmt)
+        with writer:
+            pending = []
+            pending_rows = 0
+            while active:
+                if len(active) == 1:
+                    taken = active[0].table
+                    if not active[0].consume(taken.num_rows):
+                        active[0].close()
+                        active = []
+                else:
+                    # Ties between runs go to the earlier run, which holds the earlier input
+                    last, smallest = min((run.key(run.table.num_rows - 1), index) for index, run in enumerate(active))
+                    pieces = []
+                    remaining = []
+                    for index, run in enumerate(active):
+                        count = run.count_before(last, index <= smallest)
+                        if count:
+                            pieces.append(run.table.slice(0, count))
+                        if run.consume(count):
+                            remaining.append(run)
+                        else:
+                            run.close()
+                    active = remaining
+                    taken = sort_table(pa.concat_tables(pieces), fields)
+
+                pending.append(taken)
+                pending_rows += taken.num_rows
+                if pending_rows >= columnar.ROW_GROUP_SIZE or not active:
+                    table = pa.concat_tables(pending)
+                    if outfmt == 'ipc':
+                        writer.write_table(table)
+                    else:
+                        columnar.write_table(writer, table, outfmt)
+                    total += pending_rows
+                    pending = []
+                    pending_rows = 0
+
+    return total
@@ -0,0 +1,169 @@
+import collections
+import json
+import math
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+# Chunk sizes tried once the best process count and IgBLAST threads are known
+CHUNK_SIZES = [25, 50, 100, 200, 400, 800, 1600, 3200]
+# Reads sampled per core when --tune_reads isn't given
+READS_PER_CORE = 500
+# Arguments set from the config file when they aren't given on the command line
+TUNED_ARGS = ['multi', 'igblast_threads', 'chunk_size']
+
+
+def default_config_file():
+    """The per-host config file written by `pyir tune`, ~/.config/pyir/<hostname>.json"""
+    config_dir = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(config_dir, 'pyir', socket.gethostname() + '.json')
+
+
+def load_config(path):
+    """Returns the tuned settings in the config file, or an empty dict if there is no usable config"""
+    try:
+        with open(path, 'r') as fin:
+            config = json.load(fin)
+    except (OSError, ValueError):
+        return {}
+    return {key: config[key] for key in TUNED_ARGS if config.get(key)}
+
+
+def save_config(path, config):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fout:
+        json.dump(config, fout, indent=4)
+
+
+def powers_of_two(limit):
+    """1, 2, 4, ... up to limit, plus limit itself"""
+    values = [1]
+    while values[-1] * 2 < limit:
+        values.append(values[-1] * 2)
+    if limit > 1:
+        values.append(limit)
+    return values
+
+
+class Tuner:
+    """Finds the fastest --multi, --igblast_threads and --chunk_size for this machine with short timed PyIR runs on a
+    sample of a real input file, using the germline databases and IgBLAST settings of the tune command line.
+
+    Process count and IgBLAST threads are searched first, over every combination that doesn't use more threads
+    than there are cores, with about four chunks per process. The chunk size is then searched with the best of
+    those, keeping at least two chunks per process so that the sample's tail doesn't favor small chunks. The best
+    settings are saved to the per-host config file that later runs read their defaults from."""
+    def __init__(self, args, argv):
+        self.args = args
+        self.argv = argv
+        self.silent = args['silent']
+        self.cores = os.cpu_count()
+        self.trials = []
+
+    def write_sample(self, path):
+        """Copies the first --tune_reads reads of the input file and returns how many were copied"""
+        num_reads = self.args['tune_reads'] or READS_PER_CORE * self.cores
+        count = 0
+        with open(self.args['tune_input'], 'r') as fin, open(path, 'w') as fout:
+            if self.args['input_type'] == 'fastq':
+                for i, line in enumerate(fin):
+                    if i % 4 == 0:
+                        if count == num_reads:
+                            break
+                        count += 1
+                    fout.write(line)
+            else:
+                for line in fin:
+                    if line.startswith('>'):
+                        if count == num_reads:
+                            break
+                        count += 1
+                    fout.write(line)
+        return count
+
+    def trial(self, multi, igblast_threads, chunk_size, record=True):
+        """Times a PyIR run on the sample with the given settings"""
+        from .factory import PyIR
+
+        argv = list(self.argv)
+        argv[argv.index('tune')] = self.sample
+        argv += ['--multi', str(multi), '--igblast_threads', str(igblast_threads), '--chunk_size', str(chunk_size),
+                 '--silent', '--gzip', 'False', '--tmp_dir', self.tmp_dir,
+                 '--out', os.path.join(self.tmp_dir, 'tune_output')]
+
+        start = time.time()
+        pyir = PyIR(query=argv[0], args=argv[1:])
+        output = pyir.run()
+        seconds = time.time() - start
+        if isinstance(output, str) and os.path.exists(output):
+            os.remove(output)
+
+        result = collections.OrderedDict([
+            ('multi', multi),
+            ('igblast_threads', igblast_threads),
+            ('chunk_size', chunk_size),
+            ('seconds', round(seconds, 3)),
+            ('reads_per_second', round(self.num_reads / seconds, 2))
+        ])
+        if record:
+            self.trials.append(result)
+            if not self.silent:
+                print('--multi {0:<4} --igblast_threads {1:<3} --chunk_size {2:<6} {3:>8.2f}s {4:>10,.0f} reads/s'.format(
+                    multi, igblast_threads, chunk_size, seconds, result['reads_per_second']))
+        return result
+
+    def chunk_size_for(self, multi, chunks_per_process):
+        return max(1, int(math.ceil(self.num_reads / float(multi * chunks_per_process))))
+
+    def run(self):
+        self.tmp_dir = tempfile.mkdtemp(dir=self.args['tmp_dir'])
+        extension = '.fastq' if self.args['input_type'] == 'fastq' else '.fasta'
+        self.sample = os.path.join(self.tmp_dir, 'tune_sample' + extension)
+        try:
+            self.num_reads = self.write_sample(self.sample)
+            if not self.silent:
+                print('Tuning on {0:,} reads from {1} with {2} cores'.format(self.num_reads, self.args['tune_input'],
+                                                                            self.cores))
+
+            # Untimed run so that the germline databases are in the page cache for every trial
+            self.trial(self.cores, 1, self.chunk_size_for(self.cores, 1), record=False)
+
+            for igblast_threads in powers_of_two(self.cores):
+                for multi in powers_of_two(self.cores // igblast_threads):
+                    self.trial(multi, igblast_threads, self.chunk_size_for(multi, 4))
+            best = max(self.trials, key=lambda t: t['reads_per_second'])
+
+            max_chunk_size = self.chunk_size_for(best['multi'], 2)
+            for chunk_size in CHUNK_SIZES:
+                if chunk_size <= max_chunk_size and chunk_size != best['chunk_size']:
+                    self.trial(best['multi'], best['igblast_threads'], chunk_size)
+            best = max(self.trials, key=lambda t: t['reads_per_second'])
+        finally:
+            shutil.rmtree(self.tmp_dir)
+
+        config = collections.OrderedDict([
+            ('multi', best['multi']),
+            ('igblast_threads', best['igblast_threads']),
+            ('chunk_size', best['chunk_size']),
+            ('reads_per_second', best['reads_per_second']),
+            ('host', socket.gethostname()),
+            ('cores', self.cores),
+            ('tune_input', os.path.abspath(self.args['tune_input'])),
+            ('tune_reads', self.num_reads),
+            ('species', self.args['species']),
+            ('receptor', self.args['receptor']),
+            ('legacy', self.args['legacy']),
+            ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('trials', self.trials)
+        ])
+        save_config(self.args['config'], config)
+
+        if not self.silent:
+            print('Best settings: --multi {0} --igblast_threads {1} --chunk_size {2} ({3:,.0f} reads/s)'.format(
+                best['multi'], best['igblast_threads'], best['chunk_size'], best['reads_per_second']))
+            print('Saved to {0}, later runs on this host use them unless given on the command line'.format(
+                self.args['config']))
+        return config
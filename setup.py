@@ -10,6 +10,7 @@ setup(
     author_email='samuel.day@vumc.org, andrejbranch@gmail.com, jwillis0720@gmail.com, strnad.bird@gmail.com',
     scripts=['./bin/pyir'],
     install_requires=['tqdm'],
+    extras_require={'arrow': ['pyarrow']},
     packages=['crowelab_pyir'],
     package_dir={'crowelab_pyir': './pyir'},
     package_data={'crowelab_pyir': ['data/*',